@@ -1,423 +1,64 @@
 # coding=utf-8
 from __future__ import absolute_import
 
-import re, sys, math, numpy as np, threading
+import re, os, sys, math, time, threading
+
+# measured so the cost of loading the plugin shows up in the logs and the batch command
+_loadStarted = time.time()
 
 import octoprint.plugin
 import octoprint.filemanager
 import octoprint.filemanager.util
 from octoprint.filemanager import FileDestinations
+from octoprint.events import Events
 
 from octoprint.access.permissions import Permissions
 
-import octoprint_gcodeleveling.twoDimFit
-import octoprint_gcodeleveling.maxima
-
-def rotateVector(theta, vec):
-	rotArray = np.array(((math.cos(theta),-math.sin(theta)),(math.sin(theta),math.cos(theta))))
-	return np.matmul(rotArray, vec)
-
-class GcodeLevelingError(Exception):
-	def __init__(self, expression, message):
-		self.expression = expression
-		self.message = message
-
-class GcodePreProcessor(octoprint.filemanager.util.LineProcessorStream):
-	def __init__(self, fileBufferedReader, python_version, logger, coeffs, zMin, zMax, lineBreakDist, arcSegDist, invertPosition):
-		super(GcodePreProcessor, self).__init__(fileBufferedReader)
-		self.python_version = python_version
-		self._logger = logger
-		self.coeffs = coeffs
-		self.zMin = zMin
-		self.zMax = zMax
-		self.lineBreakDist = lineBreakDist**2
-		self.arcSegDist = arcSegDist
-		self.invertPosition = invertPosition
-
-		self.pwm = maxima.SingleGradientAscent()
-
-		self.moveCurr = "G0"
-
-		self.xPrev = 0.0
-		self.yPrev = 0.0
-		self.zPrev = 0.0
-		self.ePrev = 0.0
-
-		self.xCurr = 0.0
-		self.yCurr = 0.0
-		self.zCurr = 0.0
-
-		self.eCurr = 0.0
-
-		self.eMode = "None"
-		self.moveMode = "Absolute"
-		self.workspacePlane = 0
-
-		self.workspacePlanes = ["G17", "G18", "G19"]
-
-		self.spareParts = ""
-
-
-		self.afterStart = False
-		self.positionFloating = False
-
-		self.move_pattern = re.compile("^G[0-3]\s")
-		self.move_mode_pattern = re.compile("^G9[0-1]")
-		self.pos_reset_pattern = re.compile("^G92")
-		self.set_workspace_plane = re.compile("^G1[7-9]")
-		self.extruder_mode_pattern = re.compile("^M8[2-3]")
-		self.comment_pattern = re.compile(";.*$")
-
-	def comment_split(self, line):
-		# Logic to seperate comments so they can be reattached after processing
-		if line.find(";") != -1:
-			comSplit = line.split(";")
-			activeCode = comSplit[0]
-			if len(comSplit) > 1:
-				for part in comSplit[1:]:
-						self.spareParts += ";" + part + " "
-
-			return activeCode
-		else:
-			return line
-
-	def move_dist(self):
-		return (self.xCurr-self.xPrev)**2 + (self.yCurr-self.yPrev)**2
-
-	def get_z(self, x, y, zOffset):
-		zNew = twoDimFit.twoDpolyEval(self.coeffs, x, y) + (zOffset * (-1 if self.invertPosition else 1))
-
-		if (zNew < self.zMin or zNew > self.zMax):
-			self._logger.info("Failed Leveling Point: {}, {}, {}".format(str(x),str(y),str(zNew)))
-			raise GcodeLevelingError("Computed Z was outside of bounds", "Gcode Leveling config likely needs to be changed")
-		return round(zNew, 3)
-
-	def createLine(self, prev, pos, zVal, eVal):
-		outLine = self.moveCurr
-
-		if pos[0] != prev[0]:
-				outLine += " X" + str(round(pos[0], 3))
-		if pos[1] != prev[1]:
-				outLine += " Y" + str(round(pos[1], 3))
-		outLine += " Z" + str(self.get_z(pos[0], pos[1], zVal))
-
-		if self.eMode != "None":
-				outLine += " E" + str(round(eVal, 5))
-
-		outLine += " " + self.spareParts
-		self.spareParts = ""
-
-		outLine += "\n"
-
-		return outLine
-
-	def createArc(self, start, center, angle, eVal, zVal):
-		outLine = self.moveCurr
-
-		radius = start - center
-
-		end = center + rotateVector(angle, radius)
-
-		if end[0] != start[0]:
-			outLine += " X" + str(round(end[0], 3))
-		if end[1] != start[1]:
-			outLine += " Y" + str(round(end[1], 3))
-		outLine += " Z" + str(self.get_z(end[0], end[1], zVal))
-
-		outLine += " I" + str(round(-radius[0], 3))
-		outLine += " J" + str(round(-radius[1], 3))
-		if self.eMode != "None":
-			outLine += " E" + str(round(eVal, 5))
-		outLine += " " + self.spareParts
-		self.spareParts = ""
-
-		outLine += "\n"
-
-		return outLine
-
-	def reconstruct_line(self):
-		outLine = self.moveCurr
-
-		if self.xCurr != self.xPrev:
-			outLine += " X" + str(round(self.xCurr, 3))
-		if self.yCurr != self.yPrev:
-			outLine += " Y" + str(round(self.yCurr, 3))
-		outLine += " Z" + str(self.get_z(self.xCurr, self.yCurr, self.zCurr))
-
-		if self.eMode != "None":
-			outLine += " E" + str(round(self.eCurr, 5))
-
-		outLine += " " + self.spareParts
-		self.spareParts = ""
-
-		outLine += "\n"
-
-		return outLine
-
-	def reconstruct_arc(self, arcI, arcJ, arcR):
-		outLine = self.moveCurr
-
-		outLine += " X" + str(round(self.xCurr, 3))
-		outLine += " Y" + str(round(self.yCurr, 3))
-		outLine += " Z" + str(self.get_z(self.xCurr, self.yCurr, self.zCurr))
-
-		if arcI != 0.0:
-			outLine += " I" + str(round(arcI, 3))
-		if arcJ != 0.0:
-			outLine += " J" + str(round(arcJ, 3))
-		if arcR != 0.0:
-			outLine += " R" + str(round(arcR, 3))
-
-		if self.eMode != "None":
-			outLine += " E" + str(round(self.eCurr, 5))
-
-		outLine += " " + self.spareParts
-		self.spareParts = ""
-
-		outLine += "\n"
-
-		return outLine
-
-	def process_line(self, origLine):
-		if not len(origLine):
-			return None
-
-		if (self.python_version == 3):
-			line = origLine.decode('utf-8').lstrip()
-		else:
-			line = origLine
-
-		# Check for standard Movement commands
-		if self.move_pattern.match(line) is not None and self.moveMode != "Relative" and not self.positionFloating:
-			activeCode = self.comment_split(line)
-			gcodeParts = re.split("\s", activeCode)
-
-			self.xPrev = self.xCurr
-			self.yPrev = self.yCurr
-			self.zPrev = self.zCurr
-
-			arcI = 0.0
-			arcJ = 0.0
-			arcR = 0.0
-
-			self.moveCurr = gcodeParts[0]
-
-			for part in gcodeParts[1:]:
-				if len(part) > 1:
-					leadChar = part[0]
-					if leadChar == "X":
-						self.xCurr = float(part[1:])
-					elif leadChar == 'Y':
-						self.yCurr = float(part[1:])
-					elif leadChar == 'Z':
-						self.zCurr = float(part[1:])
-					elif leadChar == 'E':
-						# Extrusion Mode Stuff
-						if (self.eMode == "Relative"):
-							self.ePrev = 0
-						elif (self.eMode == "Absolute"):
-							self.ePrev = self.eCurr
-						else:
-							self.eMode = "Absolute"
-							self.ePrev = self.eCurr
-
-						self.eCurr = float(part[1:])
-					elif leadChar == 'I':
-						arcI = float(part[1:])
-					elif leadChar == 'J':
-						arcJ = float(part[1:])
-					elif leadChar == 'R':
-						arcR = float(part[1:])
-					else:
-						self.spareParts = part + " " + self.spareParts
-
-			if self.moveCurr == "G0" or self.moveCurr == "G1":
-				self.moveDist = self.move_dist()
-
-				if (self.moveDist > self.lineBreakDist and self.lineBreakDist != 0.0 and self.afterStart):
-					line = ""
-					start = np.array([self.xPrev, self.yPrev])
-					end = np.array([self.xCurr, self.yCurr])
-
-					for s, e in maxima.lineWiseMaxima(self.coeffs, start, end, self.pwm):
-						eVal = 0.0
-						if (self.eMode == "Absolute"):
-								eVal = self.ePrev + (self.eCurr-self.ePrev) * np.linalg.norm(e - start) / np.linalg.norm(end - start)
-						elif (self.eMode == "Relative"):
-								eVal = self.eCurr * np.linalg.norm(e - s) / np.linalg.norm(end - start)
-						zVal = self.zPrev + (self.zCurr - self.zPrev)*np.linalg.norm(e - start) / np.linalg.norm(end - start)
-
-						line += self.createLine(s, e, zVal, eVal)
-				else:
-					self.afterStart = True
-					line = self.reconstruct_line()
-			elif self.workspacePlane == 0:
-				# Handling for Gcode files that do not give a pos before the arc
-				if not self.afterStart:
-					self.zPrev = self.get_z(self.xPrev, self.yPrev, 0.0)*(self.invertPosition*2 - 1)
-
-				if (arcI or arcJ) and arcR:
-					raise GcodeLevelingError("Arc format mixing error", "G2/G3 commands cannot use R with I or J")
-				elif arcI or arcJ:
-					# figure out the center point
-					radius = np.array((-arcI, -arcJ))
-					prev = np.array((self.xPrev, self.yPrev))
-					current = np.array((self.xCurr, self.yCurr))
-					center = prev - radius
-					endArm = current - center
-
-					r = np.array((radius[0], radius[1], 0.0))
-					eA = np.array((endArm[0], endArm[1], 0.0))
-
-
-					# figure out exit angle
-					normalizedCross = np.cross(r, eA)/(np.linalg.norm(radius)*np.linalg.norm(endArm))
-					# alpha = math.asin(normalizedCross[2])
-					alpha = math.acos(np.dot(radius, endArm)/(np.linalg.norm(radius)*np.linalg.norm(endArm)))
-
-
-					longPath = (self.moveCurr == "G3") != (normalizedCross[2] > 0)
-
-					arcAngle = 0.0
-					if longPath:
-						arcAngle = 2*math.pi-alpha
-					else:
-						arcAngle = alpha
-
-					if self.moveCurr == "G2":
-						arcAngle *= -1
-
-					# self._logger.info("Arc Angle {}".format(arcAngle))
-					arcLength = np.linalg.norm(radius) * arcAngle
-
-					if (self.arcSegDist != 0.0 and arcLength >= self.arcSegDist):
-						line = ""
-
-						for s, c, a, qin, qend in maxima.flatArcWiseMaxima(self.coeffs, center, radius, arcAngle, 0, 1, self.pwm):
-							if (self.eMode == "Absolute"):
-								eVal = self.ePrev + (self.eCurr-self.ePrev) * qend
-							elif (self.eMode == "Relative"):
-								eVal = self.eCurr * (qend-qin)
-							zVal = qend*(self.zCurr - self.zPrev) + self.zPrev
-
-							line += self.createArc(s, c, a, eVal, zVal)
-					else:
-						self.reconstruct_arc(arcI, arcJ, arcR)
-
-				elif arcR:
-					# figure out the center point
-					prev = np.array((self.xPrev, self.yPrev))
-					current = np.array((self.xCurr, self.yCurr))
-
-					directConnect = current-prev
-
-					if np.linalg.norm(directConnect) > 2*arcR:
-						raise GcodeLevelingError("Invalid Arc Radius", "An arc cannot be formed with too small of a radius")
-					elif np.linalg.norm(directConnect) == 0.0:
-						raise GcodeLevelingError("Invalid Arc Endpoints", "An radius defined arc cannot be formed with identital endpoints")
-					rotModify = -1 if self.moveCurr == "G2" else 1
-
-					q = np.array((directConnect[1]*-1*rotModify, directConnect[0]*rotModify))
-					q /= np.linalg.norm(q)
-					q *= math.sqrt(arcR**2 - (np.linalg.norm(directConnect)/2)**2)
-
-					center = prev + directConnect/2 + q
-
-					pArm = prev - center
-					cArm = current - center
-
-					# figure out exit angle
-					arcAngle = math.acos(np.dot(pArm, cArm)/(np.linalg.norm(pArm)*np.linalg.norm(cArm)))
-
-					arcLength = arcR * arcAngle
-
-					if self.moveCurr == "G2":
-						arcAngle *= -1
-
-					if (self.arcSegDist != 0.0 and arcLength >= self.arcSegDist):
-						line = ""
-
-						for s, c, a, qin, qend in maxima.flatArcWiseMaxima(self.coeffs, center, radius, arcAngle, 0, 1, self.pwm):
-							if (self.eMode == "Absolute"):
-								eVal = self.ePrev + (self.eCurr-self.ePrev) * qend
-							elif (self.eMode == "Relative"):
-								eVal = self.eCurr * (qend-qin)
-							zVal = qend*(self.zCurr - self.zPrev) + self.zPrev
-
-							line += self.createArc(s, c, a, eVal, zVal)
-					else:
-						self.reconstruct_arc(arcI, arcJ, arcR)
-
-				else:
-						raise GcodeLevelingError("Arc values missing", "G2/G3 commands either need an R or an I or J")
-
-		# # TODO: Add in proper support for relative movements
-		elif (self.pos_reset_pattern.match(line) is not None):
-			activeCode = self.comment_split(line)
-			gcodeParts = re.split("\s", activeCode)
-
-			self.xPrev = self.xCurr
-			self.yPrev = self.yCurr
-			self.zPrev = self.zCurr
-
-			for part in gcodeParts[1:]:
-				if len(part) > 1:
-					leadChar = part[0]
-					if leadChar == "X" or leadChar == 'Y' or leadChar == 'Z':
-						self.posFloating = True
-					elif leadChar == 'E':
-						self.eCurr = float(part[1:])
-
-			return origLine
-		# Check for movement mode
-		elif self.move_mode_pattern.match(line) is not None:
-			line = re.sub(self.comment_pattern, "", line)
-			mode = re.split("\s", line)[0]
-
-			if mode == "G90":
-				self.moveMode = "Absolute"
-			elif mode == "G91":
-				self.moveMode = "Relative"
-
-			# self._logger.info("Line sets move mode " + self.moveMode)
-			return origLine
-
-		# Check for extruder movement mode
-		elif self.extruder_mode_pattern.match(line) is not None:
-			line = re.sub(self.comment_pattern, "", line)
-			mode = re.split("\s", line)[0]
-
-			if mode == "M82":
-				self.eMode = "Absolute"
-			elif mode == "M83":
-				self.eMode = "Relative"
-
-			# self._logger.info("Line sets extruder mode " + self.eMode)
-			return origLine
-
-		# Check for workspace switches
-		elif self.set_workspace_plane.match(line) is not None:
-			line = re.sub(self.comment_pattern, "", line)
-			mode = re.split("\s", line)[0]
-
-			self.workspacePlane = workspacePlanes.index(mode)
-			return origLine
-
-		if (self.python_version == 3):
-			line = line.encode('utf-8')
-
-		return line
+# numpy and the fitting/maxima modules are imported on first use, see ensure_model
+import octoprint_gcodeleveling.storage
+import octoprint_gcodeleveling.model
+import octoprint_gcodeleveling.jobs
+import octoprint_gcodeleveling.probing
+import octoprint_gcodeleveling.governor
 
 class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 						  octoprint.plugin.SettingsPlugin,
 						  octoprint.plugin.AssetPlugin,
 						  octoprint.plugin.TemplatePlugin,
-						  octoprint.plugin.SimpleApiPlugin):
+						  octoprint.plugin.SimpleApiPlugin,
+						  octoprint.plugin.EventHandlerPlugin,
+						  octoprint.plugin.ShutdownPlugin):
+
+	def __init__(self):
+		self.probeSession = probing.ProbeSession()
+
+		self.printing = False
+		# send loop latency is only measured during prints with Measure Send Latency on, the serial hooks check this flag alone
+		self.measuringLatency = False
+		self.sendLatency = governor.SendLatency()
+		# state and result of the last dry run of each path
+		self.analyses = dict()
+		# loaded seek index of each path, with the mtime and size of the index file it was read from
+		self.seekIndexes = dict()
+
+		self.relevelPaths = set()
+		self.resumedPaths = set()
 
-	checkForProbe = 0
+		self.model = None
+		self.modelCache = None
+		self.modelLock = threading.Lock()
+
+		self.jobPool = None
 
 	def createFilePreProcessor(self, path, file_object, blinks=None, printer_profile=None, allow_overwrite=True, *args, **kwargs):
+		if path in self.resumedPaths:
+			# finished by a job resumed after a restart, it is already leveled
+			return file_object
+
 		if self.pointsEntered:
+			from octoprint_gcodeleveling import bounds
+			from octoprint_gcodeleveling.preprocessor import GcodeLevelingError, GcodeLevelingFailure
+
 			fileName = file_object.filename
 			if not octoprint.filemanager.valid_file_type(fileName, type="gcode"):
 				return file_object
@@ -425,9 +66,17 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 			if fileName.endswith("_NO-GCL.gcode"):
 				return file_object
 			else:
-				if self.unmodifiedCopy:
-					import os
-
+				if path in self.relevelPaths:
+					# the original is already stored compressed, it is just being leveled again
+					pass
+				elif self.unmodifiedCopy and self.compressUnmodified:
+					# Unprocessed file stream is compressed into the plugin data folder instead of the uploads
+					stream = file_object.stream()
+					try:
+						storage.saveCompressed(stream, storage.originalPath(self.get_plugin_data_folder(), path))
+					finally:
+						stream.close()
+				elif self.unmodifiedCopy:
 					gclFileName = re.sub(".gcode", "_NO-GCL.gcode", fileName)
 					gclShortPath = re.sub(".gcode", "_NO-GCL.gcode", path)
 
@@ -440,27 +89,127 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 					cleanFO = octoprint.filemanager.util.DiskFileWrapper(gclFileName, gclPath)
 					self._file_manager.add_file(FileDestinations.LOCAL, gclPath, cleanFO, allow_overwrite=True, display=gclFileName)
 
-				fileStream = file_object.stream()
-				self._logger.info("Gcode PreProcessing started.")
-				self.gcode_preprocessor = GcodePreProcessor(fileStream, self.python_version, self._logger, self.coeffs, self.zMin, self.zMax, self.lineBreakDist, self.arcSegDist, self.invertPosition)
-			return octoprint.filemanager.util.StreamWrapper(fileName, self.gcode_preprocessor)
+				levelingModel = self.ensure_model()
+
+				certification = self.certify_file(path, file_object, levelingModel)
+				if certification is not None and certification['status'] == bounds.OUTSIDE:
+					x, y, z = certification['point']
+					self._logger.info("Failed Leveling Point: {}, {}, {}".format(str(x),str(y),str(z)))
+					error = GcodeLevelingError("Computed Z was outside of bounds", "Gcode Leveling config likely needs to be changed")
+					return octoprint.filemanager.util.StreamWrapper(fileName, GcodeLevelingFailure(file_object.stream(), error))
+				certified = certification is not None and certification['status'] == bounds.CERTIFIED
+
+				# each upload levels with the model and settings as they are now, later saves only affect later uploads
+				with self.modelLock:
+					job = jobs.snapshot(levelingModel.coeffs, self.zMin, self.zMax, self.lineBreakDist, self.arcSegDist, self.invertPosition, certified, self.minSegmentTime, self.arcFitTolerance, self.maxJobTime, self.maxGrowth, self.indexEvery, levelingModel.tiles)
+				indexPath = storage.indexPath(self.get_plugin_data_folder(), path)
+				return jobs.LevelingJobWrapper(fileName, file_object, job, self.jobPool, self._logger, notify=self.notify_job, storagePath=path, indexPath=indexPath)
 		else:
 			self._logger.info("Points have not been entered (or they are all zero). Enter points or disable this plugin if you do not need it.")
 
 			return file_object
 
+	def notify_job(self, state, **data):
+		data['state'] = state
+		self._plugin_manager.send_plugin_message("gcodeleveling", data)
+
+	def resume_job(self, jobId):
+		from octoprint_gcodeleveling.preprocessor import GcodeLevelingError
+
+		jobDir = self.jobPool.jobDir(jobId)
+		info = jobs.loadJob(jobDir)
+		self._logger.info("Resuming leveling job {} of {}".format(jobId, info['path']))
+
+		leveledPath = os.path.join(jobDir, "output.gcode")
+		try:
+			jobs.runJob(self.jobPool, jobId, info['name'], os.path.join(jobDir, "input.gcode"), leveledPath, info['job'], self._logger, self.notify_job, indexPath=info['indexPath'])
+		except jobs.PoolClosed:
+			return
+		except GcodeLevelingError:
+			self.jobPool.discard(jobId)
+			return
+		except Exception:
+			self._logger.exception("Resuming leveling job {} of {} failed".format(jobId, info['path']))
+			self.jobPool.discard(jobId)
+			return
+
+		self.resumedPaths.add(info['path'])
+		try:
+			leveled = octoprint.filemanager.util.DiskFileWrapper(info['name'], leveledPath)
+			self._file_manager.add_file(FileDestinations.LOCAL, info['path'], leveled, allow_overwrite=True, display=info['name'])
+		finally:
+			self.resumedPaths.discard(info['path'])
+		self.jobPool.discard(jobId)
+
+	def certify_file(self, path, file_object, levelingModel):
+		from octoprint_gcodeleveling import bounds
+
+		# the pre-scan needs a second pass over the file, which only a file on disk can give cheaply
+		if not self.certifyBounds or not isinstance(file_object, octoprint.filemanager.util.DiskFileWrapper):
+			return None
+
+		scanStream = file_object.stream()
+		try:
+			extents = bounds.scanExtents(scanStream)
+		finally:
+			scanStream.close()
+
+		if extents is None:
+			self._logger.info("Bounds of {} could not be certified (position resets or arcs before the first move)".format(path))
+			return None
+
+		certification = bounds.certify(levelingModel.coeffs, extents, self.zMin, self.zMax, self.invertPosition, levelingModel.tiles)
+		self._logger.info("Leveled Z of {} spans {} to {} ({})".format(path, round(certification['low'], 3), round(certification['high'], 3), certification['status']))
+		return certification
+
+	def ensure_model(self):
+		# the model is fit (or loaded from the cache) the first time it is needed instead of at startup
+		with self.modelLock:
+			if self.model is None:
+				started = time.time()
+				# the saved points, which a probing run only replaces once it finished
+				self.model = self.modelCache.get(self._settings.get(['points']), self.modelDegree['x'], self.modelDegree['y'], self.tileCount)
+				self._logger.info("Leveling Model Ready ({} ms)".format(int((time.time() - started) * 1000)))
+				self._logger.debug(self.model.coeffs)
+			return self.model
+
 	# ~~ StartupPlugin mixin
 
 	def on_after_startup(self):
-		self._logger.info("Gcode Leveling Plugin started")
+		self._logger.info("Gcode Leveling Plugin started (loaded in {} ms)".format(int(loadTime * 1000)))
 
 		if (sys.version_info > (3, 5)): # Detect and set python version
 			self.python_version = 3
 		else:
 			self.python_version = 2
 
+		self.modelCache = model.ModelCache(os.path.join(self.get_plugin_data_folder(), "models"))
+		self.flagPath = os.path.join(self.get_plugin_data_folder(), "printing")
+		# left behind if OctoPrint stopped mid print
+		governor.stopPrinting(self.flagPath)
+		# left behind if OctoPrint stopped between a folder being removed and moved
+		storage.removeHeld(self.get_plugin_data_folder())
+		self.jobPool = jobs.JobPool(os.path.join(self.get_plugin_data_folder(), "jobs"), flagPath=self.flagPath)
 		self.update_from_settings()
 
+		# uploads that were still being leveled when OctoPrint stopped pick up from their last checkpoint
+		for jobId in self.jobPool.interrupted():
+			thread = threading.Thread(target=self.resume_job, args=(jobId,))
+			thread.daemon = True
+			thread.start()
+
+		if self.pointsEntered and self._settings.get_boolean(['warmUpModel']):
+			thread = threading.Thread(target=self.ensure_model)
+			thread.daemon = True
+			thread.start()
+
+	##~~ ShutdownPlugin mixin
+
+	def on_shutdown(self):
+		if self.jobPool is not None:
+			self.jobPool.close()
+			governor.stopPrinting(self.flagPath)
+
 	##~~ SettingsPlugin mixin
 
 	def get_settings_defaults(self):
@@ -469,12 +218,26 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 				[0,0,0]
 			],
 			"modelDegree": {"x":2,"y":2},
+			"tiles": {"x":1,"y":1},
 			"zMin": 0.0,
 			"zMax": 100.0,
 			"lineBreakDist": 10.0,
 			"arcSegDist": 15.0,
+			"minSegmentTime": 0.0,
+			"arcFitTolerance": 0.0,
+			"maxJobTime": 0.0,
+			"maxGrowth": 0.0,
+			"indexEvery": 1000,
+			"governLeveling": True,
+			"workerNice": 10,
+			"reservedCores": 1,
+			"printingDuty": 0.5,
+			"measureLatency": False,
 			"invertPosition": False,
 			"unmodifiedCopy": True,
+			"compressUnmodified": False,
+			"certifyBounds": True,
+			"warmUpModel": False,
 			'x': 5,
 			'y': 5,
 			'xMin': 0.0,
@@ -487,11 +250,19 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 			"probePosCmd": "M114",
 			"homeCmd": "G28",
 			"probeFeedrate": 200.0,
+			"probeTimeout": 60.0,
 			'xOffset': 0.0,
 			'yOffset': 0.0,
 			'zOffset': 0.0,
 			'finalZ': 100.0,
-			'sendBedLevelVisualizer': False
+			'sendBedLevelVisualizer': False,
+			"autoDegree": False,
+			"adaptiveProbing": False,
+			"adaptiveTolerance": 0.02,
+			"maxProbePoints": 100,
+			"maxDegree": 4,
+			"profiles": {},
+			"activeProfile": ""
 		}
 
 	def on_settings_save(self, data):
@@ -499,6 +270,14 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 
 		self.update_from_settings()
 
+		# edits to the points of the active profile belong to that profile
+		activeProfile = self._settings.get(['activeProfile'])
+		if activeProfile and self.pointsEntered:
+			profile = self._settings.get(['profiles', activeProfile])
+			if profile is not None and profile.get('model') != self.modelKey:
+				self.store_profile(activeProfile)
+		self.prune_models()
+
 	def update_from_settings(self):
 		# auto-probing settings loading
 		self.probeRegex = re.compile(self._settings.get(['probeRegex']))
@@ -507,6 +286,7 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 
 		self.probeFeedrate = self._settings.get(['probeFeedrate'])
 		self.homeCmd = self._settings.get(['homeCmd'])
+		self.probeTimeout = self._settings.get_float(['probeTimeout'])
 
 		self.clearZ = self._settings.get_float(['clearZ'])
 		self.probeZ = self._settings.get_float(['probeZ'])
@@ -523,6 +303,19 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 
 		self.offset = (self._settings.get_float(['xOffset']), self._settings.get_float(['yOffset']), self._settings.get_float(['zOffset']))
 
+		# print-safe limits for leveling work
+		self.governLeveling = self._settings.get_boolean(['governLeveling'])
+		self.reservedCores = self._settings.get_int(['reservedCores'])
+		self.printingDuty = self._settings.get_float(['printingDuty'])
+		self.measureLatency = self._settings.get_boolean(['measureLatency'])
+		if self.jobPool is not None:
+			self.jobPool.niceness = self._settings.get_int(['workerNice'])
+			self.govern()
+
+		self.adaptiveProbing = self._settings.get_boolean(['adaptiveProbing'])
+		self.adaptiveTolerance = self._settings.get_float(['adaptiveTolerance'])
+		self.maxProbePoints = self._settings.get_int(['maxProbePoints'])
+
 		# normal settings loading
 		points = self._settings.get(['points'])
 
@@ -535,17 +328,29 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 		self.pointsEntered = not allZeros
 
 		if self.pointsEntered:
-			self.zMin = self._settings.get_float(['zMin'])
-			self.zMax = self._settings.get_float(['zMax'])
-			self.lineBreakDist = self._settings.get_float(['lineBreakDist'])
-			self.arcSegDist = self._settings.get_float(['arcSegDist'])
-			self.modelDegree = self._settings.get(['modelDegree'])
-			self.invertPosition = self._settings.get_boolean(['invertPosition'])
-			self.unmodifiedCopy = self._settings.get_boolean(['unmodifiedCopy'])
-
-			self.coeffs = twoDimFit.twoDpolyFit(points, int(self.modelDegree['x']), int(self.modelDegree['y']))
-			self._logger.info("Leveling Model Computed")
-			self._logger.debug(self.coeffs)
+			# the fit itself waits for ensure_model, and only happens when these points and degrees were never fit before
+			with self.modelLock:
+				self.zMin = self._settings.get_float(['zMin'])
+				self.zMax = self._settings.get_float(['zMax'])
+				self.lineBreakDist = self._settings.get_float(['lineBreakDist'])
+				self.arcSegDist = self._settings.get_float(['arcSegDist'])
+				self.minSegmentTime = self._settings.get_float(['minSegmentTime'])
+				self.arcFitTolerance = self._settings.get_float(['arcFitTolerance'])
+				self.maxJobTime = self._settings.get_float(['maxJobTime'])
+				self.maxGrowth = self._settings.get_float(['maxGrowth'])
+				self.indexEvery = self._settings.get_int(['indexEvery'])
+				self.modelDegree = self._settings.get(['modelDegree'])
+				tiles = self._settings.get(['tiles'])
+				self.tileCount = (max(1, int(tiles['x'])), max(1, int(tiles['y'])))
+				self.invertPosition = self._settings.get_boolean(['invertPosition'])
+				self.unmodifiedCopy = self._settings.get_boolean(['unmodifiedCopy'])
+				self.compressUnmodified = self._settings.get_boolean(['compressUnmodified'])
+				self.certifyBounds = self._settings.get_boolean(['certifyBounds'])
+
+				self.points = points
+				self.modelKey = model.modelKey(points, self.modelDegree['x'], self.modelDegree['y'], self.tileCount)
+				if self.model is not None and self.model.key != self.modelKey:
+					self.model = None
 		else:
 			self._logger.info("Points have not been entered (or they are all zero). Enter points or disable this plugin if you do not need it.")
 
@@ -592,12 +397,67 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 	def get_api_commands(self):
 		return dict(
 			probe=['x', 'y', 'xMin', 'yMin', 'xMax', 'yMax', 'clearZ', 'probeZ', 'probeRegex', 'probePosCmd', 'homeCmd', 'probeFeedrate', 'xOffset', 'yOffset', 'zOffset', 'finalZ', 'sendBedLevelVisualizer'],
-			test=[]
+			test=[],
+			restoreOriginal=['path'],
+			relevel=['path'],
+			analyze=['path'],
+			selectDegree=[],
+			cancel=['id'],
+			index=['path'],
+			abortProbe=[],
+			saveProfile=['name'],
+			selectProfile=['name'],
+			deleteProfile=['name']
 		)
 
+	def on_api_get(self, request):
+		import flask
+
+		return flask.jsonify(jobs=self.jobPool.status(), printing=self.printing, latency=self.sendLatency.report(), analyses=self.analyses)
+
 	def on_api_command(self, command, data):
 		if command == "test":
 			self._logger.info("test called")
+		elif command == "restoreOriginal":
+			if Permissions.FILES_UPLOAD.can():
+				return self.restore_original(data['path'])
+			else:
+				self._logger.info("cannot restore original since permission is missing")
+		elif command == "relevel":
+			if Permissions.FILES_UPLOAD.can():
+				return self.relevel(data['path'])
+			else:
+				self._logger.info("cannot relevel since permission is missing")
+		elif command == "analyze":
+			if Permissions.FILES_DOWNLOAD.can():
+				return self.analyze(data['path'], int(data.get('sample', 1)))
+			else:
+				self._logger.info("cannot analyze since permission is missing")
+		elif command == "index":
+			if Permissions.FILES_DOWNLOAD.can():
+				return self.seek_index(data['path'], data)
+			else:
+				self._logger.info("cannot read the seek index since permission is missing")
+		elif command == "cancel":
+			if Permissions.FILES_UPLOAD.can():
+				return self.cancel_job(data['id'])
+			else:
+				self._logger.info("cannot cancel leveling since permission is missing")
+		elif command == "selectDegree":
+			if Permissions.SETTINGS.can():
+				return self.select_degree(data.get('points'), int(data.get('maxDegree', self._settings.get_int(['maxDegree']))), int(data.get('folds', 0)))
+			else:
+				self._logger.info("cannot select a model degree since permission is missing")
+		elif command in ("saveProfile", "selectProfile", "deleteProfile"):
+			if Permissions.SETTINGS.can():
+				if command == "saveProfile":
+					return self.save_profile(data['name'])
+				elif command == "selectProfile":
+					return self.select_profile(data['name'])
+				else:
+					return self.delete_profile(data['name'])
+			else:
+				self._logger.info("cannot change mesh profiles since permission is missing")
 		elif command == "probe":
 			if Permissions.CONTROL.can() and self._printer.is_ready():
 				self.probeRegex = re.compile(data['probeRegex'])
@@ -606,6 +466,7 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 
 				self.probeFeedrate = data['probeFeedrate']
 				self.homeCmd = data['homeCmd']
+				self.probeTimeout = float(data.get('probeTimeout', self.probeTimeout))
 
 				self.clearZ = float(data['clearZ'])
 				self.probeZ = float(data['probeZ'])
@@ -622,49 +483,419 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 
 				self.offset = (float(data['xOffset']), float(data['yOffset']), float(data['zOffset']))
 
+				self.adaptiveProbing = bool(data.get('adaptive', self.adaptiveProbing))
+				self.adaptiveTolerance = float(data.get('adaptiveTolerance', self.adaptiveTolerance))
+				self.maxProbePoints = int(data.get('maxProbePoints', self.maxProbePoints))
+
 				thread = threading.Thread(target=self.auto_probe)
 				thread.daemon = True
 				thread.start()
 			else:
 				self._logger.info("cannot probe since permission is missing or printer is printing")
+		elif command == "abortProbe":
+			if Permissions.CONTROL.can():
+				return self.abort_probe()
+			else:
+				self._logger.info("cannot abort probing since permission is missing")
 
-	def auto_probe(self):
-		self._logger.info("Probing Matrix")
-		# self._printer.home(("x", "y"))
-		self._printer.commands("G0 F{}".format(self.probeFeedrate))
-		self._printer.commands(self.homeCmd)
-
-
-		self.points = []
+	# where the plugin stores something for an uploaded file (storage.originalPath or storage.indexPath), None for any other API path
+	def stored_file(self, locate, path):
+		if not self._file_manager.file_exists(FileDestinations.LOCAL, path):
+			return None
+		try:
+			return locate(self.get_plugin_data_folder(), path)
+		except ValueError:
+			return None
 
-		self.checkForProbe = 0
-		self.probePoints = self.xCount*self.yCount
+	def restore_original(self, path):
+		import flask
+
+		compressedPath = self.stored_file(storage.originalPath, path)
+		if compressedPath is None or not os.path.isfile(compressedPath):
+			return flask.make_response("No compressed original stored for {}".format(path), 404)
+
+		gclShortPath = re.sub(".gcode", "_NO-GCL.gcode", path)
+		gclFileName = gclShortPath.split("/")[-1]
+
+		# Decompression is streamed straight into storage, the preprocessor hook skips _NO-GCL files
+		original = octoprint.filemanager.util.StreamWrapper(gclFileName, storage.openCompressed(compressedPath))
+		added = self._file_manager.add_file(FileDestinations.LOCAL, gclShortPath, original, allow_overwrite=True, display=gclFileName)
+
+		return flask.jsonify(path=added)
+
+	def relevel(self, path):
+		import flask
+
+		compressedPath = self.stored_file(storage.originalPath, path)
+		if compressedPath is None or not os.path.isfile(compressedPath):
+			return flask.make_response("No compressed original stored for {}".format(path), 404)
+
+		fileName = path.split("/")[-1]
+
+		# Run the stored original back through the preprocessor hook with the current model
+		self.relevelPaths.add(path)
+		try:
+			original = octoprint.filemanager.util.StreamWrapper(fileName, storage.openCompressed(compressedPath))
+			added = self._file_manager.add_file(FileDestinations.LOCAL, path, original, allow_overwrite=True, display=fileName)
+		finally:
+			self.relevelPaths.discard(path)
+
+		return flask.jsonify(path=added)
+
+	def analyze(self, path, sampleEvery):
+		import flask
+
+		if not self.pointsEntered:
+			return flask.make_response("Points have not been entered, there is no model to analyze with", 409)
+		if not self._file_manager.file_exists(FileDestinations.LOCAL, path):
+			return flask.make_response("File not found: {}".format(path), 404)
+		if self.analyses.get(path, {}).get('state') == "running":
+			return flask.make_response("{} is already being analyzed".format(path), 409)
+		if self.original_file(path) is None:
+			return flask.make_response("No unleveled original stored for {}".format(path), 409)
+
+		# a large file takes minutes, the result is sent as a plugin message and kept for GET
+		self.analyses[path] = dict(state="running")
+		thread = threading.Thread(target=self.run_analysis, args=(path, sampleEvery))
+		thread.daemon = True
+		thread.start()
+		return flask.make_response(flask.jsonify(path=path, state="running"), 202)
+
+	# the stored upload is already leveled, a dry run reads the original it was leveled from: (path on disk, compressed) or None
+	def original_file(self, path):
+		if path.endswith("_NO-GCL.gcode"):
+			return (self._file_manager.path_on_disk(FileDestinations.LOCAL, path), False)
+
+		compressedPath = self.stored_file(storage.originalPath, path)
+		if compressedPath is not None and os.path.isfile(compressedPath):
+			return (compressedPath, True)
+
+		gclShortPath = re.sub(".gcode", "_NO-GCL.gcode", path)
+		if gclShortPath != path and self._file_manager.file_exists(FileDestinations.LOCAL, gclShortPath):
+			return (self._file_manager.path_on_disk(FileDestinations.LOCAL, gclShortPath), False)
+		return None
+
+	def run_analysis(self, path, sampleEvery):
+		import uuid
+
+		# runs in a leveling worker, at its priority and under the same throttle while printing
+		jobId = uuid.uuid4().hex
+		try:
+			levelingModel = self.ensure_model()
+			original = self.original_file(path)
+			if original is None:
+				raise ValueError("No unleveled original stored for {}".format(path))
+			self._logger.info("Dry run analysis of {} started (leveling every {} input chunks)".format(path, sampleEvery))
+
+			with self.modelLock:
+				job = jobs.snapshot(levelingModel.coeffs, self.zMin, self.zMax, self.lineBreakDist, self.arcSegDist, self.invertPosition, False, self.minSegmentTime, 0.0, tiles=levelingModel.tiles)
+			stats = self.jobPool.analyze(jobId, path, original[0], original[1], job, sampleEvery)
+			if "error" in stats:
+				raise ValueError(stats['message'])
+		except Exception as error:
+			self._logger.exception("Dry run analysis of {} failed".format(path))
+			self.analyses[path] = dict(state="failed", error=str(error))
+			self._plugin_manager.send_plugin_message("gcodeleveling", dict(state='analysisFailed', path=path, error=str(error)))
+			return
+		finally:
+			self.jobPool.discard(jobId)
+
+		stats['path'] = path
+		self._logger.info("Dry run analysis of {} finished in {}s".format(path, stats['phases']['total']))
+		self.analyses[path] = dict(state="done", stats=stats)
+		self._plugin_manager.send_plugin_message("gcodeleveling", dict(state='analyzed', path=path, stats=stats))
+
+	def seek_index(self, path, query):
+		import flask
+		from octoprint_gcodeleveling import index
+
+		indexPath = self.stored_file(storage.indexPath, path)
+		if indexPath is None or not os.path.isfile(indexPath):
+			return flask.make_response("No seek index stored for {}".format(path), 404)
+
+		# loaded once per leveling, a re-leveled file rewrites its index
+		stat = os.stat(indexPath)
+		cached = self.seekIndexes.get(path)
+		if cached is None or cached[0] != (stat.st_mtime, stat.st_size):
+			cached = ((stat.st_mtime, stat.st_size), index.load(indexPath))
+			self.seekIndexes[path] = cached
+		seekIndex = cached[1]
+
+		# a file replaced without leveling (e.g. with no points entered) leaves its old index behind
+		if seekIndex['bytes'] != os.path.getsize(self._file_manager.path_on_disk(FileDestinations.LOCAL, path)):
+			return flask.make_response("The seek index of {} is out of date".format(path), 409)
+
+		keys = [key for key in ("line", "offset", "layer", "z") if key in query]
+		if not len(keys):
+			return flask.jsonify(path=path, every=seekIndex['every'], lines=seekIndex['lines'], bytes=seekIndex['bytes'], entries=len(seekIndex['columns']['line']))
+
+		value = float(query[keys[0]]) if keys[0] == "z" else int(query[keys[0]])
+		return flask.jsonify(path=path, entry=index.lookup(seekIndex, keys[0], value))
+
+	def cancel_job(self, jobId):
+		import flask
+
+		if not self.jobPool.cancel(jobId):
+			return flask.make_response("No running leveling job {}".format(jobId), 404)
+
+		self._logger.info("Cancelling leveling job {}".format(jobId))
+		return flask.jsonify(id=jobId, cancelled=True)
+
+	def abort_probe(self):
+		import flask
+
+		if not self.probeSession.abort("Cancelled"):
+			return flask.make_response("Not probing", 409)
+
+		self._logger.info("Aborting auto probing")
+		return flask.jsonify(state=self.probeSession.state)
+
+	def select_degree(self, points, maxDegree, folds):
+		import flask
+		from octoprint_gcodeleveling import twoDimFit
+
+		if points is None:
+			points = self._settings.get(['points'])
+		points = [[float(coor) for coor in point] for point in points]
+
+		started = time.time()
+		selection = twoDimFit.selectDegree(points, maxDegree, folds)
+		if selection is None:
+			return flask.make_response("Not enough points to compare any model degree", 409)
+
+		self._logger.info("Cross validation picked degree ({}, {}) with {} mm rms error ({} ms)".format(selection['x'], selection['y'], round(selection['rmse'], 4), int((time.time() - started) * 1000)))
+		return flask.jsonify(selection)
+
+	##~~ Mesh profiles
+
+	def store_profile(self, name):
+		self._settings.set(['profiles', name], dict(points=self._settings.get(['points']), modelDegree=self._settings.get(['modelDegree']), tiles=self._settings.get(['tiles']), model=self.modelKey))
+		self._settings.save()
+
+	def prune_models(self):
+		keep = set(profile.get('model') for profile in self._settings.get(['profiles']).values())
+		if self.pointsEntered:
+			keep.add(self.modelKey)
+		self.modelCache.prune(keep)
+
+	def save_profile(self, name):
+		import flask
+
+		if not self.pointsEntered:
+			return flask.make_response("Points have not been entered, there is no mesh to save", 409)
+
+		self._settings.set(['activeProfile'], name)
+		self.store_profile(name)
+		self._logger.info("Saved mesh profile {}".format(name))
+		return flask.jsonify(profile=name, model=self.modelKey)
+
+	def select_profile(self, name):
+		import flask
+
+		profile = self._settings.get(['profiles', name])
+		if profile is None:
+			return flask.make_response("Unknown mesh profile {}".format(name), 404)
+
+		self._settings.set(['points'], profile['points'])
+		self._settings.set(['modelDegree'], profile['modelDegree'])
+		# profiles saved before tiles existed are untiled
+		self._settings.set(['tiles'], profile.get('tiles', dict(x=1, y=1)))
+		self._settings.set(['activeProfile'], name)
+		self._settings.save()
+
+		# switching to a known profile is a cache lookup, not a fit
+		cached = self.modelCache.load(profile['model'])
+		if cached is not None and self.pointsEntered:
+			with self.modelLock:
+				self.model = cached
+				self.points = profile['points']
+				self.modelDegree = profile['modelDegree']
+				tiles = profile.get('tiles', dict(x=1, y=1))
+				self.tileCount = (max(1, int(tiles['x'])), max(1, int(tiles['y'])))
+				self.modelKey = cached.key
+		else:
+			self.update_from_settings()
+
+		self._logger.info("Switched to mesh profile {}".format(name))
+		return flask.jsonify(profile=name, model=self.modelKey)
+
+	def delete_profile(self, name):
+		import flask
+
+		if self._settings.get(['profiles', name]) is None:
+			return flask.make_response("Unknown mesh profile {}".format(name), 404)
+
+		self._settings.remove(['profiles', name])
+		if self._settings.get(['activeProfile']) == name:
+			self._settings.set(['activeProfile'], "")
+		self._settings.save()
+		self.prune_models()
+
+		return flask.jsonify(profile=name)
+
+	##~~ EventHandlerPlugin mixin
+
+	def on_event(self, event, payload):
+		if event in (Events.PRINT_STARTED, Events.PRINT_RESUMED):
+			self.govern(True)
+		elif event in (Events.PRINT_PAUSED, Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
+			self.govern(False)
+
+		if payload is not None and payload.get('storage') == FileDestinations.LOCAL:
+			self.follow_files(event, payload)
+			for key in ("path", "source_path"):
+				self.seekIndexes.pop(payload.get(key), None)
+
+	# the stored original and seek index of a file go where the file goes
+	def follow_files(self, event, payload):
+		dataFolder = self.get_plugin_data_folder()
+		# a moved file is also reported as removed
+		if event == Events.FILE_REMOVED and payload.get('operation') != "move":
+			storage.removeStored(storage.storedFiles(dataFolder, payload['path']))
+		elif event == Events.FILE_MOVED:
+			storage.moveStored(storage.storedFiles(dataFolder, payload['source_path']), storage.storedFiles(dataFolder, payload['destination_path']))
+		elif event == Events.FOLDER_REMOVED:
+			# a moved folder is removed right before it is moved, anything still held from before was really removed
+			storage.removeHeld(dataFolder)
+			storage.moveStored(storage.storedFolders(dataFolder, payload['path']), storage.storedFolders(dataFolder, payload['path'], held=True))
+		elif event == Events.FOLDER_MOVED:
+			storage.moveStored(storage.storedFolders(dataFolder, payload['source_path'], held=True), storage.storedFolders(dataFolder, payload['destination_path']))
+
+	# leveling workers and dry runs read the flag between batches, so a print that starts mid job slows it down right away
+	def govern(self, printing=None):
+		if printing is None:
+			printing = self._printer.is_printing()
+
+		measuring = printing and self.measureLatency
+		if measuring and not self.measuringLatency:
+			self.sendLatency.reset()
+		elif not measuring and self.measuringLatency:
+			latency = self.sendLatency.report()
+			for name in ("idle", "leveling"):
+				if latency[name]['count']:
+					self._logger.info("Send loop latency {} leveling: p99 {} ms, max {} ms over {} lines".format("without" if name == "idle" else "while", latency[name]['p99'], latency[name]['max'], latency[name]['count']))
+		self.printing = printing
+		self.measuringLatency = measuring
+
+		if printing and self.governLeveling:
+			governor.startPrinting(self.flagPath, self.printingDuty, governor.printingCpus(self.reservedCores))
+		else:
+			governor.stopPrinting(self.flagPath)
 
-		self._plugin_manager.send_plugin_message("gcodeleveling", dict(state='startProbing', totalPoints=self.probePoints))
+	def leveling(self):
+		return len(self.jobPool.jobs) > 0
 
-		xDiff = self.xMax-self.xMin
-		yDiff = self.yMax-self.yMin
+	def auto_probe(self):
+		from octoprint_gcodeleveling import twoDimFit
 
-		forward = True
-		for xProbe in range(self.xCount):
-			x = self.xMin + xProbe * xDiff / (self.xCount-1)
+		# the API and the @ command can both start a run
+		if self.probeSession.state == probing.PROBING:
+			self._logger.info("cannot probe since probing is already running")
+			return
 
-			for yProbe in range(self.yCount):
-				if forward:
-					y = self.yMin + yProbe * yDiff / (self.yCount-1)
-				else:
-					y = self.yMax - yProbe * yDiff / (self.yCount-1)
-				self._printer.commands("G0 X{} Y{} Z{}".format(round(x, 3), round(y, 3), self.clearZ))
-				self._printer.commands("G38.2 Z{}".format(self.probeZ))
-				if self.probePosCmd != "":
-					self._printer.commands(self.probePosCmd)
-				self._printer.commands("G0 X{} Y{} Z{}".format(round(x, 3), round(y, 3), self.clearZ))
+		self._logger.info("Probing Matrix")
+		# self._printer.home(("x", "y"))
+		self._printer.commands("G0 F{}".format(self.probeFeedrate))
+		self._printer.commands(self.homeCmd)
 
-				self.checkForProbe += 1
 
-			forward = not forward
+		# kept apart from the saved points until the run finishes, so an aborted run leaves the model alone
+		probed = []
+		# fit as the points come in, so the model is ready when probing finishes
+		degree = self._settings.get(['modelDegree'])
+		probeFit = twoDimFit.IncrementalFit(int(degree['x']), int(degree['y']))
 
-		self._printer.commands("G0 X0 Y0 Z{}".format(self.finalZ))
+		plan = None
+		if self.adaptiveProbing:
+			plan = probing.AdaptivePlan(self.xMin, self.xMax, self.yMin, self.yMax, self.xCount, self.yCount, self.adaptiveTolerance, self.maxProbePoints, offset=self.offset[:2], xDeg=probeFit.xDeg, yDeg=probeFit.yDeg)
+			pending = plan.coarse
+		else:
+			pending = probing.gridPoints(self.xMin, self.xMax, self.yMin, self.yMax, self.xCount, self.yCount)
+
+		self.probePoints = len(pending)
+		self.probeSession.start(self.probeRegex, self.probeTimeout)
+
+		try:
+			self._plugin_manager.send_plugin_message("gcodeleveling", dict(state='startProbing', totalPoints=self.probePoints))
+
+			# one point at a time, so a missing result or an abort stops the printer after the point it is on
+			previous = (0.0, 0.0)
+			while len(pending):
+				for x, y in pending:
+					self.probeSession.expect(self.probe_travel(previous, (x, y)))
+					self.queue_probe(x, y)
+					previous = (x, y)
+					result = self.probeSession.wait()
+					if result is None:
+						self._logger.info("Auto probing aborted after {} points: {}".format(len(probed), self.probeSession.error))
+						self._plugin_manager.send_plugin_message("gcodeleveling", dict(state='abortedProbing', currentPoint=len(probed), totalPoints=self.probePoints, reason=self.probeSession.error))
+						return
+
+					self._logger.debug("{} ({}, {}, {})".format(len(probed), *result))
+					probed.append((result[0]+self.offset[0], result[1]+self.offset[1], result[2]+self.offset[2]))
+
+					probeFit.add(probed[-1])
+					probeCoeffs = probeFit.coeffs()
+					residuals = probeFit.residuals(probeCoeffs)
+					worst = max(range(len(residuals)), key=lambda ind: abs(residuals[ind]))
+					fit = dict(coeffs=probeCoeffs.tolist(), residuals=[round(residual, 4) for residual in residuals], worstPoint=worst+1,
+						maxResidual=round(abs(residuals[worst]), 4), rms=round(math.sqrt(sum(residual**2 for residual in residuals) / len(residuals)), 4))
+
+					self._plugin_manager.send_plugin_message("gcodeleveling", dict(state='updateProbing', currentPoint=len(probed), totalPoints=self.probePoints, fit=fit))
+
+				pending = []
+				if plan is not None:
+					pending = plan.refine(probeFit, probeCoeffs, (x, y))
+					if len(pending):
+						self._logger.info("Adaptive probing round {} adds {} points".format(plan.rounds, len(pending)))
+						self.probePoints += len(pending)
+
+			if plan is not None and len(plan.outliers):
+				self._logger.info("Adaptive probing stopped refining since more points no longer improved the fit, {} points are still more than {} mm off it: {}".format(len(plan.outliers), self.adaptiveTolerance, plan.outliers))
+
+			self._printer.commands("G0 X0 Y0 Z{}".format(self.finalZ))
+		except Exception as error:
+			self._logger.exception("Auto probing failed after {} points".format(len(probed)))
+			self._plugin_manager.send_plugin_message("gcodeleveling", dict(state='abortedProbing', currentPoint=len(probed), totalPoints=self.probePoints, reason=str(error)))
+			return
+		finally:
+			# whatever ends the run, the session can't be left probing or no later run could start
+			self.probeSession.finish()
+
+		self.finish_probing(probed, probeFit, probeCoeffs, fit)
+
+	# seconds from queuing a point to its report at the probe feedrate: up from the last point, over to this one and down as far as probeZ
+	def probe_travel(self, previous, point):
+		distance = math.hypot(point[0] - previous[0], point[1] - previous[1]) + 2*abs(self.clearZ - self.probeZ)
+		return distance / (float(self.probeFeedrate) / 60.0)
+
+	def queue_probe(self, x, y):
+		self._printer.commands("G0 X{} Y{} Z{}".format(x, y, self.clearZ))
+		self._printer.commands("G38.2 Z{}".format(self.probeZ))
+		if self.probePosCmd != "":
+			self._printer.commands(self.probePosCmd)
+		self._printer.commands("G0 X{} Y{} Z{}".format(x, y, self.clearZ))
+
+	def finish_probing(self, probed, probeFit, probeCoeffs, fit):
+		self._logger.debug(probed)
+		self._logger.info("Saving auto-probed points (rms residual {} mm, largest {} mm at point {})".format(fit['rms'], fit['maxResidual'], fit['worstPoint']))
+		self._settings.set(['points'], probed)
+		# the last fit is exactly the model of these points, cached so it never has to be fit again (tiled models are fit per tile)
+		if self._settings.get_int(['tiles', 'x']) == 1 and self._settings.get_int(['tiles', 'y']) == 1:
+			self.modelCache.store(model.LevelingModel(model.modelKey(probed, probeFit.xDeg, probeFit.yDeg), probeCoeffs))
+		if self._settings.get_boolean(['autoDegree']):
+			from octoprint_gcodeleveling import twoDimFit
+
+			selection = twoDimFit.selectDegree(probed, self._settings.get_int(['maxDegree']))
+			if selection is not None:
+				self._logger.info("Using cross validated degree ({}, {}) with {} mm rms error".format(selection['x'], selection['y'], round(selection['rmse'], 4)))
+				self._settings.set(['modelDegree'], dict(x=selection['x'], y=selection['y']))
+		self.update_from_settings()
+		self._plugin_manager.send_plugin_message("gcodeleveling", dict(state='finishedProbing'))
+		if self.sendBedLevelVisualizer:
+			thread = threading.Thread(target=self.send_BLV)
+			thread.daemon = True
+			thread.start()
 
 	def send_BLV(self):
 		mesh = []
@@ -672,7 +903,16 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 		forward = True
 		first = True
 		count = 0
-		for point in self.points:
+		points = self.points
+		if len(points) != self.xCount*self.yCount:
+			from octoprint_gcodeleveling import evaluators
+
+			# adaptive probing does not probe the grid itself, so the mesh is the fitted surface at the grid points
+			levelingModel = self.ensure_model()
+			surface = evaluators.forModel(levelingModel.coeffs, levelingModel.tiles)
+			points = [(x + self.offset[0], y + self.offset[1], surface.value(x + self.offset[0], y + self.offset[1])) for x, y in probing.gridPoints(self.xMin, self.xMax, self.yMin, self.yMax, self.xCount, self.yCount)]
+
+		for point in points:
 			if first:
 				if count < self.yCount:
 					mesh.append([point[2]])
@@ -707,25 +947,19 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 
 	##~~ Received Gcode Hook
 	def parseReceived(self, comm_instance, line):
-		if self.checkForProbe > 0:
-			mat = self.probeRegex.match(line)
-			if mat:
-				self.checkForProbe -= 1
-				self._logger.debug("{} ({}, {}, {})".format(self.checkForProbe, mat.group('x'), mat.group('y'), mat.group('z')))
-				self.points.append((float(mat.group('x'))+self.offset[0], float(mat.group('y'))+self.offset[1], float(mat.group('z'))+self.offset[2]))
-				self._plugin_manager.send_plugin_message("gcodeleveling", dict(state='updateProbing', currentPoint=self.probePoints-self.checkForProbe, totalPoints=self.probePoints))
-				if self.checkForProbe == 0:
-					self._logger.debug(self.points)
-					self._logger.info("Saving auto-probed points")
-					self._settings.set(['points'], self.points)
-					self.update_from_settings()
-					self._plugin_manager.send_plugin_message("gcodeleveling", dict(state='finishedProbing'))
-					if self.sendBedLevelVisualizer:
-						thread = threading.Thread(target=self.send_BLV)
-						thread.daemon = True
-						thread.start()
+		# runs for every line the printer sends, outside a print or a probing run these checks are all it costs
+		if self.measuringLatency and line[:2] == "ok":
+			self.sendLatency.received()
+		if self.probeSession.state != probing.PROBING:
+			return line
+		self.probeSession.feed(line)
 		return line
 
+	##~~ Sent Gcode Hook
+	def gcodeSent(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+		if self.measuringLatency:
+			self.sendLatency.sent(self.leveling())
+
 
 	##~~ @ Command Gcode Hook
 	def custom_atcommand_handler(self, comm, phase, command, parameters, tags=None):
@@ -739,6 +973,8 @@ class GcodeLevelingPlugin(octoprint.plugin.StartupPlugin,
 			self._logger.info("cannot probe since permission is missing or printer is printing")
 		return
 
+loadTime = time.time() - _loadStarted
+
 __plugin_name__ = "Gcode Leveling"
 
 __plugin_pythoncompat__ = ">=2.7,<4" # python 2 and 3
@@ -752,5 +988,6 @@ def __plugin_load__():
 		"octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
 		"octoprint.filemanager.preprocessor": __plugin_implementation__.createFilePreProcessor,
 		"octoprint.comm.protocol.gcode.received": __plugin_implementation__.parseReceived,
+		"octoprint.comm.protocol.gcode.sent": __plugin_implementation__.gcodeSent,
 		"octoprint.comm.protocol.atcommand.queuing": __plugin_implementation__.custom_atcommand_handler
 	}
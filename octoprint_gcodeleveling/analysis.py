@@ -0,0 +1,172 @@
+import logging, re, sys, time
+
+from octoprint_gcodeleveling.preprocessor import GcodePreProcessor
+
+_logger = logging.getLogger("octoprint.plugins.gcodeleveling.analysis")
+
+# Runs a file through the preprocessor logic, keeping statistics instead of output
+# With sampling only every Nth chunk of the input is leveled, the chunks in between are skipped with a few regex passes
+# that carry the Z and the modes past them, and the totals are extrapolated from the chunks that were leveled
+class GcodeAnalyzer(GcodePreProcessor):
+	def __init__(self, fileBufferedReader, python_version, logger, coeffs, zMin, zMax, lineBreakDist, arcSegDist, invertPosition, sampleEvery=1, minSegmentTime=0.0, tiles=None):
+		super(GcodeAnalyzer, self).__init__(fileBufferedReader, python_version, logger, coeffs, zMin, zMax, lineBreakDist, arcSegDist, invertPosition, minSegmentTime=minSegmentTime, tiles=tiles)
+		self.sampleEvery = max(1, int(sampleEvery))
+
+		self.raw_move_pattern = re.compile(br"^\s*G[0-3]\s")
+		self.skipped_move_pattern = re.compile(br"^[ \t]*G[0-3][ \t]", re.M)
+		self.skipped_z_pattern = re.compile(br"^[ \t]*G[0-3][ \t][^;\n]*Z(-?[0-9.]+)", re.M)
+		self.skipped_mode_pattern = re.compile(br"^[ \t]*(G9[01]|M8[23])", re.M)
+
+		self.linesSeen = 0
+		self.movesSeen = 0
+		self.movesSampled = 0
+		self.movesSplit = 0
+		self.segments = 0
+
+		self.inBytes = 0
+		self.sampledInBytes = 0
+		self.outBytes = 0
+		self.outLines = 0
+
+		self.zLow = None
+		self.zHigh = None
+		self.outOfBounds = None
+
+		self.phases = dict(passthrough=0.0, subdivision=0.0, skipped=0.0)
+
+	def get_z(self, x, y, zOffset):
+		zNew = self.model.value(x, y) + (zOffset * (-1 if self.invertPosition else 1))
+
+		if self.zLow is None or zNew < self.zLow:
+			self.zLow = zNew
+		if self.zHigh is None or zNew > self.zHigh:
+			self.zHigh = zNew
+
+		if self.outOfBounds is None and (zNew < self.zMin or zNew > self.zMax):
+			self.outOfBounds = dict(x=float(x), y=float(y), z=float(zNew), line=self.linesSeen)
+		return round(zNew, 3)
+
+	def createLine(self, prev, pos, zVal, eVal):
+		self.segments += 1
+		return super(GcodeAnalyzer, self).createLine(prev, pos, zVal, eVal)
+
+	def createArc(self, start, center, angle, eVal, zVal):
+		self.segments += 1
+		return super(GcodeAnalyzer, self).createArc(start, center, angle, eVal, zVal)
+
+	def process_line(self, origLine):
+		self.linesSeen += 1
+		started = time.time()
+
+		if self.raw_move_pattern.match(origLine) is None:
+			out = super(GcodeAnalyzer, self).process_line(origLine)
+			self.phases['passthrough'] += time.time() - started
+			return out
+
+		self.movesSeen += 1
+		self.movesSampled += 1
+		self.segments = 0
+		out = super(GcodeAnalyzer, self).process_line(origLine)
+		if self.segments > 1:
+			self.movesSplit += 1
+		self.phases['subdivision'] += time.time() - started
+		return out
+
+	# only what the leveled chunks after it need: the last Z and modes, the first move after it only sets the position
+	def skip(self, chunk):
+		started = time.time()
+		self.linesSeen += chunk.count(b"\n")
+		self.movesSeen += len(self.skipped_move_pattern.findall(chunk))
+
+		heights = self.skipped_z_pattern.findall(chunk)
+		if len(heights):
+			self.zCurr = float(heights[-1])
+		for mode in self.skipped_mode_pattern.findall(chunk):
+			if mode == b"G90":
+				self.moveMode = "Absolute"
+			elif mode == b"G91":
+				self.moveMode = "Relative"
+			elif mode == b"M82":
+				self.eMode = "Absolute"
+			else:
+				self.eMode = "Relative"
+		self.afterStart = False
+		self.phases['skipped'] += time.time() - started
+
+	def run(self, chunkSize=1 << 16, throttle=None):
+		started = time.time()
+		chunkNumber = 0
+		try:
+			while True:
+				# whole lines only, a chunk ends at the end of the line it stops in
+				chunk = self.input_stream.read(chunkSize)
+				if not len(chunk):
+					break
+				if not chunk.endswith(b"\n"):
+					chunk += self.input_stream.readline()
+				self.inBytes += len(chunk)
+
+				if chunkNumber % self.sampleEvery == 0:
+					self.sampledInBytes += len(chunk)
+					for line in chunk.splitlines(True):
+						out = self.process_line(line)
+						if out is not None:
+							self.outBytes += len(out)
+							self.outLines += out.count(b"\n")
+				else:
+					self.skip(chunk)
+				chunkNumber += 1
+
+				if throttle is not None:
+					throttle.pace()
+		finally:
+			if throttle is not None:
+				throttle.release()
+		total = time.time() - started - (throttle.slept if throttle is not None else 0.0)
+
+		byteScale = float(self.inBytes) / self.sampledInBytes if self.sampledInBytes else 0.0
+		moveScale = float(self.movesSeen) / self.movesSampled if self.movesSampled else 0.0
+
+		phases = dict((name, round(duration, 3)) for name, duration in self.phases.items())
+		phases['io'] = round(max(0.0, total - sum(self.phases.values())), 3)
+		phases['total'] = round(total, 3)
+		if throttle is not None:
+			phases['throttled'] = round(throttle.slept, 3)
+
+		return dict(
+			lines=self.linesSeen,
+			movesSeen=self.movesSeen,
+			movesSampled=self.movesSampled,
+			movesSplit=self.movesSplit,
+			movesSplitEstimate=int(round(self.movesSplit * moveScale)),
+			outputLinesEstimate=int(round(self.outLines * byteScale)),
+			outputBytesEstimate=int(round(self.outBytes * byteScale)),
+			zMin=None if self.zLow is None else round(self.zLow, 3),
+			zMax=None if self.zHigh is None else round(self.zHigh, 3),
+			outOfBounds=self.outOfBounds,
+			limitedMovesEstimate=int(round(self.limitedMoves * moveScale)),
+			limitDeviation=round(self.limitDeviation, 4),
+			sampleEvery=self.sampleEvery,
+			phases=phases
+		)
+
+# Runs in a leveling worker, the model and limits come in a jobs.LevelingJob snapshot like a leveling job's
+def analyzePath(inPath, compressed, job, sampleEvery, flagPath=None):
+	from octoprint_gcodeleveling import bounds, governor, storage
+
+	python_version = 3 if sys.version_info > (3, 5) else 2
+	openInput = lambda: storage.openCompressed(inPath) if compressed else open(inPath, "rb")
+
+	analyzer = GcodeAnalyzer(openInput(), python_version, _logger, job.coeffs, job.zMin, job.zMax, job.lineBreakDist, job.arcSegDist, job.invertPosition, sampleEvery=sampleEvery, minSegmentTime=job.minSegmentTime, tiles=job.tiles)
+	try:
+		stats = analyzer.run(throttle=governor.Throttle(flagPath) if flagPath is not None else None)
+	finally:
+		analyzer.close()
+
+	with openInput() as scanStream:
+		extents = bounds.scanExtents(scanStream)
+	if extents is not None:
+		stats['certification'] = bounds.certify(job.coeffs, extents, job.zMin, job.zMax, job.invertPosition, job.tiles)
+	else:
+		stats['certification'] = dict(status=bounds.UNKNOWN)
+	return stats
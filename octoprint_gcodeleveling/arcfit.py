@@ -0,0 +1,247 @@
+import math
+
+from octoprint_gcodeleveling import geometry
+
+# Welds runs of leveled G1 segments back into helical G2/G3 arcs
+# A run is only welded when every vertex, every chord's sag and the Z at every vertex stay within the tolerance of the arc,
+# so the printed path stays as close to the leveling model as the segments were
+class ArcWelder():
+	def __init__(self, tolerance, maxRadius=1000.0, rateVariance=0.05, minSegments=3):
+		self.tolerance = tolerance
+		self.maxRadius = maxRadius
+		self.rateVariance = rateVariance
+		self.minSegments = minSegments
+
+		# position after the last line fed in (pending lines included)
+		self.x = 0.0
+		self.y = 0.0
+		self.z = 0.0
+		self.e = 0.0
+
+		self.absolute = True
+		self.eRelative = False
+
+		self.runStart = None
+		self.run = []
+
+		self.arcs = 0
+		self.weldedLines = 0
+
+	def getState(self):
+		return dict(x=self.x, y=self.y, z=self.z, e=self.e, absolute=self.absolute, eRelative=self.eRelative,
+			runStart=self.runStart, run=self.run, arcs=self.arcs, weldedLines=self.weldedLines)
+
+	def setState(self, state):
+		self.x, self.y, self.z, self.e = state['x'], state['y'], state['z'], state['e']
+		self.absolute = state['absolute']
+		self.eRelative = state['eRelative']
+		self.runStart = tuple(state['runStart']) if state['runStart'] is not None else None
+		self.run = [(tuple(point), line) for point, line in state['run']]
+		self.arcs = state['arcs']
+		self.weldedLines = state['weldedLines']
+
+	# for output that can hold several lines at once, split like readline would
+	def feedLines(self, text):
+		lines = text.split("\n")
+		out = "".join(self.feed(line + "\n") for line in lines[:-1])
+		if len(lines[-1]):
+			out += self.feed(lines[-1])
+		return out
+
+	def feed(self, line):
+		parts = line.split(";")[0].split()
+		if not len(parts):
+			return self.flush() + line
+
+		command = parts[0]
+		if command == "G1" and self.absolute and self.weldable(parts):
+			return self.extend(self.parse(parts), line)
+
+		out = self.flush()
+		self.track(command, parts)
+		return out + line
+
+	def flush(self):
+		if len(self.run) >= self.minSegments:
+			out = self.arc()
+		else:
+			out = "".join(line for point, line in self.run)
+		self.run = []
+		return out
+
+	def weldable(self, parts):
+		hasXY = False
+		for part in parts[1:]:
+			leadChar = part[0]
+			if leadChar not in "XYZE" or len(part) < 2:
+				return False
+			hasXY = hasXY or leadChar in "XY"
+		return hasXY
+
+	# (x, y, z, e, has an E word), e is the absolute E value or the relative amount
+	def parse(self, parts):
+		x, y, z = self.x, self.y, self.z
+		e = 0.0 if self.eRelative else self.e
+		hasE = False
+		for part in parts[1:]:
+			value = float(part[1:])
+			if part[0] == "X":
+				x = value
+			elif part[0] == "Y":
+				y = value
+			elif part[0] == "Z":
+				z = value
+			else:
+				e = value
+				hasE = True
+		return (x, y, z, e, hasE)
+
+	def track(self, command, parts):
+		if command in ("G0", "G1", "G2", "G3"):
+			for part in parts[1:]:
+				if len(part) < 2 or part[0] not in "XYZE":
+					continue
+				value = float(part[1:])
+				if part[0] == "E":
+					if not self.eRelative:
+						self.e = value
+				elif part[0] == "X":
+					self.x = value if self.absolute else self.x + value
+				elif part[0] == "Y":
+					self.y = value if self.absolute else self.y + value
+				else:
+					self.z = value if self.absolute else self.z + value
+		elif command == "G90":
+			self.absolute = True
+		elif command == "G91":
+			self.absolute = False
+		elif command == "M82":
+			self.eRelative = False
+		elif command == "M83":
+			self.eRelative = True
+		elif command == "G92":
+			if len(parts) == 1:
+				self.x = self.y = self.z = self.e = 0.0
+			for part in parts[1:]:
+				if len(part) < 2:
+					continue
+				value = float(part[1:])
+				if part[0] == "X":
+					self.x = value
+				elif part[0] == "Y":
+					self.y = value
+				elif part[0] == "Z":
+					self.z = value
+				elif part[0] == "E":
+					self.e = value
+
+	def extend(self, point, line):
+		if not len(self.run):
+			self.runStart = (self.x, self.y, self.z, self.e, False)
+
+		self.x, self.y, self.z = point[0], point[1], point[2]
+		if not self.eRelative:
+			self.e = point[3]
+
+		self.run.append((point, line))
+		if self.fit() is not None:
+			return ""
+
+		# the new segment does not belong to the arc, it starts the next run
+		last = self.run.pop()
+		start = self.run[-1][0]
+		out = self.flush()
+		self.runStart = start
+		self.run = [last]
+		return out
+
+	# center and total swept angle of the arc through the run, or None when the run is not an arc within tolerance
+	def fit(self):
+		points = [self.runStart] + [point for point, line in self.run]
+		count = len(self.run)
+		if count < 2:
+			return ()
+
+		a = points[0]
+		b = points[(count + 1) // 2]
+		c = points[-1]
+
+		d = 2*(a[0]*(b[1] - c[1]) + b[0]*(c[1] - a[1]) + c[0]*(a[1] - b[1]))
+		if abs(d) < 1e-9:
+			return None
+		aSqr = a[0]**2 + a[1]**2
+		bSqr = b[0]**2 + b[1]**2
+		cSqr = c[0]**2 + c[1]**2
+		center = ((aSqr*(b[1] - c[1]) + bSqr*(c[1] - a[1]) + cSqr*(a[1] - b[1])) / d,
+				  (aSqr*(c[0] - b[0]) + bSqr*(a[0] - c[0]) + cSqr*(b[0] - a[0])) / d)
+		radius = geometry.dist(center, a)
+		if radius > self.maxRadius:
+			return None
+
+		hasE = points[1][4]
+		rate = None
+		angles = [0.0]
+		arm = geometry.sub(a, center)
+		for ind in range(1, len(points)):
+			point = points[ind]
+			nextArm = geometry.sub(point, center)
+
+			if abs(geometry.norm(nextArm) - radius) > self.tolerance:
+				return None
+
+			chord = geometry.dist(points[ind - 1], point)
+			if chord >= 2*radius or radius - math.sqrt(radius**2 - (chord/2)**2) > self.tolerance:
+				return None
+
+			sweep = math.atan2(geometry.cross(arm, nextArm), geometry.dot(arm, nextArm))
+			if sweep == 0.0 or (ind > 1 and (sweep > 0) != (angles[1] > 0)):
+				return None
+			angles.append(angles[-1] + sweep)
+			arm = nextArm
+
+			# the extrusion per mm has to stay the same along the arc
+			if point[4] != hasE:
+				return None
+			if hasE:
+				extruded = point[3] if self.eRelative else point[3] - points[ind - 1][3]
+				segmentRate = extruded / chord
+				if rate is None:
+					rate = segmentRate
+				elif abs(segmentRate - rate) > self.rateVariance * abs(rate):
+					return None
+
+		total = angles[-1]
+		if abs(total) >= 2*math.pi:
+			return None
+
+		# a helical arc moves Z linearly with the angle
+		for point, angle in zip(points, angles):
+			if abs(a[2] + (c[2] - a[2]) * angle / total - point[2]) > self.tolerance:
+				return None
+
+		return center, total
+
+	def arc(self):
+		center, total = self.fit()
+		start = self.runStart
+		end = self.run[-1][0]
+
+		outLine = "G3" if total > 0 else "G2"
+		outLine += " X" + str(round(end[0], 3))
+		outLine += " Y" + str(round(end[1], 3))
+		outLine += " Z" + str(round(end[2], 3))
+		outLine += " I" + str(round(center[0] - start[0], 3))
+		outLine += " J" + str(round(center[1] - start[1], 3))
+		if end[4]:
+			if self.eRelative:
+				outLine += " E" + str(round(sum(point[3] for point, line in self.run), 5))
+			else:
+				outLine += " E" + str(round(end[3], 5))
+		outLine += "\n"
+
+		# comments on the welded lines are kept, on their own lines ahead of the arc that replaces them
+		comments = "".join(line[line.index(";"):].rstrip() + "\n" for point, line in self.run if ";" in line)
+
+		self.arcs += 1
+		self.weldedLines += len(self.run)
+		return comments + outLine
@@ -0,0 +1,196 @@
+# coding=utf-8
+from __future__ import absolute_import, print_function
+
+import argparse, collections, logging, re, shutil, sys, tempfile, time
+
+from octoprint_gcodeleveling import GcodeLevelingPlugin, jobs
+
+# Replays gcode through the plugin's serial hooks against a scripted printer, to see what the hooks add to each command
+# OctoPrint's send loop calls the sent hook for every line and the received hook for every line the printer answers with,
+# so anything slow in them holds up the next line of a print
+
+clock = getattr(time, "perf_counter", time.time)
+
+# the probe regexes from the README with a report in each firmware's format
+firmwares = {
+	"marlin": dict(
+		regex=r"^ok X:(?P<x>[0-9]+\.[0-9]+) Y:(?P<y>[0-9]+\.[0-9]+) Z:(?P<z>[0-9]+\.[0-9]+)",
+		report="ok X:{:.2f} Y:{:.2f} Z:{:.2f} E:0.00 Count: A:20000 B:4000 C:1000",
+		status="T:210.00 /210.00 B:60.00 /60.00 @:64 B@:127",
+		probeCmd="M114"
+	),
+	"grbl": dict(
+		regex=r"\[PRB:(?P<x>[0-9]+\.[0-9]{3}),(?P<y>[0-9]+\.[0-9]{3}),(?P<z>[0-9]+\.[0-9]+):1\]",
+		report="[PRB:{:.3f},{:.3f},{:.3f}:1]",
+		status="<Run|MPos:10.000,20.000,0.200|FS:1500,0>",
+		probeCmd="G38.2"
+	)
+}
+
+# Stand in for the printer on the other end of the serial port, answers each line the way the firmware would
+class FakeSerial():
+	def __init__(self, firmware, statusEvery=20):
+		self.firmware = firmwares[firmware]
+		self.statusEvery = statusEvery
+		self.written = 0
+		self.probed = 0
+		self.responses = collections.deque()
+
+	def write(self, line):
+		self.written += 1
+		if self.statusEvery and self.written % self.statusEvery == 0:
+			self.responses.append(self.firmware['status'])
+
+		if line.split(" ", 1)[0] == self.firmware['probeCmd']:
+			self.probed += 1
+			report = self.firmware['report'].format(10.0 + self.probed % 100, 20.0 + self.probed % 50, 0.2)
+			self.responses.append(report)
+			# Marlin's position report is its ok
+			if report.startswith("ok"):
+				return
+		self.responses.append("ok")
+
+	def readline(self):
+		return self.responses.popleft() if len(self.responses) else None
+
+# serpentine infill over a 200 x 200 bed, for when no file is given
+def syntheticLines(count):
+	lines = ["G90", "M82", "G28", "G1 Z0.2 F3000"]
+	e = 0.0
+	for ind in range(count):
+		row = ind // 40
+		column = ind % 40 if row % 2 == 0 else 39 - ind % 40
+		e += 0.05
+		lines.append("G1 X{:.3f} Y{:.3f} E{:.5f} F1800".format(5.0 + column * 4.75, 5.0 + (row % 40) * 4.75, e))
+	return lines
+
+def fileLines(path):
+	with open(path) as gcodeFile:
+		for line in gcodeFile:
+			line = line.split(";", 1)[0].strip()
+			if len(line):
+				yield line
+
+def percentile(ordered, fraction):
+	return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+# one pass over the lines with the plugin in the given state, the time spent in its hooks is taken per command
+def replay(plugin, lines, firmware, scenario, probeEvery, hooks=True):
+	serial = FakeSerial(firmware)
+	plugin.printing = scenario == "print"
+	# with latency diagnostics on, the most the hooks do during a print
+	plugin.measuringLatency = plugin.printing
+	if scenario == "probe":
+		plugin.probeSession.start(re.compile(firmwares[firmware]['regex']), 0.0)
+
+	added = []
+	probes = 0
+	skipped = 0
+	started = clock()
+	for ind, line in enumerate(lines):
+		if scenario == "probe" and probeEvery and ind % probeEvery == 0:
+			# a point of the probing run, its report arrives among the answers to the lines sent after it
+			plugin.probeSession.expect()
+			line = firmwares[firmware]['probeCmd']
+			probes += 1
+
+		if line.startswith("@"):
+			command, _, parameters = line[1:].partition(" ")
+			# would start a real probing run
+			if command == "GCODELEVELING-AUTOPROBE":
+				skipped += 1
+				continue
+			if hooks:
+				hookStarted = clock()
+				plugin.custom_atcommand_handler(None, "queuing", command, parameters)
+				added.append(clock() - hookStarted)
+			continue
+
+		serial.write(line)
+		spent = 0.0
+		if hooks:
+			hookStarted = clock()
+			plugin.gcodeSent(None, "sent", line, None, line.split(" ", 1)[0])
+			spent += clock() - hookStarted
+
+		response = serial.readline()
+		while response is not None:
+			if hooks:
+				hookStarted = clock()
+				plugin.parseReceived(None, response)
+				spent += clock() - hookStarted
+			response = serial.readline()
+		if hooks:
+			added.append(spent)
+	elapsed = clock() - started
+
+	received = 0
+	if scenario == "probe":
+		received = plugin.probeSession.results.qsize()
+		plugin.probeSession.finish()
+	plugin.printing = False
+	plugin.measuringLatency = False
+
+	result = dict(scenario=scenario, commands=serial.written, skipped=skipped, seconds=elapsed, linesPerSecond=serial.written / max(elapsed, 1e-9))
+	if len(added):
+		ordered = sorted(added)
+		result.update(mean=sum(ordered) / len(ordered) * 1e6, p50=percentile(ordered, 0.5) * 1e6, p90=percentile(ordered, 0.9) * 1e6,
+			p99=percentile(ordered, 0.99) * 1e6, max=ordered[-1] * 1e6)
+	if scenario == "probe":
+		result.update(probes=probes, received=received)
+	return result
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="gcodeleveling-bench", description="Measure the latency the GcodeLeveling serial hooks add to each command, against a scripted printer")
+	parser.add_argument("files", nargs="*", help="gcode files to replay (default: a generated file of --lines moves)")
+	parser.add_argument("--lines", type=int, default=100000, help="moves in the generated file (default: 100000)")
+	parser.add_argument("--firmware", choices=sorted(firmwares), default="marlin", help="format of the printer's answers and probe reports (default: marlin)")
+	parser.add_argument("--scenario", action="append", choices=["idle", "print", "probe"], help="plugin state to replay in, can be given more than once (default: all)")
+	parser.add_argument("--probe-every", type=int, default=50, help="lines between probe points in the probe scenario (default: 50)")
+	parser.add_argument("--repeat", type=int, default=3, help="passes over the lines per scenario, only the last one is reported (default: 3)")
+	parser.add_argument("--max-p99-us", type=float, default=0.0, help="fail if a scenario's p99 added latency per command is above this many microseconds (default: 0, no limit)")
+	args = parser.parse_args(argv)
+
+	logging.basicConfig(level=logging.WARNING)
+
+	lines = []
+	for path in args.files:
+		lines.extend(fileLines(path))
+	if not len(args.files):
+		lines = syntheticLines(args.lines)
+
+	# only the hooks are used, so the plugin is not injected by OctoPrint
+	folder = tempfile.mkdtemp(prefix="gcodeleveling-bench-")
+	plugin = GcodeLevelingPlugin()
+	plugin._logger = logging.getLogger("octoprint.plugins.gcodeleveling")
+	plugin.jobPool = jobs.JobPool(folder)
+
+	failed = False
+	try:
+		for ind in range(max(1, args.repeat)):
+			baseline = replay(plugin, lines, args.firmware, "idle", args.probe_every, hooks=False)
+		print("{} commands ({}), {:.0f} lines/s without hooks".format(baseline['commands'], args.firmware, baseline['linesPerSecond']))
+
+		for scenario in args.scenario or ["idle", "print", "probe"]:
+			for ind in range(max(1, args.repeat)):
+				result = replay(plugin, lines, args.firmware, scenario, args.probe_every)
+
+			summary = "{}: {:.0f} lines/s, added latency per command mean {:.2f} us, p50 {:.2f} us, p90 {:.2f} us, p99 {:.2f} us, max {:.1f} us".format(
+				scenario, result['linesPerSecond'], result['mean'], result['p50'], result['p90'], result['p99'], result['max'])
+			if scenario == "probe":
+				summary += ", {} of {} probe reports matched".format(result['received'], result['probes'])
+				if result['received'] != result['probes']:
+					failed = True
+			if result['skipped']:
+				summary += ", {} @ commands skipped".format(result['skipped'])
+			if args.max_p99_us > 0 and result['p99'] > args.max_p99_us:
+				summary += ", p99 over the {} us limit".format(args.max_p99_us)
+				failed = True
+			print(summary)
+	finally:
+		shutil.rmtree(folder, ignore_errors=True)
+
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
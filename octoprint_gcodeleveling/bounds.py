@@ -0,0 +1,217 @@
+import heapq, math
+import numpy as np
+
+CERTIFIED = "certified"
+UNKNOWN = "unknown"
+OUTSIDE = "outside"
+
+# The range of the model over a rectangle comes from its Bernstein form: a polynomial over a box lies between the smallest and
+# largest of its Bernstein coefficients there, and the corner coefficients are its values at the corners.
+# Halving the box with de Casteljau's algorithm tightens the bound, the box with the worst bound is halved until it is within
+# tolerance of a value the surface actually reaches
+
+def binomial(n, k):
+	return math.factorial(n) // (math.factorial(k) * math.factorial(n - k))
+
+# coefficients along axis 0 of p(lo + (hi - lo)*u) in powers of u
+def rescale(table, lo, hi):
+	out = np.zeros_like(table)
+	for power in range(table.shape[0]):
+		for k in range(power + 1):
+			out[k] += table[power] * binomial(power, k) * lo**(power - k) * (hi - lo)**k
+	return out
+
+# power coefficients on [0, 1] along axis 0 to Bernstein coefficients
+def toBernstein(table):
+	n = table.shape[0] - 1
+	basis = np.array([[binomial(i, k) / float(binomial(n, k)) if k <= i else 0.0 for k in range(n + 1)] for i in range(n + 1)])
+	return np.tensordot(basis, table, axes=(1, 0))
+
+def bernsteinCoeffs(coeffs, xLo, xHi, yLo, yHi):
+	table = rescale(np.asarray(coeffs, dtype="float"), xLo, xHi)
+	table = rescale(table.T, yLo, yHi).T
+	return toBernstein(toBernstein(table).T).T
+
+# the Bernstein coefficients of the two halves of the box along an axis
+def halve(bern, axis):
+	work = np.moveaxis(bern, axis, 0)
+	left = [work[0]]
+	right = [work[-1]]
+	for level in range(1, work.shape[0]):
+		work = (work[:-1] + work[1:]) / 2.0
+		left.append(work[0])
+		right.append(work[-1])
+	return np.moveaxis(np.array(left), 0, axis), np.moveaxis(np.array(right[::-1]), 0, axis)
+
+def corners(bern):
+	return max(bern[0, 0], bern[0, -1], bern[-1, 0], bern[-1, -1])
+
+# an upper bound of the polynomial over the box, at most tolerance above its maximum unless maxSplits runs out first
+def upperBound(bern, tolerance, maxSplits=4000):
+	reached = corners(bern)
+	boxes = [(-bern.max(), 0, bern)]
+	count = 1
+	while True:
+		# the top of the heap has the largest bound of all the boxes left, so it bounds the whole rectangle
+		bound, _, box = heapq.heappop(boxes)
+		if -bound - reached <= tolerance or count > maxSplits:
+			return -bound
+
+		# halve along the direction the coefficients vary most in
+		axis = 0 if np.ptp(box, axis=0).max() >= np.ptp(box, axis=1).max() else 1
+		for half in halve(box, axis):
+			reached = max(reached, corners(half))
+			heapq.heappush(boxes, (-half.max(), count, half))
+			count += 1
+
+# min and max of the surface model over a rectangle, a bound the model never leaves that is at most tolerance wider than its range
+def polyRange(coeffs, xLo, xHi, yLo, yHi, tolerance=1e-4):
+	coeffs = np.asarray(coeffs, dtype="float")
+	bern = bernsteinCoeffs(coeffs, xLo, xHi, yLo, yHi)
+
+	# rounding while changing basis, on the order of the largest term of the polynomial over the rectangle
+	reach = max(abs(xLo), abs(xHi)), max(abs(yLo), abs(yHi))
+	rounding = 64 * np.finfo(float).eps * sum(abs(coeff) * reach[0]**r * reach[1]**c for r, row in enumerate(coeffs) for c, coeff in enumerate(row))
+
+	high = upperBound(bern, tolerance)
+	low = -upperBound(-bern, tolerance)
+	return low - rounding, high + rounding
+
+# min and max of a tiled model over a rectangle, each point is a weighted average of the tiles covering it
+# so the range of every tile over the part it covers bounds the blend as well
+def tiledRange(tiles, xLo, xHi, yLo, yHi):
+	from octoprint_gcodeleveling import tiling
+
+	low = float("inf")
+	high = float("-inf")
+	for xTile, row in enumerate(tiles['coeffs']):
+		spanXLo, spanXHi = tiling.tileSpan(tiles['x'], xTile)
+		for yTile, table in enumerate(row):
+			spanYLo, spanYHi = tiling.tileSpan(tiles['y'], yTile)
+			lo = (max(xLo, spanXLo), max(yLo, spanYLo))
+			hi = (min(xHi, spanXHi), min(yHi, spanYHi))
+			if lo[0] > hi[0] or lo[1] > hi[1]:
+				continue
+			tileLow, tileHigh = polyRange(table, lo[0], hi[0], lo[1], hi[1])
+			low = min(low, tileLow)
+			high = max(high, tileHigh)
+	return low, high
+
+# Quick pass over a gcode stream collecting the region the preprocessor will evaluate the model on
+def scanExtents(stream):
+	xLo = yLo = zLo = float("inf")
+	xHi = yHi = zHi = float("-inf")
+	zLowPoint = zHighPoint = None
+
+	x = y = z = 0.0
+	relative = False
+	afterStart = False
+	xyPlane = True
+
+	while True:
+		line = stream.readline()
+		if not line:
+			break
+		line = line.lstrip()
+		if line[:1] != b"G":
+			continue
+
+		activeCode = line.split(b";")[0]
+		parts = activeCode.split()
+		command = parts[0]
+
+		if command in (b"G0", b"G1", b"G2", b"G3"):
+			if relative:
+				continue
+
+			xPrev, yPrev = x, y
+			arcI = arcJ = arcR = 0.0
+			for part in parts[1:]:
+				if len(part) > 1:
+					leadChar = part[:1]
+					if leadChar == b"X":
+						x = float(part[1:])
+					elif leadChar == b"Y":
+						y = float(part[1:])
+					elif leadChar == b"Z":
+						z = float(part[1:])
+					elif leadChar == b"I":
+						arcI = float(part[1:])
+					elif leadChar == b"J":
+						arcJ = float(part[1:])
+					elif leadChar == b"R":
+						arcR = float(part[1:])
+
+			if command in (b"G0", b"G1"):
+				afterStart = True
+			elif not xyPlane:
+				continue
+			elif not afterStart:
+				# arcs before the first line move are leveled from a model value, so no static bound holds
+				return None
+			elif arcI or arcJ:
+				radius = math.hypot(arcI, arcJ)
+				xLo = min(xLo, xPrev + arcI - radius)
+				xHi = max(xHi, xPrev + arcI + radius)
+				yLo = min(yLo, yPrev + arcJ - radius)
+				yHi = max(yHi, yPrev + arcJ + radius)
+			else:
+				reach = 2*abs(arcR)
+				xLo = min(xLo, xPrev - reach)
+				xHi = max(xHi, xPrev + reach)
+				yLo = min(yLo, yPrev - reach)
+				yHi = max(yHi, yPrev + reach)
+
+			xLo = min(xLo, x)
+			xHi = max(xHi, x)
+			yLo = min(yLo, y)
+			yHi = max(yHi, y)
+			if z < zLo:
+				zLo = z
+				zLowPoint = (x, y, z)
+			if z > zHi:
+				zHi = z
+				zHighPoint = (x, y, z)
+		elif command == b"G90":
+			relative = False
+		elif command == b"G91":
+			relative = True
+		elif command == b"G92":
+			# the preprocessor keeps leveling after a position reset, in coordinates the scan can't follow
+			if any(part[:1] in (b"X", b"Y", b"Z") for part in parts[1:]):
+				return None
+		elif command in (b"G17", b"G18", b"G19"):
+			xyPlane = command == b"G17"
+
+	if zLowPoint is None:
+		return None
+
+	return dict(xMin=xLo, xMax=xHi, yMin=yLo, yMax=yHi, zMin=zLo, zMax=zHi, zLowPoint=zLowPoint, zHighPoint=zHighPoint)
+
+# Decide once whether every leveled Z of a file is guaranteed to land inside [zMin, zMax]
+def certify(coeffs, extents, zMin, zMax, invertPosition, tiles=None):
+	from octoprint_gcodeleveling import evaluators
+
+	sign = -1 if invertPosition else 1
+	if tiles is not None:
+		low, high = tiledRange(tiles, extents['xMin'], extents['xMax'], extents['yMin'], extents['yMax'])
+	else:
+		low, high = polyRange(coeffs, extents['xMin'], extents['xMax'], extents['yMin'], extents['yMax'])
+
+	offsets = sorted((sign*extents['zMin'], sign*extents['zMax']))
+	result = dict(low=float(low + offsets[0]), high=float(high + offsets[1]))
+
+	if result['low'] >= zMin and result['high'] <= zMax:
+		result['status'] = CERTIFIED
+		return result
+
+	# the points with the most extreme gcode Z are real points of the file, if one misses the file can't fit
+	for x, y, z in (extents['zLowPoint'], extents['zHighPoint']):
+		zNew = evaluators.forModel(coeffs, tiles).value(x, y) + sign*z
+		if zNew < zMin or zNew > zMax:
+			result['status'] = OUTSIDE
+			result['point'] = (x, y, float(zNew))
+			return result
+
+	result['status'] = UNKNOWN
+	return result
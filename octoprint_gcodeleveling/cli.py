@@ -0,0 +1,105 @@
+# coding=utf-8
+from __future__ import absolute_import, print_function
+
+import argparse, json, logging, multiprocessing, os, sys, time
+
+import octoprint_gcodeleveling
+from octoprint_gcodeleveling import GcodeLevelingPlugin, twoDimFit, tiling, bounds, jobs
+
+# Settings come either from a plain json/yaml file with the plugin's keys or straight from OctoPrint's config.yaml
+def loadSettings(path):
+	with open(path) as settingsFile:
+		if path.endswith(".json"):
+			data = json.load(settingsFile)
+		else:
+			import yaml
+			data = yaml.safe_load(settingsFile)
+
+	if "plugins" in data:
+		data = data["plugins"].get("gcodeleveling", {})
+
+	settings = GcodeLevelingPlugin().get_settings_defaults()
+	settings.update(data)
+	return settings
+
+def fitModel(settings):
+	points = settings["points"]
+	if all(coor == 0.0 for point in points for coor in point):
+		raise ValueError("Points have not been entered (or they are all zero)")
+
+	xDeg = int(settings["modelDegree"]["x"])
+	yDeg = int(settings["modelDegree"]["y"])
+	tiles = None
+	if (int(settings["tiles"]["x"]), int(settings["tiles"]["y"])) != (1, 1):
+		tiles = tiling.fitTiles(points, xDeg, yDeg, max(1, int(settings["tiles"]["x"])), max(1, int(settings["tiles"]["y"])))
+	return twoDimFit.twoDpolyFit(points, xDeg, yDeg), tiles
+
+def levelFile(job):
+	inPath, outPath, coeffs, tiles, settings, indexPath = job
+
+	zMin = float(settings["zMin"])
+	zMax = float(settings["zMax"])
+	invertPosition = bool(settings["invertPosition"])
+
+	started = time.time()
+	certified = False
+	if settings.get("certifyBounds", True):
+		with open(inPath, "rb") as scanStream:
+			extents = bounds.scanExtents(scanStream)
+		if extents is not None:
+			certification = bounds.certify(coeffs, extents, zMin, zMax, invertPosition, tiles=tiles)
+			if certification['status'] == bounds.OUTSIDE:
+				return dict(path=inPath, error="Computed Z was outside of bounds", message="Gcode Leveling config likely needs to be changed")
+			certified = certification['status'] == bounds.CERTIFIED
+
+	# the same worker function the plugin's pool runs for uploads
+	result = jobs.levelPath(inPath, outPath, jobs.snapshot(coeffs, zMin, zMax, settings["lineBreakDist"], settings["arcSegDist"], invertPosition, certified, settings["minSegmentTime"], settings["arcFitTolerance"], settings["maxJobTime"], settings["maxGrowth"], settings["indexEvery"], tiles), indexPath=indexPath)
+	result['seconds'] = time.time() - started
+	return result
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="gcodeleveling", description="Level gcode files with the GcodeLeveling model outside of OctoPrint")
+	parser.add_argument("settings", help="json/yaml file with the plugin settings (points, modelDegree, ...) or OctoPrint's config.yaml")
+	parser.add_argument("files", nargs="+", help="gcode files to level")
+	parser.add_argument("-o", "--output-dir", default="leveled", help="directory to write the leveled files to (default: ./leveled)")
+	parser.add_argument("--index", action="store_true", help="also write a seek index next to each leveled file (<file>.index.json)")
+	parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help="number of files to level at once (default: cpu count)")
+	args = parser.parse_args(argv)
+
+	logging.basicConfig(level=logging.WARNING)
+
+	settings = loadSettings(args.settings)
+	fitStarted = time.time()
+	coeffs, tiles = fitModel(settings)
+	print("plugin loaded in {} ms, model fit in {} ms".format(int(octoprint_gcodeleveling.loadTime * 1000), int((time.time() - fitStarted) * 1000)))
+
+	if not os.path.isdir(args.output_dir):
+		os.makedirs(args.output_dir)
+
+	jobs = []
+	for inPath in args.files:
+		outPath = os.path.join(args.output_dir, os.path.basename(inPath))
+		if os.path.abspath(outPath) == os.path.abspath(inPath):
+			parser.error("{} would be overwritten, choose another output directory".format(inPath))
+		jobs.append((inPath, outPath, coeffs, tiles, settings, outPath + ".index.json" if args.index else None))
+
+	failed = 0
+	started = time.time()
+	pool = multiprocessing.Pool(max(1, min(args.jobs, len(jobs))))
+	try:
+		for result in pool.imap_unordered(levelFile, jobs):
+			if "error" in result:
+				failed += 1
+				print("{}: failed, {} ({} at line {}, byte {})".format(result['path'], result['error'], result['message'], result.get('line', 0), result.get('offset', 0)))
+			else:
+				megabytes = result['inBytes'] / 1e6
+				print("{}: {:.1f} MB -> {:.1f} MB in {:.1f}s ({:.2f} MB/s)".format(result['path'], megabytes, result['outBytes'] / 1e6, result['seconds'], megabytes / max(result['seconds'], 1e-6)))
+	finally:
+		pool.close()
+		pool.join()
+
+	print("{} of {} files leveled in {:.1f}s".format(len(jobs) - failed, len(jobs), time.time() - started))
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,146 @@
+import hashlib, json
+
+# The degree and coefficients of a model never change once it is fit, so its value, gradient and hessian are written out
+# as straight-line Horner expressions with the coefficients inlined and compiled once, instead of looping over the
+# coefficient tables on each of the millions of evaluations a file takes
+
+# compiled models by the hash of their coefficients, the preprocessor only gets the coefficients
+cache = {}
+cacheSize = 16
+
+def modelHash(coeffs):
+	rows = [[float(coeff) for coeff in row] for row in coeffs]
+	return hashlib.sha1(repr(rows).encode("utf-8")).hexdigest()
+
+# nested Horner form of a coefficient table, in y within each row and in x over the rows
+def horner(table):
+	rows = [row for row in table]
+	while len(rows) and not len(rows[-1]):
+		rows.pop()
+	if not len(rows):
+		return "0.0"
+
+	expression = None
+	for row in reversed(rows):
+		rowExpression = None
+		for coeff in reversed(list(row)):
+			if rowExpression is None:
+				rowExpression = repr(float(coeff))
+			else:
+				rowExpression = "({})*y + {}".format(rowExpression, repr(float(coeff)))
+		if rowExpression is None:
+			rowExpression = "0.0"
+
+		if expression is None:
+			expression = rowExpression
+		else:
+			expression = "({})*x + {}".format(expression, rowExpression)
+	return expression
+
+def source(coeffs, derivatives):
+	return "\n".join([
+		"def value(x, y):",
+		"\treturn {}".format(horner(coeffs)),
+		"def gradient(x, y):",
+		"\treturn ({}, {})".format(horner(derivatives['x']), horner(derivatives['y'])),
+		"def hessian(x, y):",
+		"\treturn ({}, {}, {})".format(horner(derivatives['xx']), horner(derivatives['yy']), horner(derivatives['xy'])),
+		""
+	])
+
+class CompiledModel():
+	def __init__(self, key, coeffs, derivatives=None):
+		if derivatives is None:
+			from octoprint_gcodeleveling import maxima
+
+			first = maxima.der(coeffs)
+			derivatives = dict(x=first['x'], y=first['y'], xx=maxima.der(first['x'])['x'], yy=maxima.der(first['y'])['y'], xy=maxima.der(first['x'])['y'])
+
+		self.key = key
+		self.source = source(coeffs, derivatives)
+		# a single polynomial has no seams to split moves at
+		self.seams = ([], [])
+
+		# repr of a coefficient that is not finite is inf or nan
+		namespace = dict(inf=float("inf"), nan=float("nan"))
+		exec(compile(self.source, "<gcodeleveling model {}>".format(key[:8]), "exec"), namespace)
+		self.value = namespace['value']
+		self.gradient = namespace['gradient']
+		self.hessian = namespace['hessian']
+
+# Blend of the compiled tiles of a tiled model (see tiling.py), with the same value, gradient and hessian as a single one
+class TiledModel():
+	def __init__(self, key, tiles):
+		from octoprint_gcodeleveling import tiling
+
+		self.key = key
+		self.xCenters = tiles['x']
+		self.yCenters = tiles['y']
+		self.tiles = [[CompiledModel("{}-{}-{}".format(key, xTile, yTile), table) for yTile, table in enumerate(row)] for xTile, row in enumerate(tiles['coeffs'])]
+		self.blend = tiling.blend
+		self.seams = tiling.seams(tiles)
+
+	# the hot path of leveling, only the weights are needed here
+	def value(self, x, y):
+		xBlend = self.blend(self.xCenters, x)
+		yBlend = self.blend(self.yCenters, y)
+		if len(xBlend) == 1 and len(yBlend) == 1:
+			return self.tiles[xBlend[0][0]][yBlend[0][0]].value(x, y)
+
+		z = 0.0
+		for xTile, xWeight, xSlope, xCurve in xBlend:
+			row = self.tiles[xTile]
+			for yTile, yWeight, ySlope, yCurve in yBlend:
+				z += xWeight*yWeight*row[yTile].value(x, y)
+		return z
+
+	def gradient(self, x, y):
+		gx = 0.0
+		gy = 0.0
+		for xTile, xWeight, xSlope, xCurve in self.blend(self.xCenters, x):
+			for yTile, yWeight, ySlope, yCurve in self.blend(self.yCenters, y):
+				tile = self.tiles[xTile][yTile]
+				z = tile.value(x, y)
+				tx, ty = tile.gradient(x, y)
+				gx += xSlope*yWeight*z + xWeight*yWeight*tx
+				gy += xWeight*ySlope*z + xWeight*yWeight*ty
+		return (gx, gy)
+
+	def hessian(self, x, y):
+		hxx = 0.0
+		hyy = 0.0
+		hxy = 0.0
+		for xTile, xWeight, xSlope, xCurve in self.blend(self.xCenters, x):
+			for yTile, yWeight, ySlope, yCurve in self.blend(self.yCenters, y):
+				tile = self.tiles[xTile][yTile]
+				z = tile.value(x, y)
+				tx, ty = tile.gradient(x, y)
+				txx, tyy, txy = tile.hessian(x, y)
+				weight = xWeight*yWeight
+				hxx += xCurve*yWeight*z + 2*xSlope*yWeight*tx + weight*txx
+				hyy += xWeight*yCurve*z + 2*xWeight*ySlope*ty + weight*tyy
+				hxy += xSlope*ySlope*z + xSlope*yWeight*ty + xWeight*ySlope*tx + weight*txy
+		return (hxx, hyy, hxy)
+
+def remember(key, build):
+	compiled = cache.get(key)
+	if compiled is None:
+		if len(cache) >= cacheSize:
+			cache.clear()
+		compiled = build()
+		cache[key] = compiled
+	return compiled
+
+def forTiles(tiles):
+	key = hashlib.sha1(json.dumps(tiles, sort_keys=True).encode("utf-8")).hexdigest()
+	return remember(key, lambda : TiledModel(key, tiles))
+
+def forCoeffs(coeffs, derivatives=None):
+	key = modelHash(coeffs)
+	return remember(key, lambda : CompiledModel(key, coeffs, derivatives))
+
+# the evaluator leveling uses for a model, its tiles if it has them
+def forModel(coeffs, tiles=None, derivatives=None):
+	if tiles is not None:
+		return forTiles(tiles)
+	return forCoeffs(coeffs, derivatives)
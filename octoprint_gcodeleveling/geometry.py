@@ -0,0 +1,33 @@
+import math
+
+# Scalar 2d vector math for the per move computations, points are plain (x, y) tuples
+# numpy is kept for the batched work (fitting, coefficient tables), on two element vectors its call overhead dwarfs the math
+
+def add(a, b):
+	return (a[0] + b[0], a[1] + b[1])
+
+def sub(a, b):
+	return (a[0] - b[0], a[1] - b[1])
+
+def scale(a, s):
+	return (a[0]*s, a[1]*s)
+
+def dot(a, b):
+	return a[0]*b[0] + a[1]*b[1]
+
+# z component of the 3d cross product of two xy vectors
+def cross(a, b):
+	return a[0]*b[1] - a[1]*b[0]
+
+def norm(a):
+	return math.sqrt(a[0]*a[0] + a[1]*a[1])
+
+def dist(a, b):
+	dx = b[0] - a[0]
+	dy = b[1] - a[1]
+	return math.sqrt(dx*dx + dy*dy)
+
+def rotateVector(theta, vec):
+	cos = math.cos(theta)
+	sin = math.sin(theta)
+	return (cos*vec[0] - sin*vec[1], sin*vec[0] + cos*vec[1])
@@ -0,0 +1,123 @@
+import collections, json, os, time
+
+from octoprint.util import atomic_write
+
+# Keeps leveling work out of the way of a running print
+# While the printer prints, the plugin keeps a flag file with the limits to follow; leveling checks it between batches of output
+# and stays off the reserved cores and sleeps enough to only be busy for the given fraction of the time
+
+def availableCpus():
+	if hasattr(os, "sched_getaffinity"):
+		return sorted(os.sched_getaffinity(0))
+	import multiprocessing
+	return list(range(multiprocessing.cpu_count()))
+
+# the cores left for leveling while printing, the lowest ones are kept for OctoPrint and its serial threads
+def printingCpus(reservedCores):
+	cpus = availableCpus()
+	return cpus[min(reservedCores, len(cpus) - 1):]
+
+def setAffinity(cpus):
+	if not hasattr(os, "sched_setaffinity"):
+		return
+	try:
+		os.sched_setaffinity(0, cpus)
+	except OSError:
+		pass
+
+# initializer of the leveling pool's workers, niceness can't be lowered again without privileges so workers always run with it
+def lowerPriority(niceness):
+	if niceness <= 0 or not hasattr(os, "nice"):
+		return
+	try:
+		os.nice(niceness)
+	except OSError:
+		pass
+
+def startPrinting(flagPath, duty, cpus):
+	with atomic_write(flagPath, mode="w") as flagFile:
+		json.dump(dict(duty=duty, cpus=cpus), flagFile)
+
+def stopPrinting(flagPath):
+	if os.path.exists(flagPath):
+		os.remove(flagPath)
+
+# Used by one leveling run, pace is called after each batch
+class Throttle():
+	def __init__(self, flagPath):
+		self.flagPath = flagPath
+		self.stamp = None
+		self.limits = None
+		self.cpus = availableCpus()
+		self.busySince = time.time()
+		self.slept = 0.0
+
+	def update(self):
+		try:
+			stamp = os.stat(self.flagPath).st_mtime
+		except OSError:
+			stamp = None
+		if stamp == self.stamp:
+			return
+		self.stamp = stamp
+
+		limits = None
+		if stamp is not None:
+			try:
+				with open(self.flagPath) as flagFile:
+					limits = json.load(flagFile)
+			except (IOError, OSError, ValueError):
+				# removed or still being replaced, read again next batch
+				self.stamp = None
+		self.limits = limits
+		setAffinity(limits['cpus'] if limits is not None else self.cpus)
+
+	def pace(self):
+		self.update()
+		if self.limits is not None and 0.0 < self.limits['duty'] < 1.0:
+			busy = time.time() - self.busySince
+			pause = busy * (1.0 - self.limits['duty']) / self.limits['duty']
+			time.sleep(pause)
+			self.slept += pause
+		self.busySince = time.time()
+
+	def release(self):
+		if self.limits is not None:
+			setAffinity(self.cpus)
+			self.limits = None
+
+# Time from an ok from the printer to the next line OctoPrint sends, kept apart for while leveling runs and while it does not
+class SendLatency():
+	def __init__(self, size=5000):
+		self.size = size
+		self.reset()
+
+	def reset(self):
+		self.okAt = None
+		self.samples = dict(idle=collections.deque(maxlen=self.size), leveling=collections.deque(maxlen=self.size))
+
+	def received(self):
+		self.okAt = time.time()
+
+	def sent(self, leveling):
+		okAt = self.okAt
+		if okAt is None:
+			return
+		self.okAt = None
+		self.samples['leveling' if leveling else 'idle'].append(time.time() - okAt)
+
+	def report(self):
+		report = dict()
+		for name, samples in self.samples.items():
+			ordered = sorted(samples)
+			if not len(ordered):
+				report[name] = dict(count=0)
+				continue
+			report[name] = dict(
+				count=len(ordered),
+				mean=round(sum(ordered) / len(ordered) * 1000, 3),
+				p50=round(ordered[len(ordered) // 2] * 1000, 3),
+				p99=round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 3),
+				max=round(ordered[-1] * 1000, 3)
+			)
+		return report
@@ -0,0 +1,126 @@
+import bisect, json
+
+from octoprint.util import atomic_write
+
+# Maps input lines of a leveled file to where their output starts, since subdivision shifts every byte after the first split move
+# An entry is made at each layer change comment, each move to a new highest Z and every Nth input line,
+# and carries the modal state from right before that line so a tool can start sending from its offset
+# z is the last leveled Z written to the output (None before the first move), top is the highest Z of the input so far, which is what layer heights are looked up by
+fields = ("line", "offset", "kind", "layer", "top", "x", "y", "z", "e", "feedrate", "eMode", "moveMode")
+
+LAYER = "layer"
+Z = "z"
+LINE = "line"
+
+class IndexBuilder():
+	def __init__(self, every, part=None):
+		self.every = every
+		# entries are also appended to this file as they are made, so a checkpointed job keeps the ones it already has
+		self.part = part
+		self.columns = dict((field, []) for field in fields)
+
+		self.layer = -1
+		self.top = None
+		# kind of the entry waiting for the arc welder to let go
+		self.deferred = None
+		self.candidate = None
+
+	def __len__(self):
+		return len(self.columns['line'])
+
+	def getState(self):
+		return dict(partOffset=self.part.tell() if self.part is not None else 0, layer=self.layer, top=self.top, deferred=self.deferred)
+
+	def setState(self, state):
+		for entry in readPart(self.part, state['partOffset']):
+			for field, value in zip(fields, entry):
+				self.columns[field].append(value)
+		self.part.seek(state['partOffset'])
+		self.part.truncate()
+		self.layer = state['layer']
+		self.top = state['top']
+		self.deferred = state['deferred']
+
+	# called with each input line before it is processed, offset is where its output will start
+	# quiet is False while the arc welder holds back earlier lines, those entries wait for the next line it does not
+	def before(self, line, preprocessor, offset, quiet):
+		if self.deferred is not None and quiet:
+			self.add(self.state(preprocessor, offset), self.deferred)
+			self.deferred = None
+
+		nth = (preprocessor.lineNumber + 1) % self.every == 0
+		if line.startswith(b";LAYER:") or line.startswith(b";LAYER_CHANGE"):
+			self.layer += 1
+			self.mark(self.state(preprocessor, offset), LAYER, quiet)
+		elif line[:1] == b"G" and b"Z" in line:
+			# only known to be a new height once the line is parsed
+			self.candidate = (self.state(preprocessor, offset), quiet, nth)
+		elif nth:
+			self.mark(self.state(preprocessor, offset), LINE, quiet)
+
+	def after(self, preprocessor):
+		if self.candidate is None:
+			return
+		state, quiet, nth = self.candidate
+		self.candidate = None
+
+		if self.top is None or preprocessor.zCurr > self.top:
+			self.top = preprocessor.zCurr
+			self.mark(state, Z, quiet)
+		elif nth:
+			self.mark(state, LINE, quiet)
+
+	def mark(self, state, kind, quiet):
+		if quiet:
+			self.add(state, kind)
+		elif self.deferred is None or kind == LAYER:
+			self.deferred = kind
+
+	def state(self, preprocessor, offset):
+		return [preprocessor.lineNumber + 1, offset, preprocessor.xCurr, preprocessor.yCurr, preprocessor.zOut, preprocessor.eCurr, preprocessor.feedrate, preprocessor.eMode, preprocessor.moveMode]
+
+	def add(self, state, kind):
+		self.append(state[:2] + [kind, self.layer, self.top] + state[2:])
+
+	def append(self, entry):
+		for field, value in zip(fields, entry):
+			self.columns[field].append(value)
+		if self.part is not None:
+			self.part.write((json.dumps(entry) + "\n").encode("utf-8"))
+
+	def save(self, path, lines, outputBytes):
+		with atomic_write(path, mode="w") as indexFile:
+			json.dump(dict(every=self.every, lines=lines, bytes=outputBytes, fields=fields, columns=self.columns), indexFile, separators=(",", ":"))
+
+# the entries a checkpoint counted, anything after it may be cut off partway through a line
+def readPart(part, partOffset):
+	part.seek(0)
+	return [json.loads(line) for line in part.read(partOffset).splitlines()]
+
+def load(path):
+	with open(path) as indexFile:
+		return json.load(indexFile)
+
+def entry(index, position):
+	return dict((field, index['columns'][field][position]) for field in index['fields'])
+
+# line and offset find the last entry at or before the value, layer and z the first entry that reaches it
+def lookup(index, key, value):
+	columns = index['columns']
+	if key in ("line", "offset"):
+		position = bisect.bisect_right(columns[key], value) - 1
+	elif key == "layer":
+		position = bisect.bisect_left(columns['layer'], value)
+	elif key == "z":
+		# only the entries before the first Z move have no top yet
+		tops = columns['top']
+		first = 0
+		while first < len(tops) and tops[first] is None:
+			first += 1
+		position = bisect.bisect_left(tops, value, first)
+	else:
+		raise ValueError("Cannot look up an index by {}".format(key))
+
+	if position < 0 or position >= len(columns['line']):
+		return None
+	return entry(index, position)
@@ -0,0 +1,412 @@
+import collections, json, logging, multiprocessing, os, shutil, sys, tempfile, threading, time, uuid
+
+import octoprint.filemanager.util
+from octoprint.util import atomic_write
+
+from octoprint_gcodeleveling import governor
+
+_logger = logging.getLogger("octoprint.plugins.gcodeleveling.jobs")
+
+# Everything a worker needs to level one file, captured once so settings saves and model changes can't reach a running job
+LevelingJob = collections.namedtuple("LevelingJob", ["coeffs", "zMin", "zMax", "lineBreakDist", "arcSegDist", "invertPosition", "certified", "minSegmentTime", "arcFitTolerance", "maxJobTime", "maxGrowth", "indexEvery", "tiles"])
+
+def snapshot(coeffs, zMin, zMax, lineBreakDist, arcSegDist, invertPosition, certified, minSegmentTime, arcFitTolerance, maxJobTime=0.0, maxGrowth=0.0, indexEvery=0, tiles=None):
+	import numpy as np
+
+	coeffs = np.array(coeffs, dtype="float")
+	coeffs.flags.writeable = False
+	return LevelingJob(coeffs, float(zMin), float(zMax), float(lineBreakDist), float(arcSegDist), bool(invertPosition), bool(certified), float(minSegmentTime), float(arcFitTolerance), float(maxJobTime), float(maxGrowth), int(indexEvery), tiles)
+
+class JobAborted(Exception):
+	def __init__(self, reason):
+		self.reason = reason
+
+# raised to the jobs still waiting when the pool is closed, their folders are kept so they are resumed after the restart
+class PoolClosed(Exception):
+	pass
+
+# checked once per chunk of output, growth only counts once enough input was read for the ratio to mean something
+def checkBudget(job, started, written, inputOffset, cancelPath):
+	if cancelPath is not None and os.path.exists(cancelPath):
+		raise JobAborted("Cancelled")
+	if job.maxJobTime != 0.0 and time.time() - started > job.maxJobTime:
+		raise JobAborted("Took longer than {} s".format(job.maxJobTime))
+	if job.maxGrowth != 0.0 and written > job.maxGrowth * max(inputOffset, 1 << 20):
+		raise JobAborted("Output grew past {} times the input".format(job.maxGrowth))
+
+# the output has to be on disk before a checkpoint points past it
+def saveCheckpoint(checkpointDir, dest, preprocessor, welder, builder, written, seconds):
+	for output in (dest, builder.part if builder is not None else None):
+		if output is not None:
+			output.flush()
+			os.fsync(output.fileno())
+
+	state = dict(inputOffset=preprocessor.inputOffset, outputOffset=written, seconds=seconds, preprocessor=preprocessor.getState(),
+		welder=welder.getState() if welder is not None else None, index=builder.getState() if builder is not None else None)
+	with atomic_write(os.path.join(checkpointDir, "checkpoint.json"), mode="w") as checkpointFile:
+		json.dump(state, checkpointFile)
+		checkpointFile.flush()
+		os.fsync(checkpointFile.fileno())
+
+def loadCheckpoint(checkpointDir):
+	checkpointPath = os.path.join(checkpointDir, "checkpoint.json")
+	if not os.path.isfile(checkpointPath) or not os.path.isfile(os.path.join(checkpointDir, "output.part")):
+		return None
+	with open(checkpointPath) as checkpointFile:
+		return json.load(checkpointFile)
+
+# Runs in the worker processes of the plugin's pool and the batch command, errors come back as values since they are pickled
+# With a checkpoint folder the output is built in there and the full modal state is saved every checkpointInterval seconds,
+# so a job interrupted by a restart continues from its last checkpoint and still writes the same bytes
+# With an index path, a seek index of the output is saved there as well (see index.py)
+# With a flag path, the run follows the limits the plugin sets while printing (see governor.py)
+def levelPath(inPath, outPath, job, cancelPath=None, checkpointDir=None, checkpointInterval=10.0, indexPath=None, flagPath=None):
+	from octoprint_gcodeleveling.preprocessor import GcodePreProcessor, GcodeLevelingError
+	from octoprint_gcodeleveling.arcfit import ArcWelder
+	from octoprint_gcodeleveling import index
+
+	python_version = 3 if sys.version_info > (3, 5) else 2
+
+	started = time.time()
+	preprocessor = None
+	welder = None
+	builder = None
+	throttle = governor.Throttle(flagPath) if flagPath is not None else None
+	try:
+		checkBudget(job, started, 0, 0, cancelPath)
+		if throttle is not None:
+			throttle.update()
+
+		state = loadCheckpoint(checkpointDir) if checkpointDir is not None else None
+
+		with open(inPath, "rb") as src:
+			preprocessor = GcodePreProcessor(src, python_version, _logger, job.coeffs, job.zMin, job.zMax, job.lineBreakDist, job.arcSegDist, job.invertPosition, certified=job.certified, minSegmentTime=job.minSegmentTime, tiles=job.tiles)
+			if job.arcFitTolerance != 0.0:
+				welder = ArcWelder(job.arcFitTolerance)
+
+			written = 0
+			if state is not None:
+				_logger.info("Resuming {} at line {} (byte {})".format(inPath, state['preprocessor']['lineNumber'], state['inputOffset']))
+				preprocessor.setState(state['preprocessor'])
+				if welder is not None:
+					welder.setState(state['welder'])
+				src.seek(state['inputOffset'])
+				written = state['outputOffset']
+				started -= state['seconds']
+
+			if indexPath is not None and job.indexEvery != 0:
+				indexPart = None
+				if checkpointDir is not None:
+					indexPart = open(os.path.join(checkpointDir, "index.part"), "r+b" if state is not None and state['index'] is not None else "wb")
+				builder = index.IndexBuilder(job.indexEvery, indexPart)
+				if state is not None and state['index'] is not None:
+					builder.setState(state['index'])
+
+			if checkpointDir is None:
+				# atomic_write drops the partial output if anything in here raises
+				output = atomic_write(outPath, mode="wb")
+			else:
+				partPath = os.path.join(checkpointDir, "output.part")
+				output = open(partPath, "r+b" if state is not None else "wb")
+
+			with output as dest:
+				# anything written after the checkpoint is produced again
+				dest.seek(written)
+				dest.truncate()
+
+				checkpointed = time.time()
+				pending = []
+				pendingBytes = 0
+				for line in iter(src.readline, b""):
+					if builder is not None:
+						builder.before(line, preprocessor, written + pendingBytes, welder is None or not len(welder.run))
+					out = preprocessor.process_line(line)
+					if builder is not None:
+						builder.after(preprocessor)
+					if out is None:
+						continue
+					if welder is not None:
+						out = welder.feedLines(out.decode("utf-8")).encode("utf-8")
+					pending.append(out)
+					pendingBytes += len(out)
+
+					if pendingBytes >= 1 << 16:
+						dest.write(b"".join(pending))
+						written += pendingBytes
+						pending = []
+						pendingBytes = 0
+
+						if throttle is not None:
+							throttle.pace()
+						# time spent waiting on a print does not count against the time budget
+						checkBudget(job, started + (throttle.slept if throttle is not None else 0.0), written, preprocessor.inputOffset, cancelPath)
+						if checkpointDir is not None and time.time() - checkpointed >= checkpointInterval:
+							saveCheckpoint(checkpointDir, dest, preprocessor, welder, builder, written, time.time() - started)
+							checkpointed = time.time()
+
+				if welder is not None:
+					# whatever the welder still holds goes at the end
+					pending.append(welder.flush().encode("utf-8"))
+				dest.write(b"".join(pending))
+				written += sum(len(out) for out in pending)
+
+			if builder is not None:
+				indexFolder = os.path.dirname(indexPath)
+				if not os.path.isdir(indexFolder):
+					os.makedirs(indexFolder)
+				builder.save(indexPath, preprocessor.lineNumber, written)
+
+			if checkpointDir is not None:
+				shutil.move(partPath, outPath)
+				checkpointPath = os.path.join(checkpointDir, "checkpoint.json")
+				if os.path.exists(checkpointPath):
+					os.remove(checkpointPath)
+			os.chmod(outPath, octoprint.filemanager.util.AbstractFileWrapper.DEFAULT_PERMISSIONS & ~octoprint.filemanager.util.UMASK)
+	except (GcodeLevelingError, JobAborted) as e:
+		if isinstance(e, JobAborted):
+			error, message = "Leveling aborted", e.reason
+		else:
+			error, message = e.expression, e.message
+		offset = preprocessor.inputOffset if preprocessor is not None else 0
+		line = preprocessor.lineNumber if preprocessor is not None else 0
+		return dict(path=inPath, error=error, message=message, offset=offset, line=line, aborted=isinstance(e, JobAborted))
+	finally:
+		if builder is not None and builder.part is not None:
+			builder.part.close()
+		if throttle is not None:
+			throttle.release()
+
+	result = dict(path=inPath, output=outPath, seconds=time.time() - started, inBytes=os.path.getsize(inPath), outBytes=os.path.getsize(outPath),
+		limitedMoves=preprocessor.limitedMoves, droppedSegments=preprocessor.droppedSegments, limitDeviation=preprocessor.limitDeviation, arcs=0, weldedLines=0,
+		indexEntries=len(builder) if builder is not None else 0)
+	if welder is not None:
+		result['arcs'] = welder.arcs
+		result['weldedLines'] = welder.weldedLines
+	return result
+
+# the worker leaves its pid in the job folder, so the server can tell a job still running from one whose worker died
+def claimJob(jobDir):
+	with open(os.path.join(jobDir, "worker.pid"), "w") as pidFile:
+		pidFile.write(str(os.getpid()))
+
+def _levelPath(args):
+	claimJob(args[4])
+	return levelPath(*args)
+
+# dry runs go through the same workers, so they get the same priority and throttle as leveling
+def _analyzePath(args):
+	from octoprint_gcodeleveling import analysis
+
+	claimJob(args[0])
+	return analysis.analyzePath(*args[1:])
+
+# the snapshot is kept next to the job's input, so an interrupted job can be queued again after a restart
+def saveJob(jobDir, name, path, job, indexPath=None):
+	fields = job._asdict()
+	fields['coeffs'] = job.coeffs.tolist()
+	with atomic_write(os.path.join(jobDir, "job.json"), mode="w") as jobFile:
+		json.dump(dict(name=name, path=path, job=fields, indexPath=indexPath), jobFile)
+
+def loadJob(jobDir):
+	with open(os.path.join(jobDir, "job.json")) as jobFile:
+		info = json.load(jobFile)
+	info['job'] = snapshot(**info['job'])
+	info.setdefault('indexPath', None)
+	return info
+
+# Queues a job on the pool and reports how it went, failures are raised as a GcodeLevelingError
+def runJob(pool, jobId, name, inPath, outPath, job, logger, notify, indexPath=None):
+	from octoprint_gcodeleveling.preprocessor import GcodeLevelingError
+
+	logger.info("Gcode PreProcessing of {} queued as job {}".format(name, jobId))
+	notify("jobStarted", id=jobId, path=name)
+	result = pool.run(jobId, name, inPath, outPath, job, indexPath=indexPath)
+
+	if "error" in result:
+		reason = "{} at line {} (byte {})".format(result['message'], result['line'], result['offset'])
+		logger.info("Gcode PreProcessing of {} failed: {}, {}".format(name, result['error'], reason))
+		notify("jobFailed", id=jobId, path=name, error=result['error'], reason=reason, line=result['line'], offset=result['offset'], aborted=result['aborted'])
+		raise GcodeLevelingError(result['error'], reason)
+
+	logger.info("Gcode PreProcessing of {} finished in {}s".format(name, round(result['seconds'], 2)))
+	if result['arcs']:
+		logger.info("Arc fitting welded {} lines into {} arcs".format(result['weldedLines'], result['arcs']))
+	if result['limitedMoves']:
+		logger.info("Segment limit merged {} segments on {} moves (max deviation {} mm)".format(result['droppedSegments'], result['limitedMoves'], round(result['limitDeviation'], 4)))
+	notify("jobFinished", id=jobId, path=name, seconds=result['seconds'])
+	return result
+
+# Bounded pool of worker processes, created on the first job
+# Each job gets a folder holding its input, snapshot, partial output and checkpoint until it is discarded
+class JobPool():
+	def __init__(self, folder, size=None, checkpointInterval=10.0, niceness=0, flagPath=None, pollInterval=1.0):
+		self.folder = folder
+		self.size = size or multiprocessing.cpu_count()
+		self.checkpointInterval = checkpointInterval
+		# how often a waiting job checks on its worker
+		self.pollInterval = pollInterval
+		# takes effect when the workers are started, on the first job
+		self.niceness = niceness
+		self.flagPath = flagPath
+		self.pool = None
+		self.closed = False
+		self.lock = threading.Lock()
+		self.jobs = collections.OrderedDict()
+
+	def jobDir(self, jobId):
+		return os.path.join(self.folder, jobId)
+
+	def cancelPath(self, jobId):
+		return os.path.join(self.jobDir(jobId), "cancel")
+
+	def pidPath(self, jobId):
+		return os.path.join(self.jobDir(jobId), "worker.pid")
+
+	# a job nobody has picked up yet has no pid, it is waiting on the queue
+	def workerAlive(self, jobId):
+		try:
+			with open(self.pidPath(jobId)) as pidFile:
+				pid = int(pidFile.read())
+		except (IOError, OSError, ValueError):
+			return True
+		return pid in [worker.pid for worker in multiprocessing.active_children()]
+
+	def create(self, jobId):
+		jobDir = self.jobDir(jobId)
+		if not os.path.isdir(jobDir):
+			os.makedirs(jobDir)
+		return jobDir
+
+	def discard(self, jobId):
+		shutil.rmtree(self.jobDir(jobId), ignore_errors=True)
+
+	# jobs left behind by a restart, oldest first, folders that never got as far as a snapshot are dropped
+	def interrupted(self):
+		if not os.path.isdir(self.folder):
+			return []
+
+		found = []
+		for jobId in os.listdir(self.folder):
+			if os.path.isfile(os.path.join(self.jobDir(jobId), "job.json")):
+				found.append(jobId)
+			else:
+				self.discard(jobId)
+		return sorted(found, key=lambda jobId: os.path.getmtime(os.path.join(self.jobDir(jobId), "job.json")))
+
+	def run(self, jobId, name, inPath, outPath, job, indexPath=None):
+		return self.apply(jobId, name, inPath, _levelPath, (inPath, outPath, job, self.cancelPath(jobId), self.jobDir(jobId), self.checkpointInterval, indexPath, self.flagPath))
+
+	# the dry run's statistics, see analysis.analyzePath
+	def analyze(self, jobId, name, inPath, compressed, job, sampleEvery):
+		return self.apply(jobId, name, inPath, _analyzePath, (self.jobDir(jobId), inPath, compressed, job, sampleEvery, self.flagPath))
+
+	def apply(self, jobId, name, inPath, task, args):
+		with self.lock:
+			if self.pool is None:
+				# spawned workers do not inherit the server's threads and sockets like forked ones would
+				context = multiprocessing.get_context("spawn") if hasattr(multiprocessing, "get_context") else multiprocessing
+				self.pool = context.Pool(self.size, initializer=governor.lowerPriority, initargs=(self.niceness,))
+				self.closed = False
+			self.create(jobId)
+			# left by the run that was interrupted, if this is a resumed job
+			if os.path.exists(self.pidPath(jobId)):
+				os.remove(self.pidPath(jobId))
+			self.jobs[jobId] = dict(id=jobId, path=name, queued=time.time())
+			result = self.pool.apply_async(task, (args,))
+
+		try:
+			# a worker killed mid job (e.g. out of memory) is replaced by the pool, but its job never comes back
+			while not result.ready():
+				result.wait(self.pollInterval)
+				if result.ready():
+					break
+				if self.closed:
+					raise PoolClosed()
+				if not self.workerAlive(jobId):
+					return dict(path=inPath, error="Leveling failed", message="The worker process exited", offset=0, line=0, aborted=False)
+			return result.get()
+		finally:
+			with self.lock:
+				del self.jobs[jobId]
+			if os.path.exists(self.cancelPath(jobId)):
+				os.remove(self.cancelPath(jobId))
+
+	# the worker notices the sentinel file at its next budget check, a queued job stops as soon as it starts
+	def cancel(self, jobId):
+		with self.lock:
+			if jobId not in self.jobs:
+				return False
+			open(self.cancelPath(jobId), "w").close()
+			return True
+
+	def status(self):
+		with self.lock:
+			pending = len(self.jobs)
+			return dict(size=self.size, started=self.pool is not None, active=min(pending, self.size), queued=max(0, pending - self.size), jobs=list(self.jobs.values()),
+				throttled=self.flagPath is not None and os.path.exists(self.flagPath))
+
+	def close(self):
+		with self.lock:
+			self.closed = True
+			if self.pool is not None:
+				self.pool.terminate()
+				self.pool.join()
+				self.pool = None
+
+# Handed to OctoPrint instead of a processing stream, the file is leveled by the pool when storage saves it
+class LevelingJobWrapper(octoprint.filemanager.util.AbstractFileWrapper):
+	def __init__(self, filename, file_object, job, pool, logger, notify=None, storagePath=None, indexPath=None):
+		octoprint.filemanager.util.AbstractFileWrapper.__init__(self, filename)
+		self.file_object = file_object
+		self.job = job
+		self.pool = pool
+		self._logger = logger
+		self.notify = notify if notify is not None else (lambda state, **data: None)
+		# where the file goes in OctoPrint's storage, only jobs that know it can be resumed after a restart
+		self.storagePath = storagePath
+		self.indexPath = indexPath
+
+	def save(self, path, permissions=None):
+		jobId = uuid.uuid4().hex
+		jobDir = self.pool.create(jobId)
+
+		# the job keeps its own input, the upload's temporary file is gone after a restart
+		inPath = os.path.join(jobDir, "input.gcode")
+		if isinstance(self.file_object, octoprint.filemanager.util.DiskFileWrapper):
+			try:
+				os.link(self.file_object.path, inPath)
+			except OSError:
+				shutil.copyfile(self.file_object.path, inPath)
+		else:
+			# workers read from disk, so streamed uploads (e.g. relevel) are spooled first
+			with open(inPath, "wb") as spool:
+				source = self.file_object.stream()
+				try:
+					shutil.copyfileobj(source, spool)
+				finally:
+					source.close()
+
+		if self.storagePath is not None:
+			saveJob(jobDir, self.filename, self.storagePath, self.job, self.indexPath)
+
+		try:
+			runJob(self.pool, jobId, self.filename, inPath, path, self.job, self._logger, self.notify, indexPath=self.indexPath)
+		except PoolClosed:
+			raise
+		except Exception:
+			self.pool.discard(jobId)
+			raise
+		self.pool.discard(jobId)
+
+		if permissions is not None:
+			os.chmod(path, permissions)
+
+	def stream(self):
+		handle, leveled = tempfile.mkstemp(suffix=".gcode")
+		os.close(handle)
+		try:
+			self.save(leveled)
+			return open(leveled, "rb")
+		finally:
+			# the open handle keeps the data readable on posix
+			os.remove(leveled)
@@ -1,6 +1,5 @@
 import math, random, time
-import numpy as np
-from octoprint_gcodeleveling.twoDimFit import twoDpolyEval
+from octoprint_gcodeleveling.geometry import add, sub, dot, norm, rotateVector
 
 threshold = 0.005
 
@@ -17,12 +16,13 @@ class PathWiseMaximizer():
 			return (False, False)
 
 class SingleGradientAscent(PathWiseMaximizer):
-	def __init__(self, ds=0.00001, step=10.0, telos=0.01, point=0.5, lvl=200):
+	def __init__(self, ds=0.00001, step=10.0, telos=0.01, point=0.5, lvl=200, samples=7):
 		self.sMin = ds
 		self.step = step
 		self.telos = telos
 		self.point = point
 		self.lvl = lvl
+		self.samples = samples
 
 	def optimize(self, value, first, second):
 		q = self.point
@@ -39,8 +39,17 @@ class SingleGradientAscent(PathWiseMaximizer):
 			tp, tv = self.testPoint(value, q)
 			if (tp):
 				return tp
-			else:
-				return None
+
+		# the full steps can overshoot off the path or settle short of the peak, and where they go changes with the last bits of the slope
+		# so fixed points along the move are checked before it is taken as flat
+		return self.sampled(value)
+
+	def sampled(self, value):
+		samples = [float(ind) / (self.samples + 1) for ind in range(1, self.samples + 1)]
+		q = max(samples, key=value)
+		tp, tv = self.testPoint(value, q)
+		if (tp):
+			return tp
 		else:
 			return None
 
@@ -64,150 +73,171 @@ def der(coeffs):
 
 	return dict(x = xPartial, y = yPartial)
 
-def polySqrGradient(coeffs, x, y):
-	return np.array((2*twoDpolyEval(coeffs, x, y)*twoDpolyEval(der(coeffs)['x'], x, y),
-			2*twoDpolyEval(coeffs, x, y)*twoDpolyEval(der(coeffs)['y'], x, y)))
-
-def polySqr2ndDerivative(coeffs, x, y):
-	return np.array((
+# model is the compiled model (see evaluators), plane the (a, b, d) taken off it: z - a*x - b*y - d
+def planeHeight(model, plane, x, y):
+	return model.value(x, y) - plane[0]*x - plane[1]*y - plane[2]
+
+def polySqrGradient(model, plane, x, y):
+	z = planeHeight(model, plane, x, y)
+	gx, gy = model.gradient(x, y)
+	return (2*z*(gx - plane[0]),
+			2*z*(gy - plane[1]))
+
+def polySqr2ndDerivative(model, plane, x, y):
+	z = planeHeight(model, plane, x, y)
+	gx, gy = model.gradient(x, y)
+	gx -= plane[0]
+	gy -= plane[1]
+	xx, yy, xy = model.hessian(x, y)
+	return (
 	# xx
-	2*twoDpolyEval(der(coeffs)['x'], x, y)*twoDpolyEval(der(coeffs)['x'], x, y)
-	+ 2*twoDpolyEval(coeffs, x, y)*twoDpolyEval(der(der(coeffs)['x'])['x'], x, y),
+	2*gx*gx + 2*z*xx,
 	# yy
-	2*twoDpolyEval(der(coeffs)['y'], x, y)*twoDpolyEval(der(coeffs)['y'], x, y)
-	+ 2*twoDpolyEval(coeffs, x, y)*twoDpolyEval(der(der(coeffs)['y'])['y'], x, y),
+	2*gy*gy + 2*z*yy,
 	# xy
-	2*twoDpolyEval(der(coeffs)['y'], x, y)*twoDpolyEval(der(coeffs)['x'], x, y)
-	+ 2*twoDpolyEval(coeffs, x, y)*twoDpolyEval(der(der(coeffs)['x'])['y'], x, y)
-	))
+	2*gy*gx + 2*z*xy
+	)
 
-def newtonHeight(coeffs, lmbd, start, heading, off):
+def newtonHeight(model, plane, lmbd, start, heading, off):
 	h = heading(lmbd)
-	x, y = start + off(lmbd)
+	x, y = add(start, off(lmbd))
 
-	return np.dot(polySqrGradient(coeffs, x, y), h)
+	return dot(polySqrGradient(model, plane, x, y), h)
 
-def newtonSlope(coeffs, lmbd, start, heading, off):
+def newtonSlope(model, plane, lmbd, start, heading, off):
 	h = heading(lmbd)
-	x, y = start + off(lmbd)
+	x, y = add(start, off(lmbd))
 
-	return np.dot(polySqr2ndDerivative(coeffs, x, y), np.array((h[0]**2, h[1]**2, 2*h[0]*h[1])))
+	xx, yy, xy = polySqr2ndDerivative(model, plane, x, y)
+	return xx*h[0]**2 + yy*h[1]**2 + xy*2*h[0]*h[1]
 
 # segments a line into the minimum set required
-def lineWiseMaxima(coeffs, start, end, pwm):
+def lineWiseMaxima(model, start, end, pwm):
 	# print("LWM ({}) ({})".format(start, end))
 	outLines = []
 
-	c = coeffs.copy()
-
-	endZ = twoDpolyEval(c, end[0], end[1])
-	startZ = twoDpolyEval(c, start[0], start[1])
+	endZ = model.value(end[0], end[1])
+	startZ = model.value(start[0], start[1])
 
-	line = np.array((end[0]-start[0], end[1]-start[1]))
-	magLine = np.linalg.norm(line)
-	normLine = line/magLine
+	line = sub(end, start)
+	magLine = norm(line)
+	normLine = (line[0]/magLine, line[1]/magLine)
 
-	# compute height delta properly remove it from coeffs
-	c[1, 0] -= normLine[0] * (endZ-startZ) / magLine
-	c[0, 1] -= normLine[1] *  (endZ-startZ) / magLine
+	# take the straight line from the start height to the end height off the model
+	slopeX = normLine[0] * (endZ-startZ) / magLine
+	slopeY = normLine[1] * (endZ-startZ) / magLine
+	plane = (slopeX, slopeY, startZ - slopeX*start[0] - slopeY*start[1])
 
-	# compute height at start and subtract it from (0,0) coeff
-	c[0, 0] -= twoDpolyEval(c, start[0], start[1])
+	lineHeading = lambda lmd : line
+	lineOffset = lambda lmd : (lmd * line[0], lmd * line[1])
 
-	lineHeading = lambda lmd : np.array((end[0]-start[0], end[1]-start[1]))
-	lineOffset = lambda lmd : lmd * lineHeading(lmd)
-
-	lineSqr = lambda lmd : twoDpolyEval(c, lineOffset(lmd)[0]+start[0], lineOffset(lmd)[1]+start[1])**2
-	first = lambda lmd : newtonHeight(c, lmd, start, lineHeading, lineOffset)
-	second = lambda lmd : newtonSlope(c, lmd, start, lineHeading, lineOffset)
+	lineSqr = lambda lmd : planeHeight(model, plane, lineOffset(lmd)[0]+start[0], lineOffset(lmd)[1]+start[1])**2
+	first = lambda lmd : newtonHeight(model, plane, lmd, start, lineHeading, lineOffset)
+	second = lambda lmd : newtonSlope(model, plane, lmd, start, lineHeading, lineOffset)
 
 	q = pwm.optimize(lineSqr, first, second)
 
 	if (q is not None):
-		x, y = start + lineOffset(q)
-		middle = np.array((x, y))
+		middle = add(start, lineOffset(q))
 
-		outLines.extend(lineWiseMaxima(coeffs, start, middle, pwm))
-		outLines.extend(lineWiseMaxima(coeffs, middle, end, pwm))
+		outLines.extend(lineWiseMaxima(model, start, middle, pwm))
+		outLines.extend(lineWiseMaxima(model, middle, end, pwm))
 	else:
 		outLines.append([start, end])
 
 	return outLines
 
-def rotateVector(theta, vec):
-	rotArray = np.array(((math.cos(theta),-math.sin(theta)),(math.sin(theta),math.cos(theta))))
-	return np.matmul(rotArray, vec)
+# The search for the worst point of a move starts from its middle, on a tiled model it can miss a bend at a seam of the model (see tiling.py)
+# So the pieces it leaves are checked where they cross a seam, and cut there if they still miss the surface
+def seamCuts(model, start, end):
+	xSeams, ySeams = model.seams
+	startZ = model.value(start[0], start[1])
+	endZ = model.value(end[0], end[1])
+	line = sub(end, start)
+
+	cuts = set()
+	for axis, seams in ((0, xSeams), (1, ySeams)):
+		for seam in seams:
+			if (start[axis] - seam) * (end[axis] - seam) < 0:
+				q = (seam - start[axis]) / (end[axis] - start[axis])
+				if (model.value(start[0] + q*line[0], start[1] + q*line[1]) - startZ - q*(endZ - startZ))**2 >= threshold:
+					cuts.add(q)
+	return [add(start, (q * line[0], q * line[1])) for q in sorted(cuts)]
+
+def seamWiseMaxima(model, start, end, pwm):
+	if not len(model.seams[0]) and not len(model.seams[1]):
+		return lineWiseMaxima(model, start, end, pwm)
+
+	outLines = []
+	for pieceStart, pieceEnd in lineWiseMaxima(model, start, end, pwm):
+		cuts = seamCuts(model, pieceStart, pieceEnd)
+		if not len(cuts):
+			outLines.append([pieceStart, pieceEnd])
+			continue
+
+		points = [pieceStart] + cuts + [pieceEnd]
+		for cutStart, cutEnd in zip(points[:-1], points[1:]):
+			outLines.extend(seamWiseMaxima(model, cutStart, cutEnd, pwm))
+	return outLines
 
 # D(x,y)/Dtheta
 def radiusGradient(arcAngle, radius):
-	mag = np.linalg.norm(radius)
-	normRadius = radius / mag
+	mag = norm(radius)
 
-	theta = math.atan2(normRadius[1], normRadius[0]) + arcAngle
+	theta = math.atan2(radius[1] / mag, radius[0] / mag) + arcAngle
 
-	return np.array((-mag*math.sin(theta), mag*math.cos(theta)))
+	return (-mag*math.sin(theta), mag*math.cos(theta))
 
 def radius2ndDer(arcAngle, radius):
-	mag = np.linalg.norm(radius)
-	normRadius = radius / mag
+	mag = norm(radius)
 
-	theta = math.atan2(normRadius[1], normRadius[0]) + arcAngle
+	theta = math.atan2(radius[1] / mag, radius[0] / mag) + arcAngle
 
-	return np.array((-mag*math.cos(theta), -mag*math.sin(theta)))
+	return (-mag*math.cos(theta), -mag*math.sin(theta))
 
-def arcDistSqr(coeffs, center, radius, arcAngle, zDelta, q):
-	point = rotateVector(arcAngle*q, radius) + center
-	# print(point, "q", q, twoDpolyEval(coeffs, point[0], point[1]))
-	return (twoDpolyEval(coeffs, point[0], point[1]) - zDelta*q)**2
+# startZ is the model height at the start of the arc, taken off so the arc starts at 0
+def arcDistSqr(model, startZ, center, radius, arcAngle, zDelta, q):
+	point = add(rotateVector(arcAngle*q, radius), center)
+	return (model.value(point[0], point[1]) - startZ - zDelta*q)**2
 
-def adsDer(coeffs, center, radius, arcAngle, zDelta, q):
-	point = rotateVector(arcAngle*q, radius) + center
-	gradient = np.array((twoDpolyEval(der(coeffs)['x'], point[0], point[1]),
-	 					twoDpolyEval(der(coeffs)['y'], point[0], point[1])))
+def adsDer(model, startZ, center, radius, arcAngle, zDelta, q):
+	point = add(rotateVector(arcAngle*q, radius), center)
+	gradient = model.gradient(point[0], point[1])
 	heading = radiusGradient(q*arcAngle, radius)
 	# print(point, gradient)
 
-	# return np.dot(polySqrGradient(coeffs, point[0], point[1]), heading)
-	return 2*(twoDpolyEval(coeffs, point[0], point[1]) - zDelta*q)*(np.dot(gradient, heading) - zDelta)
+	return 2*(model.value(point[0], point[1]) - startZ - zDelta*q)*(dot(gradient, heading) - zDelta)
 
-def ads2ndDer(coeffs, center, radius, arcAngle, zDelta, q):
-	point = rotateVector(arcAngle*q, radius) + center
-	gradient = np.array((twoDpolyEval(der(coeffs)['x'], point[0], point[1]),
-	 					twoDpolyEval(der(coeffs)['y'], point[0], point[1])))
+def ads2ndDer(model, startZ, center, radius, arcAngle, zDelta, q):
+	point = add(rotateVector(arcAngle*q, radius), center)
+	gradient = model.gradient(point[0], point[1])
 	heading = radiusGradient(q*arcAngle, radius)
 
-	grad2 = np.array((twoDpolyEval(der(der(coeffs)['x'])['x'], point[0], point[1]),
-					  twoDpolyEval(der(der(coeffs)['y'])['y'], point[0], point[1]),
-					  twoDpolyEval(der(der(coeffs)['x'])['y'], point[0], point[1])*2))
-	head2 = np.array((heading[0], heading[1], heading[0]*heading[1]))
+	grad2xx, grad2yy, grad2xy = model.hessian(point[0], point[1])
+	grad2xy *= 2
 
-	prodA = (np.dot(gradient, heading) - zDelta)**2
-	# np.dot(gradient, heading)
-	pordBee = np.dot(grad2, head2) + np.dot(gradient, radius2ndDer(arcAngle*q, radius))
-	prodB = (twoDpolyEval(coeffs, point[0], point[1]) - zDelta*q)*pordBee
+	prodA = (dot(gradient, heading) - zDelta)**2
+	# dot(gradient, heading)
+	pordBee = grad2xx*heading[0] + grad2yy*heading[1] + grad2xy*heading[0]*heading[1] + dot(gradient, radius2ndDer(arcAngle*q, radius))
+	prodB = (model.value(point[0], point[1]) - startZ - zDelta*q)*pordBee
 
 	return (2*prodA+2*prodB)
 
 # segments an arc into the minimum set required
-def flatArcWiseMaxima(coeffs, center, radius, arcAngle, qin, qend, pwm):
+def flatArcWiseMaxima(model, center, radius, arcAngle, qin, qend, pwm):
 	# print(center+radius, center, arcAngle)
-	center = np.array(center)
-	radius = np.array(radius)
-	c = coeffs.copy()
 	outArcs = []
 
-	start = center + radius
-	end = center + rotateVector(arcAngle, radius)
+	start = add(center, radius)
+	end = add(center, rotateVector(arcAngle, radius))
 
-	endZ = twoDpolyEval(c, end[0], end[1])
-	startZ = twoDpolyEval(c, start[0], start[1])
+	endZ = model.value(end[0], end[1])
+	startZ = model.value(start[0], start[1])
 	deltaZ = endZ-startZ
 
-	c[0, 0] -= twoDpolyEval(c, start[0], start[1])
-
-	value = lambda lmd : arcDistSqr(c, center, radius, arcAngle, deltaZ, lmd)
-	first = lambda lmd : adsDer(c, center, radius, arcAngle, deltaZ, lmd)
-	second = lambda lmd : ads2ndDer(c, center, radius, arcAngle, deltaZ, lmd)
+	value = lambda lmd : arcDistSqr(model, startZ, center, radius, arcAngle, deltaZ, lmd)
+	first = lambda lmd : adsDer(model, startZ, center, radius, arcAngle, deltaZ, lmd)
+	second = lambda lmd : ads2ndDer(model, startZ, center, radius, arcAngle, deltaZ, lmd)
 
 
 	q = pwm.optimize(value, first, second)
@@ -215,9 +245,65 @@ def flatArcWiseMaxima(coeffs, center, radius, arcAngle, qin, qend, pwm):
 	if (q is not None):
 		middle = arcAngle * q
 		# print("breaking at {}".format(q))
-		outArcs.extend(flatArcWiseMaxima(coeffs, center, radius, middle-0, qin, qin+(qend-qin)*q, pwm))
-		outArcs.extend(flatArcWiseMaxima(coeffs, center, rotateVector(middle, radius),
+		outArcs.extend(flatArcWiseMaxima(model, center, radius, middle-0, qin, qin+(qend-qin)*q, pwm))
+		outArcs.extend(flatArcWiseMaxima(model, center, rotateVector(middle, radius),
 										arcAngle-middle, qin+(qend-qin)*q, qend, pwm))
 	else:
 		outArcs.append([start, center, arcAngle, qin, qend])
 	return outArcs
+
+# angles along an arc where it crosses the line coordinate == seam, coordinate 0 is x and 1 is y
+def arcCrossings(center, radius, arcAngle, coordinate, seam):
+	mag = norm(radius)
+	ratio = (seam - center[coordinate]) / mag
+	if abs(ratio) >= 1.0:
+		return []
+
+	startAngle = math.atan2(radius[1], radius[0])
+	if coordinate == 0:
+		angles = (math.acos(ratio), -math.acos(ratio))
+	else:
+		angles = (math.asin(ratio), math.pi - math.asin(ratio))
+
+	crossings = []
+	for angle in angles:
+		turn = (angle - startAngle) % (2*math.pi)
+		if arcAngle < 0:
+			turn -= 2*math.pi
+		if 0 < abs(turn) < abs(arcAngle):
+			crossings.append(turn)
+	return crossings
+
+# the same for the pieces of an arc
+def seamArcCuts(model, center, radius, arcAngle):
+	xSeams, ySeams = model.seams
+	start = add(center, radius)
+	end = add(center, rotateVector(arcAngle, radius))
+	startZ = model.value(start[0], start[1])
+	deltaZ = model.value(end[0], end[1]) - startZ
+
+	cuts = set()
+	for coordinate, seams in ((0, xSeams), (1, ySeams)):
+		for seam in seams:
+			for angle in arcCrossings(center, radius, arcAngle, coordinate, seam):
+				if arcDistSqr(model, startZ, center, radius, arcAngle, deltaZ, angle / arcAngle) >= threshold:
+					cuts.add(angle)
+	return sorted(cuts, key=abs)
+
+def seamWiseArcMaxima(model, center, radius, arcAngle, pwm, qin=0, qend=1):
+	if not len(model.seams[0]) and not len(model.seams[1]):
+		return flatArcWiseMaxima(model, center, radius, arcAngle, qin, qend, pwm)
+
+	outArcs = []
+	for start, pieceCenter, pieceAngle, pieceIn, pieceEnd in flatArcWiseMaxima(model, center, radius, arcAngle, qin, qend, pwm):
+		pieceRadius = sub(start, center)
+		cuts = seamArcCuts(model, center, pieceRadius, pieceAngle)
+		if not len(cuts):
+			outArcs.append([start, pieceCenter, pieceAngle, pieceIn, pieceEnd])
+			continue
+
+		angles = [0.0] + cuts + [pieceAngle]
+		for cutStart, cutEnd in zip(angles[:-1], angles[1:]):
+			outArcs.extend(seamWiseArcMaxima(model, center, rotateVector(cutStart, pieceRadius), cutEnd - cutStart, pwm,
+											pieceIn + (pieceEnd - pieceIn) * cutStart / pieceAngle, pieceIn + (pieceEnd - pieceIn) * cutEnd / pieceAngle))
+	return outArcs
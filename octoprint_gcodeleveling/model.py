@@ -0,0 +1,102 @@
+import hashlib, json, os
+
+from octoprint.util import atomic_write
+
+from octoprint_gcodeleveling import evaluators
+
+# numpy, twoDimFit and maxima are imported inside the functions below, so keys can be computed without loading them
+
+# A fitted model is identified by the points, degrees and tiles it was fit from
+def modelKey(points, xDeg, yDeg, tileCount=(1, 1)):
+	description = dict(points=[[float(coor) for coor in point] for point in points], degree=[int(xDeg), int(yDeg)])
+	# untiled models keep the keys they were cached under before tiles existed
+	if tuple(tileCount) != (1, 1):
+		description['tiles'] = [int(tileCount[0]), int(tileCount[1])]
+	return hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+def derivativeTables(coeffs):
+	from octoprint_gcodeleveling import maxima
+
+	first = maxima.der(coeffs)
+	return dict(
+		x=first['x'],
+		y=first['y'],
+		xx=maxima.der(first['x'])['x'],
+		yy=maxima.der(first['y'])['y'],
+		xy=maxima.der(first['x'])['y']
+	)
+
+# coeffs is the single polynomial over the whole bed, tiles the tiled model leveling uses instead when there is one (see tiling.py)
+class LevelingModel():
+	def __init__(self, key, coeffs, derivatives=None, tiles=None):
+		self.key = key
+		self.coeffs = coeffs
+		self.derivatives = derivatives if derivatives is not None else derivativeTables(coeffs)
+		self.tiles = tiles
+		# compiled as the model is built, so the first file leveled with it does not pay for it
+		self.compiled = evaluators.forModel(coeffs, tiles, self.derivatives)
+
+# Fitted models kept in memory and persisted in the plugin data folder, so restarts and profile switches skip the fit
+class ModelCache():
+	def __init__(self, folder):
+		self.folder = folder
+		self.models = {}
+
+	def path(self, key):
+		return os.path.join(self.folder, key + ".npz")
+
+	def get(self, points, xDeg, yDeg, tileCount=(1, 1)):
+		from octoprint_gcodeleveling import twoDimFit, tiling
+
+		key = modelKey(points, xDeg, yDeg, tileCount)
+
+		model = self.load(key)
+		if model is None:
+			tiles = None
+			if tuple(tileCount) != (1, 1):
+				tiles = tiling.fitTiles(points, int(xDeg), int(yDeg), int(tileCount[0]), int(tileCount[1]))
+			model = LevelingModel(key, twoDimFit.twoDpolyFit(points, int(xDeg), int(yDeg)), tiles=tiles)
+			self.store(model)
+		return model
+
+	def load(self, key):
+		import numpy as np
+
+		if key in self.models:
+			return self.models[key]
+
+		path = self.path(key)
+		if not os.path.isfile(path):
+			return None
+
+		with np.load(path, allow_pickle=False) as data:
+			derivatives = dict((name, data[name].tolist()) for name in ("x", "y", "xx", "yy", "xy"))
+			tiles = json.loads(str(data["tiles"])) if "tiles" in data.files else None
+			model = LevelingModel(key, data["coeffs"], derivatives, tiles)
+
+		self.models[key] = model
+		return model
+
+	def store(self, model):
+		import numpy as np
+
+		self.models[model.key] = model
+
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+		arrays = dict((name, np.array(table, dtype="float")) for name, table in model.derivatives.items())
+		if model.tiles is not None:
+			arrays['tiles'] = np.array(json.dumps(model.tiles))
+		with atomic_write(self.path(model.key), mode="wb") as cacheFile:
+			np.savez(cacheFile, coeffs=model.coeffs, **arrays)
+
+	# drops every cached model that is not in use anymore
+	def prune(self, keep):
+		for key in list(self.models.keys()):
+			if key not in keep:
+				del self.models[key]
+
+		if os.path.isdir(self.folder):
+			for fileName in os.listdir(self.folder):
+				if fileName.endswith(".npz") and fileName[:-len(".npz")] not in keep:
+					os.remove(os.path.join(self.folder, fileName))
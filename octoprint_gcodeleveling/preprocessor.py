@@ -0,0 +1,495 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import re, math
+
+import octoprint.filemanager.util
+
+from octoprint_gcodeleveling import evaluators, maxima, geometry
+
+class GcodeLevelingError(Exception):
+	def __init__(self, expression, message):
+		self.expression = expression
+		self.message = message
+
+class GcodePreProcessor(octoprint.filemanager.util.LineProcessorStream):
+	def __init__(self, fileBufferedReader, python_version, logger, coeffs, zMin, zMax, lineBreakDist, arcSegDist, invertPosition, certified=False, minSegmentTime=0.0, tiles=None):
+		super(GcodePreProcessor, self).__init__(fileBufferedReader)
+		self.python_version = python_version
+		self._logger = logger
+		self.coeffs = coeffs
+		# the tiles of a tiled model replace the single polynomial of coeffs (see tiling.py)
+		self.model = evaluators.forModel(coeffs, tiles)
+		self.zMin = zMin
+		self.zMax = zMax
+		# the whole file was proven to stay inside zMin and zMax before processing, so get_z skips the bounds check
+		self.certified = certified
+		self.lineBreakDist = lineBreakDist**2
+		self.arcSegDist = arcSegDist
+		self.invertPosition = invertPosition
+		# subdivided moves keep each segment at least this many seconds long at the current feedrate (0 disables)
+		self.minSegmentTime = minSegmentTime
+
+		self.limitedMoves = 0
+		self.droppedSegments = 0
+		self.limitDeviation = 0.0
+		self.limitsReported = False
+
+		# where in the input the preprocessor is, for progress and error reports
+		self.lineNumber = 0
+		self.inputOffset = 0
+
+		self.pwm = maxima.SingleGradientAscent()
+
+		self.moveCurr = "G0"
+
+		self.xPrev = 0.0
+		self.yPrev = 0.0
+		self.zPrev = 0.0
+		self.ePrev = 0.0
+
+		self.xCurr = 0.0
+		self.yCurr = 0.0
+		self.zCurr = 0.0
+
+		self.eCurr = 0.0
+		# last Z written to the output, None until the first leveled move
+		self.zOut = None
+
+		self.feedrate = None
+
+		self.eMode = "None"
+		self.moveMode = "Absolute"
+		self.workspacePlane = 0
+
+		self.workspacePlanes = ["G17", "G18", "G19"]
+
+		self.spareParts = ""
+
+
+		self.afterStart = False
+		self.positionFloating = False
+
+		self.move_pattern = re.compile("^G[0-3]\s")
+		self.move_mode_pattern = re.compile("^G9[0-1]")
+		self.pos_reset_pattern = re.compile("^G92")
+		self.set_workspace_plane = re.compile("^G1[7-9]")
+		self.extruder_mode_pattern = re.compile("^M8[2-3]")
+		self.comment_pattern = re.compile(";.*$")
+
+	# everything that carries over from one line to the next, so a checkpointed job can pick up where it stopped
+	stateFields = ("lineNumber", "inputOffset", "moveCurr", "xPrev", "yPrev", "zPrev", "ePrev", "xCurr", "yCurr", "zCurr", "eCurr", "zOut", "feedrate",
+		"eMode", "moveMode", "workspacePlane", "spareParts", "afterStart", "positionFloating", "limitedMoves", "droppedSegments", "limitDeviation")
+
+	def getState(self):
+		return dict((field, getattr(self, field)) for field in self.stateFields)
+
+	def setState(self, state):
+		for field in self.stateFields:
+			# checkpoints from before a field was added keep its starting value
+			setattr(self, field, state.get(field, getattr(self, field)))
+
+	def comment_split(self, line):
+		# Logic to seperate comments so they can be reattached after processing
+		if line.find(";") != -1:
+			comSplit = line.split(";")
+			activeCode = comSplit[0]
+			if len(comSplit) > 1:
+				for part in comSplit[1:]:
+						self.spareParts += ";" + part + " "
+
+			return activeCode
+		else:
+			return line
+
+	def move_dist(self):
+		return (self.xCurr-self.xPrev)**2 + (self.yCurr-self.yPrev)**2
+
+	def get_z(self, x, y, zOffset):
+		zNew = self.model.value(x, y) + (zOffset * (-1 if self.invertPosition else 1))
+
+		# a certified file can't leave the bounds, polyRange encloses the model over every point the scan saw
+		if not self.certified and (zNew < self.zMin or zNew > self.zMax):
+			self._logger.info("Failed Leveling Point: {}, {}, {}".format(str(x),str(y),str(zNew)))
+			raise GcodeLevelingError("Computed Z was outside of bounds", "Gcode Leveling config likely needs to be changed")
+		return round(zNew, 3)
+
+	# Merges subdivisions back together when a move would be split into more segments than the planner can take at its feedrate
+	# boundary(i) gives the point and path fraction the i-th piece starts at (i == len(pieces) is the end of the move)
+	def limit_segments(self, pieces, length, boundary, merge):
+		if self.minSegmentTime == 0.0 or not self.feedrate or len(pieces) < 2:
+			return pieces
+
+		allowed = max(1, int(length / (self.feedrate / 60.0) / self.minSegmentTime))
+		count = len(pieces)
+		if count <= allowed:
+			return pieces
+
+		kept = [0] + [int(round(k * count / float(allowed))) for k in range(1, allowed)] + [count]
+
+		limited = []
+		for first, last in zip(kept[:-1], kept[1:]):
+			limited.append(merge(pieces[first:last]))
+
+			# Z is interpolated linearly between the kept break points, the model's distance from that at a dropped one is the accuracy lost
+			startPoint, startQ = boundary(first)
+			endPoint, endQ = boundary(last)
+			startZ = self.model.value(startPoint[0], startPoint[1])
+			endZ = self.model.value(endPoint[0], endPoint[1])
+			for ind in range(first + 1, last):
+				point, q = boundary(ind)
+				expected = startZ + (endZ - startZ) * (q - startQ) / (endQ - startQ)
+				self.limitDeviation = max(self.limitDeviation, abs(self.model.value(point[0], point[1]) - expected))
+
+		self.limitedMoves += 1
+		self.droppedSegments += count - allowed
+		return limited
+
+	def limit_line(self, pieces, start, end, length):
+		return self.limit_segments(pieces, length,
+			lambda ind : (end, 1.0) if ind == len(pieces) else (pieces[ind][0], geometry.dist(start, pieces[ind][0]) / length),
+			lambda run : (run[0][0], run[-1][1]))
+
+	def limit_arc(self, pieces, length):
+		end = (self.xCurr, self.yCurr)
+		return self.limit_segments(pieces, length,
+			lambda ind : (end, 1.0) if ind == len(pieces) else (pieces[ind][0], pieces[ind][3]),
+			lambda run : [run[0][0], run[0][1], sum(piece[2] for piece in run), run[0][3], run[-1][4]])
+
+	def read(self, n=-1):
+		data = super(GcodePreProcessor, self).read(n)
+		if (n == -1 or not len(data)) and self.limitedMoves and not self.limitsReported:
+			self.limitsReported = True
+			self._logger.info("Segment limit merged {} segments on {} moves (max deviation {} mm)".format(self.droppedSegments, self.limitedMoves, round(self.limitDeviation, 4)))
+		return data
+
+	def createLine(self, prev, pos, zVal, eVal):
+		outLine = self.moveCurr
+
+		if pos[0] != prev[0]:
+				outLine += " X" + str(round(pos[0], 3))
+		if pos[1] != prev[1]:
+				outLine += " Y" + str(round(pos[1], 3))
+		self.zOut = self.get_z(pos[0], pos[1], zVal)
+		outLine += " Z" + str(self.zOut)
+
+		if self.eMode != "None":
+				outLine += " E" + str(round(eVal, 5))
+
+		outLine += " " + self.spareParts
+		self.spareParts = ""
+
+		outLine += "\n"
+
+		return outLine
+
+	def createArc(self, start, center, angle, eVal, zVal):
+		outLine = self.moveCurr
+
+		radius = geometry.sub(start, center)
+
+		end = geometry.add(center, geometry.rotateVector(angle, radius))
+
+		if end[0] != start[0]:
+			outLine += " X" + str(round(end[0], 3))
+		if end[1] != start[1]:
+			outLine += " Y" + str(round(end[1], 3))
+		self.zOut = self.get_z(end[0], end[1], zVal)
+		outLine += " Z" + str(self.zOut)
+
+		outLine += " I" + str(round(-radius[0], 3))
+		outLine += " J" + str(round(-radius[1], 3))
+		if self.eMode != "None":
+			outLine += " E" + str(round(eVal, 5))
+		outLine += " " + self.spareParts
+		self.spareParts = ""
+
+		outLine += "\n"
+
+		return outLine
+
+	def reconstruct_line(self):
+		outLine = self.moveCurr
+
+		if self.xCurr != self.xPrev:
+			outLine += " X" + str(round(self.xCurr, 3))
+		if self.yCurr != self.yPrev:
+			outLine += " Y" + str(round(self.yCurr, 3))
+		self.zOut = self.get_z(self.xCurr, self.yCurr, self.zCurr)
+		outLine += " Z" + str(self.zOut)
+
+		if self.eMode != "None":
+			outLine += " E" + str(round(self.eCurr, 5))
+
+		outLine += " " + self.spareParts
+		self.spareParts = ""
+
+		outLine += "\n"
+
+		return outLine
+
+	def reconstruct_arc(self, arcI, arcJ, arcR):
+		outLine = self.moveCurr
+
+		outLine += " X" + str(round(self.xCurr, 3))
+		outLine += " Y" + str(round(self.yCurr, 3))
+		outLine += " Z" + str(self.get_z(self.xCurr, self.yCurr, self.zCurr))
+
+		if arcI != 0.0:
+			outLine += " I" + str(round(arcI, 3))
+		if arcJ != 0.0:
+			outLine += " J" + str(round(arcJ, 3))
+		if arcR != 0.0:
+			outLine += " R" + str(round(arcR, 3))
+
+		if self.eMode != "None":
+			outLine += " E" + str(round(self.eCurr, 5))
+
+		outLine += " " + self.spareParts
+		self.spareParts = ""
+
+		outLine += "\n"
+
+		return outLine
+
+	def process_line(self, origLine):
+		if not len(origLine):
+			return None
+
+		self.lineNumber += 1
+		self.inputOffset += len(origLine)
+
+		if (self.python_version == 3):
+			line = origLine.decode('utf-8').lstrip()
+		else:
+			line = origLine
+
+		# Check for standard Movement commands
+		if self.move_pattern.match(line) is not None and self.moveMode != "Relative" and not self.positionFloating:
+			activeCode = self.comment_split(line)
+			gcodeParts = re.split("\s", activeCode)
+
+			self.xPrev = self.xCurr
+			self.yPrev = self.yCurr
+			self.zPrev = self.zCurr
+
+			arcI = 0.0
+			arcJ = 0.0
+			arcR = 0.0
+
+			self.moveCurr = gcodeParts[0]
+
+			for part in gcodeParts[1:]:
+				if len(part) > 1:
+					leadChar = part[0]
+					if leadChar == "X":
+						self.xCurr = float(part[1:])
+					elif leadChar == 'Y':
+						self.yCurr = float(part[1:])
+					elif leadChar == 'Z':
+						self.zCurr = float(part[1:])
+					elif leadChar == 'E':
+						# Extrusion Mode Stuff
+						if (self.eMode == "Relative"):
+							self.ePrev = 0
+						elif (self.eMode == "Absolute"):
+							self.ePrev = self.eCurr
+						else:
+							self.eMode = "Absolute"
+							self.ePrev = self.eCurr
+
+						self.eCurr = float(part[1:])
+					elif leadChar == 'I':
+						arcI = float(part[1:])
+					elif leadChar == 'J':
+						arcJ = float(part[1:])
+					elif leadChar == 'R':
+						arcR = float(part[1:])
+					else:
+						if leadChar == 'F':
+							self.feedrate = float(part[1:])
+						self.spareParts = part + " " + self.spareParts
+
+			if self.moveCurr == "G0" or self.moveCurr == "G1":
+				self.moveDist = self.move_dist()
+
+				if (self.moveDist > self.lineBreakDist and self.lineBreakDist != 0.0 and self.afterStart):
+					line = ""
+					start = (self.xPrev, self.yPrev)
+					end = (self.xCurr, self.yCurr)
+					moveLength = geometry.dist(start, end)
+
+					for s, e in self.limit_line(maxima.seamWiseMaxima(self.model, start, end, self.pwm), start, end, moveLength):
+						eVal = 0.0
+						fromStart = geometry.dist(start, e)
+						if (self.eMode == "Absolute"):
+								eVal = self.ePrev + (self.eCurr-self.ePrev) * fromStart / moveLength
+						elif (self.eMode == "Relative"):
+								eVal = self.eCurr * geometry.dist(s, e) / moveLength
+						zVal = self.zPrev + (self.zCurr - self.zPrev)*fromStart / moveLength
+
+						line += self.createLine(s, e, zVal, eVal)
+				else:
+					self.afterStart = True
+					line = self.reconstruct_line()
+			elif self.workspacePlane == 0:
+				# Handling for Gcode files that do not give a pos before the arc
+				if not self.afterStart:
+					self.zPrev = self.get_z(self.xPrev, self.yPrev, 0.0)*(self.invertPosition*2 - 1)
+
+				if (arcI or arcJ) and arcR:
+					raise GcodeLevelingError("Arc format mixing error", "G2/G3 commands cannot use R with I or J")
+				elif arcI or arcJ:
+					# figure out the center point
+					radius = (-arcI, -arcJ)
+					center = (self.xPrev + arcI, self.yPrev + arcJ)
+					endArm = (self.xCurr - center[0], self.yCurr - center[1])
+					radiusLength = geometry.norm(radius)
+					armLengths = radiusLength*geometry.norm(endArm)
+
+					# figure out exit angle
+					normalizedCross = geometry.cross(radius, endArm)/armLengths
+					# alpha = math.asin(normalizedCross)
+					alpha = math.acos(geometry.dot(radius, endArm)/armLengths)
+
+
+					longPath = (self.moveCurr == "G3") != (normalizedCross > 0)
+
+					arcAngle = 0.0
+					if longPath:
+						arcAngle = 2*math.pi-alpha
+					else:
+						arcAngle = alpha
+
+					if self.moveCurr == "G2":
+						arcAngle *= -1
+
+					# self._logger.info("Arc Angle {}".format(arcAngle))
+					arcLength = radiusLength * arcAngle
+
+					if (self.arcSegDist != 0.0 and arcLength >= self.arcSegDist):
+						line = ""
+
+						for s, c, a, qin, qend in self.limit_arc(maxima.seamWiseArcMaxima(self.model, center, radius, arcAngle, self.pwm), abs(arcLength)):
+							if (self.eMode == "Absolute"):
+								eVal = self.ePrev + (self.eCurr-self.ePrev) * qend
+							elif (self.eMode == "Relative"):
+								eVal = self.eCurr * (qend-qin)
+							zVal = qend*(self.zCurr - self.zPrev) + self.zPrev
+
+							line += self.createArc(s, c, a, eVal, zVal)
+					else:
+						self.reconstruct_arc(arcI, arcJ, arcR)
+
+				elif arcR:
+					# figure out the center point
+					prev = (self.xPrev, self.yPrev)
+					current = (self.xCurr, self.yCurr)
+
+					directConnect = geometry.sub(current, prev)
+					connectLength = geometry.norm(directConnect)
+
+					if connectLength > 2*arcR:
+						raise GcodeLevelingError("Invalid Arc Radius", "An arc cannot be formed with too small of a radius")
+					elif connectLength == 0.0:
+						raise GcodeLevelingError("Invalid Arc Endpoints", "An radius defined arc cannot be formed with identital endpoints")
+					rotModify = -1 if self.moveCurr == "G2" else 1
+
+					# q is perpendicular to directConnect, so it has the same length
+					q = geometry.scale((directConnect[1]*-1*rotModify, directConnect[0]*rotModify), math.sqrt(arcR**2 - (connectLength/2)**2)/connectLength)
+
+					center = geometry.add(geometry.add(prev, geometry.scale(directConnect, 0.5)), q)
+
+					pArm = geometry.sub(prev, center)
+					cArm = geometry.sub(current, center)
+
+					# figure out exit angle
+					arcAngle = math.acos(geometry.dot(pArm, cArm)/(geometry.norm(pArm)*geometry.norm(cArm)))
+
+					arcLength = arcR * arcAngle
+
+					if self.moveCurr == "G2":
+						arcAngle *= -1
+
+					if (self.arcSegDist != 0.0 and arcLength >= self.arcSegDist):
+						line = ""
+
+						for s, c, a, qin, qend in self.limit_arc(maxima.seamWiseArcMaxima(self.model, center, pArm, arcAngle, self.pwm), abs(arcLength)):
+							if (self.eMode == "Absolute"):
+								eVal = self.ePrev + (self.eCurr-self.ePrev) * qend
+							elif (self.eMode == "Relative"):
+								eVal = self.eCurr * (qend-qin)
+							zVal = qend*(self.zCurr - self.zPrev) + self.zPrev
+
+							line += self.createArc(s, c, a, eVal, zVal)
+					else:
+						self.reconstruct_arc(arcI, arcJ, arcR)
+
+				else:
+						raise GcodeLevelingError("Arc values missing", "G2/G3 commands either need an R or an I or J")
+
+		# # TODO: Add in proper support for relative movements
+		elif (self.pos_reset_pattern.match(line) is not None):
+			activeCode = self.comment_split(line)
+			gcodeParts = re.split("\s", activeCode)
+
+			self.xPrev = self.xCurr
+			self.yPrev = self.yCurr
+			self.zPrev = self.zCurr
+
+			for part in gcodeParts[1:]:
+				if len(part) > 1:
+					leadChar = part[0]
+					if leadChar == "X" or leadChar == 'Y' or leadChar == 'Z':
+						self.posFloating = True
+					elif leadChar == 'E':
+						self.eCurr = float(part[1:])
+
+			return origLine
+		# Check for movement mode
+		elif self.move_mode_pattern.match(line) is not None:
+			line = re.sub(self.comment_pattern, "", line)
+			mode = re.split("\s", line)[0]
+
+			if mode == "G90":
+				self.moveMode = "Absolute"
+			elif mode == "G91":
+				self.moveMode = "Relative"
+
+			# self._logger.info("Line sets move mode " + self.moveMode)
+			return origLine
+
+		# Check for extruder movement mode
+		elif self.extruder_mode_pattern.match(line) is not None:
+			line = re.sub(self.comment_pattern, "", line)
+			mode = re.split("\s", line)[0]
+
+			if mode == "M82":
+				self.eMode = "Absolute"
+			elif mode == "M83":
+				self.eMode = "Relative"
+
+			# self._logger.info("Line sets extruder mode " + self.eMode)
+			return origLine
+
+		# Check for workspace switches
+		elif self.set_workspace_plane.match(line) is not None:
+			line = re.sub(self.comment_pattern, "", line)
+			mode = re.split("\s", line)[0]
+
+			self.workspacePlane = workspacePlanes.index(mode)
+			return origLine
+
+		if (self.python_version == 3):
+			line = line.encode('utf-8')
+
+		return line
+
+# Stands in for the preprocessor when a file is known to fail, so the upload errors out right away
+class GcodeLevelingFailure(octoprint.filemanager.util.LineProcessorStream):
+	def __init__(self, fileBufferedReader, error):
+		super(GcodeLevelingFailure, self).__init__(fileBufferedReader)
+		self.error = error
+
+	def process_line(self, origLine):
+		raise self.error
@@ -0,0 +1,214 @@
+import re
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+# twoDimFit (and numpy with it) is imported when a plan is scored, the plugin imports this module at startup for ProbeSession
+
+IDLE = "idle"
+PROBING = "probing"
+DONE = "done"
+
+# Literal text every match of a pattern starts with, so most received lines are skipped with a startswith
+# instead of running the full regex (probeRegex is always used with match, so it is anchored either way)
+def literalPrefix(pattern, flags=0):
+	if flags & (re.IGNORECASE | re.VERBOSE) or "|" in pattern:
+		return ""
+	if pattern.startswith("^"):
+		pattern = pattern[1:]
+
+	prefix = ""
+	ind = 0
+	while ind < len(pattern):
+		char = pattern[ind]
+		if char == "\\":
+			# escaped punctuation is literal, classes like \d or \s end the prefix
+			if ind + 1 >= len(pattern) or pattern[ind+1].isalnum():
+				break
+			literal = pattern[ind+1]
+			step = 2
+		elif char in ".^$*+?{}[]()|":
+			break
+		else:
+			literal = char
+			step = 1
+
+		following = pattern[ind+step:ind+step+1]
+		if following in ("*", "?", "{"):
+			break
+		prefix += literal
+		if following == "+":
+			break
+		ind += step
+	return prefix
+
+# One auto probing run: idle until started, probing while points are being reported, done once finished or aborted
+# The received line hook hands it lines, which cost a state check outside a run and a prefix check while waiting on a point
+class ProbeSession():
+	def __init__(self):
+		self.state = IDLE
+		self.regex = None
+		self.prefix = ""
+		# margin on top of each point's travel time, 0 waits forever
+		self.timeout = 0.0
+		self.pointTimeout = None
+		self.waiting = False
+		self.results = queue.Queue()
+		self.error = None
+
+	def start(self, regex, timeout):
+		self.regex = regex
+		self.prefix = literalPrefix(regex.pattern, regex.flags)
+		self.timeout = timeout
+		self.waiting = False
+		self.results = queue.Queue()
+		self.error = None
+		self.state = PROBING
+
+	def feed(self, line):
+		if not self.waiting or not line.startswith(self.prefix):
+			return
+		mat = self.regex.match(line)
+		if mat is not None:
+			self.waiting = False
+			self.results.put((float(mat.group('x')), float(mat.group('y')), float(mat.group('z'))))
+
+	# called before a point's commands are queued, so its report can't arrive before the session listens for it
+	# travel is how long the moves up to the point's report take at the probe feedrate
+	def expect(self, travel=0.0):
+		self.pointTimeout = travel + self.timeout if self.timeout > 0 else None
+		self.waiting = True
+
+	# the reported (x, y, z) of the point, None once it timed out or the session was aborted
+	def wait(self):
+		try:
+			result = self.results.get(timeout=self.pointTimeout)
+		except queue.Empty:
+			self.abort("No probe result within {} s".format(round(self.pointTimeout, 1)))
+			return None
+		return result if self.state == PROBING else None
+
+	def abort(self, reason):
+		if self.state != PROBING:
+			return False
+		self.error = reason
+		self.state = DONE
+		self.waiting = False
+		self.results.put(None)
+		return True
+
+	def finish(self):
+		self.state = DONE
+
+# serpentine order over an xCount by yCount grid, so the probe never crosses the whole bed between points
+def gridPoints(xMin, xMax, yMin, yMax, xCount, yCount):
+	points = []
+	forward = True
+	for xProbe in range(xCount):
+		x = xMin + xProbe * (xMax - xMin) / (xCount-1)
+
+		for yProbe in range(yCount):
+			if forward:
+				y = yMin + yProbe * (yMax - yMin) / (yCount-1)
+			else:
+				y = yMax - yProbe * (yMax - yMin) / (yCount-1)
+			points.append((round(x, 3), round(y, 3)))
+
+		forward = not forward
+	return points
+
+# nearest neighbour tour from where the probe is now, points are probed in this order
+def travelOrder(points, start):
+	left = list(points)
+	ordered = []
+	position = start
+	while len(left):
+		nearest = min(range(len(left)), key=lambda ind: (left[ind][0] - position[0])**2 + (left[ind][1] - position[1])**2)
+		position = left.pop(nearest)
+		ordered.append(position)
+	return ordered
+
+# Probes a coarse grid first, then after each round splits only the grid cells where the fitted surface is still uncertain
+# (standard error of the height at the cell center) or bends away from what was probed (residual at the cell's probed points),
+# probing the center and edge midpoints of those cells
+# The coarse grid only has to pin the model down, so it is one point per axis past the model's degree (at most the configured grid)
+class AdaptivePlan():
+	def __init__(self, xMin, xMax, yMin, yMax, xCount, yCount, tolerance, maxPoints, offset=(0.0, 0.0), maxRounds=4, xDeg=2, yDeg=2, improvement=0.8):
+		self.tolerance = tolerance
+		self.maxPoints = maxPoints
+		self.offset = offset
+		self.maxRounds = maxRounds
+		# a round has to bring the largest residual under this fraction of the last one for residuals to keep adding points
+		self.improvement = improvement
+		self.rounds = 1
+		self.lastMisfit = None
+		self.improving = True
+		# probed points the model still misses by more than the tolerance once more points stopped helping
+		self.outliers = []
+
+		self.xCount = max(2, min(xCount, xDeg + 2))
+		self.yCount = max(2, min(yCount, yDeg + 2))
+		self.coarse = gridPoints(xMin, xMax, yMin, yMax, self.xCount, self.yCount)
+		self.planned = set(self.coarse)
+
+		xStep = (xMax - xMin) / (self.xCount-1)
+		yStep = (yMax - yMin) / (self.yCount-1)
+		self.cells = [(xMin + xCell*xStep, xMin + (xCell+1)*xStep, yMin + yCell*yStep, yMin + (yCell+1)*yStep) for xCell in range(self.xCount-1) for yCell in range(self.yCount-1)]
+
+	# (standard error at the center, largest residual of the points on it) of each cell
+	def score(self, fit, coeffs):
+		from octoprint_gcodeleveling import twoDimFit
+
+		xOffset, yOffset = self.offset
+		centers = [((x0 + x1)/2 + xOffset, (y0 + y1)/2 + yOffset) for x0, x1, y0, y1 in self.cells]
+		errors = twoDimFit.heightError(fit.points, fit.xDeg, fit.yDeg, centers)
+		residuals = fit.residuals(coeffs)
+
+		scores = []
+		for ind, (x0, x1, y0, y1) in enumerate(self.cells):
+			# reported positions can be a little off the commanded ones
+			slack = 0.01 * max(x1 - x0, y1 - y0)
+			misfit = [abs(residual) for (x, y, z), residual in zip(fit.points, residuals)
+				if x0 + xOffset - slack <= x <= x1 + xOffset + slack and y0 + yOffset - slack <= y <= y1 + yOffset + slack]
+			scores.append((float(errors[ind]) if errors is not None else float("inf"), max(misfit) if len(misfit) else 0.0))
+		return scores
+
+	# points for the next round in travel order, an empty list once the surface is pinned down or the budget is spent
+	def refine(self, fit, coeffs, position):
+		if self.rounds >= self.maxRounds or len(self.planned) >= self.maxPoints:
+			return []
+
+		scores = self.score(fit, coeffs)
+		# a fixed degree fit can't follow a bend that more points show, past that its residuals are the degree limit or probe noise
+		worst = max(misfit for error, misfit in scores)
+		self.improving = self.improving and (self.lastMisfit is None or worst < self.improvement * self.lastMisfit)
+		self.lastMisfit = worst
+		if not self.improving:
+			self.outliers = [point for point, residual in zip(fit.points, fit.residuals(coeffs)) if abs(residual) > self.tolerance]
+
+		# the worst cells get the budget first
+		flagged = []
+		for (error, misfit), cell in zip(scores, self.cells):
+			score = max(error, misfit) if self.improving else error
+			if score > self.tolerance:
+				flagged.append((score, cell))
+		flagged.sort(key=lambda pair: -pair[0])
+
+		added = []
+		cells = []
+		for score, (x0, x1, y0, y1) in flagged:
+			xMid = (x0 + x1)/2
+			yMid = (y0 + y1)/2
+			fresh = [point for point in ((round(xMid, 3), round(yMid, 3)), (round(xMid, 3), round(y0, 3)), (round(xMid, 3), round(y1, 3)), (round(x0, 3), round(yMid, 3)), (round(x1, 3), round(yMid, 3)))
+				if point not in self.planned and point not in added]
+			if len(self.planned) + len(added) + len(fresh) > self.maxPoints:
+				break
+			added.extend(fresh)
+			cells.extend([(x0, xMid, y0, yMid), (x0, xMid, yMid, y1), (xMid, x1, y0, yMid), (xMid, x1, yMid, y1)])
+
+		self.planned.update(added)
+		self.cells = cells
+		self.rounds += 1
+		return travelOrder(added, position)
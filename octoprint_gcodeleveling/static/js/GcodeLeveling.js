@@ -30,12 +30,125 @@ $(function() {
                     probeRegex: self.settingsViewModel.settings.plugins.gcodeleveling.probeRegex(),
                     probePosCmd: self.settingsViewModel.settings.plugins.gcodeleveling.probePosCmd(),
                     homeCmd: self.settingsViewModel.settings.plugins.gcodeleveling.homeCmd(),
+                    probeTimeout: parseFloat(self.settingsViewModel.settings.plugins.gcodeleveling.probeTimeout()).toFixed(3),
                     probeFeedrate: parseFloat(self.settingsViewModel.settings.plugins.gcodeleveling.probeFeedrate()).toFixed(3),
                     xOffset: parseFloat(self.settingsViewModel.settings.plugins.gcodeleveling.xOffset()).toFixed(3),
                     yOffset: parseFloat(self.settingsViewModel.settings.plugins.gcodeleveling.yOffset()).toFixed(3),
                     zOffset: parseFloat(self.settingsViewModel.settings.plugins.gcodeleveling.zOffset()).toFixed(3),
                     finalZ: parseFloat(self.settingsViewModel.settings.plugins.gcodeleveling.finalZ()).toFixed(3),
-                    sendBedLevelVisualizer: self.settingsViewModel.settings.plugins.gcodeleveling.sendBedLevelVisualizer()
+                    sendBedLevelVisualizer: self.settingsViewModel.settings.plugins.gcodeleveling.sendBedLevelVisualizer(),
+                    adaptive: self.settingsViewModel.settings.plugins.gcodeleveling.adaptiveProbing(),
+                    adaptiveTolerance: parseFloat(self.settingsViewModel.settings.plugins.gcodeleveling.adaptiveTolerance()).toFixed(3),
+                    maxProbePoints: parseInt(self.settingsViewModel.settings.plugins.gcodeleveling.maxProbePoints())
+                }),
+                contentType: "application/json; charset=UTF-8"
+            });
+        }
+
+        self.abortProbe = function() {
+            $.ajax({
+                url: API_BASEURL + "plugin/gcodeleveling",
+                type: "POST",
+                dataType: "json",
+                data: JSON.stringify({
+                    command: "abortProbe"
+                }),
+                contentType: "application/json; charset=UTF-8"
+            });
+        }
+
+        self.probeButtons = {
+            confirm: {
+                confirm: true,
+                buttons: [{
+                    text: 'Abort',
+                    click: function(notice) {
+                        self.abortProbe();
+                        notice.update({text: 'Aborting'});
+                    }
+                }, {
+                    addClass: 'hidden'
+                }]
+            },
+            buttons: {
+                closer: false,
+                sticker: false
+            }
+        }
+
+        self.degreeSelection = ko.observable("");
+
+        self.selectDegree = function() {
+            $.ajax({
+                url: API_BASEURL + "plugin/gcodeleveling",
+                type: "POST",
+                dataType: "json",
+                data: JSON.stringify({
+                    command: "selectDegree",
+                    points: ko.toJS(self.settingsViewModel.settings.plugins.gcodeleveling.points),
+                    maxDegree: parseInt(self.settingsViewModel.settings.plugins.gcodeleveling.maxDegree())
+                }),
+                contentType: "application/json; charset=UTF-8"
+            }).done(function(selection) {
+                self.settingsViewModel.settings.plugins.gcodeleveling.modelDegree.x(selection.x);
+                self.settingsViewModel.settings.plugins.gcodeleveling.modelDegree.y(selection.y);
+                self.degreeSelection(`${selection.rmse.toFixed(4)} mm error on unseen points`);
+            }).fail(function(response) {
+                self.degreeSelection(response.responseText);
+            });
+        }
+
+        self.newProfileName = ko.observable("");
+        self.selectedProfile = ko.observable();
+
+        self.profileNames = ko.pureComputed(function() {
+            if (!self.settingsViewModel.settings || !self.settingsViewModel.settings.plugins) {
+                return [];
+            }
+            return Object.keys(ko.toJS(self.settingsViewModel.settings.plugins.gcodeleveling.profiles) || {}).sort();
+        });
+
+        self.profileCommand = function(command, name) {
+            if (!name) {
+                return;
+            }
+            $.ajax({
+                url: API_BASEURL + "plugin/gcodeleveling",
+                type: "POST",
+                dataType: "json",
+                data: JSON.stringify({
+                    command: command,
+                    name: name
+                }),
+                contentType: "application/json; charset=UTF-8"
+            }).done(function() {
+                self.settingsViewModel.requestData();
+            });
+        }
+
+        self.saveProfile = function() {
+            self.profileCommand("saveProfile", self.newProfileName());
+            self.newProfileName("");
+        }
+
+        self.selectProfile = function() {
+            self.profileCommand("selectProfile", self.selectedProfile());
+        }
+
+        self.deleteProfile = function() {
+            self.profileCommand("deleteProfile", self.selectedProfile());
+        }
+
+        self.jobNotifies = {};
+
+        self.cancelJob = function(jobId) {
+            $.ajax({
+                url: API_BASEURL + "plugin/gcodeleveling",
+                type: "POST",
+                dataType: "json",
+                data: JSON.stringify({
+                    command: "cancel",
+                    id: jobId
                 }),
                 contentType: "application/json; charset=UTF-8"
             });
@@ -57,33 +170,84 @@ $(function() {
             if (plugin === "gcodeleveling") {
                 if (data.state === "startProbing") {
                     self.probePoints = data.totalPoints;
-                    self.probingNotify = new PNotify({
+                    self.probingNotify = new PNotify($.extend({
                         title: 'Started Probing',
                         type: 'info',
                         textTrusted: true,
                         text: `Currently Homing: @ Point (0/${self.probePoints}) <br />
                             <div class="progress progress-striped active"><div class="bar" style="width: 0%"></div></div>`,
                         hide: false
-                    });
+                    }, self.probeButtons));
                 } else if (data.state === "updateProbing") {
+                    var fitText = data.fit ? `<br />Fit: ${data.fit.rms} mm rms, largest residual ${data.fit.maxResidual} mm @ Point ${data.fit.worstPoint}` : '';
                     if (!self.probingNotify) {
                         self.probePoints = data.totalPoints;
-                        self.probingNotify = new PNotify({
+                        self.probingNotify = new PNotify($.extend({
                             title: 'Probing',
                             type: 'info',
                             textTrusted: true,
-                            text: `@ Point (${data.currentPoint}/${self.probePoints}) <br />
+                            text: `@ Point (${data.currentPoint}/${self.probePoints})${fitText} <br />
                                 <div class="progress progress-striped active"><div class="bar" style="width: ${data.currentPoint/self.probePoints*100.0}%"></div></div>`,
                             hide: false
-                        });
+                        }, self.probeButtons));
                     } else {
                         pointUpdate = {
                             title: 'Probing',
-                            text: `@ Point (${data.currentPoint}/${self.probePoints}) <br />
+                            text: `@ Point (${data.currentPoint}/${self.probePoints})${fitText} <br />
                                 <div class="progress progress-striped active"><div class="bar" style="width: ${data.currentPoint/self.probePoints*100.0}%"></div></div>`
                         }
                         self.probingNotify.update(pointUpdate);
                     }
+                } else if (data.state === "abortedProbing") {
+                    abortUpdate = {
+                        title: 'Probing Aborted',
+                        type: 'error',
+                        text: `${data.reason} @ Point (${data.currentPoint}/${data.totalPoints}), the probed points were not saved`,
+                        hide: false,
+                        confirm: {confirm: false},
+                        buttons: {closer: true, sticker: true}
+                    }
+                    if (!self.probingNotify) {
+                        self.probingNotify = new PNotify(abortUpdate);
+                    } else {
+                        self.probingNotify.update(abortUpdate);
+                    }
+                } else if (data.state === "jobStarted") {
+                    self.jobNotifies[data.id] = new PNotify({
+                        title: 'Leveling ' + data.path,
+                        type: 'info',
+                        text: 'The upload is being leveled',
+                        hide: false,
+                        confirm: {
+                            confirm: true,
+                            buttons: [{
+                                text: 'Cancel',
+                                click: function(notice) {
+                                    self.cancelJob(data.id);
+                                    notice.update({text: 'Cancelling'});
+                                }
+                            }, {
+                                addClass: 'hidden'
+                            }]
+                        },
+                        buttons: {
+                            closer: false,
+                            sticker: false
+                        }
+                    });
+                } else if (data.state === "jobFinished" || data.state === "jobFailed") {
+                    if (self.jobNotifies[data.id]) {
+                        self.jobNotifies[data.id].remove();
+                        delete self.jobNotifies[data.id];
+                    }
+                    if (data.state === "jobFailed") {
+                        new PNotify({
+                            title: (data.aborted ? 'Leveling Aborted: ' : 'Leveling Failed: ') + data.path,
+                            type: 'error',
+                            text: data.error + ': ' + data.reason,
+                            hide: false
+                        });
+                    }
                 } else if (data.state === "finishedProbing") {
                     if (!self.probingNotify) {
                         self.probePoints = data.totalPoints;
@@ -98,6 +262,8 @@ $(function() {
                     } else {
                         finishUpdate = {
                             title: 'Finished Probing',
+                            confirm: {confirm: false},
+                            buttons: {closer: true, sticker: true},
                             text: `${self.probePoints} points were probed and saved <br />
                                 <div class="progress progress-striped active"><div class="bar" style="width: 100%"></div></div>`
                         }
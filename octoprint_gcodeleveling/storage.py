@@ -0,0 +1,65 @@
+import os, gzip, shutil
+
+from octoprint.util import atomic_write
+
+# gzip level 1 keeps the Pi's CPU mostly free while still roughly quartering gcode on disk
+compressLevel = 1
+compressedSuffix = ".gz"
+
+# what is stored for a file, each kind in its own folder under the plugin data folder
+kinds = ("originals", "index")
+# a moved folder is removed before it is moved, its stored files wait here in between
+heldFolder = "removed"
+
+# Paths also come from the API, so they are checked to stay inside the plugin's folders
+def storagePath(path):
+	parts = [part for part in path.replace("\\", "/").split("/") if part not in ("", ".")]
+	if not len(parts) or ".." in parts:
+		raise ValueError("Invalid path: {}".format(path))
+	return "/".join(parts)
+
+def originalPath(dataFolder, path):
+	return os.path.join(dataFolder, "originals", storagePath(path) + compressedSuffix)
+
+# seek index of a leveled file, written by the leveling job
+def indexPath(dataFolder, path):
+	return os.path.join(dataFolder, "index", storagePath(path) + ".json")
+
+def storedFiles(dataFolder, path):
+	return (originalPath(dataFolder, path), indexPath(dataFolder, path))
+
+def storedFolders(dataFolder, path, held=False):
+	root = os.path.join(dataFolder, heldFolder) if held else dataFolder
+	return tuple(os.path.join(root, kind, storagePath(path)) for kind in kinds)
+
+def moveStored(sources, destinations):
+	for source, destination in zip(sources, destinations):
+		if not os.path.exists(source):
+			continue
+		removeStored((destination,))
+		folder = os.path.dirname(destination)
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		shutil.move(source, destination)
+
+def removeStored(paths):
+	for path in paths:
+		if os.path.isdir(path):
+			shutil.rmtree(path, ignore_errors=True)
+		elif os.path.isfile(path):
+			os.remove(path)
+
+def removeHeld(dataFolder):
+	removeStored((os.path.join(dataFolder, heldFolder),))
+
+def saveCompressed(stream, dest):
+	folder = os.path.dirname(dest)
+	if not os.path.isdir(folder):
+		os.makedirs(folder)
+
+	with atomic_write(dest, mode="wb") as raw:
+		with gzip.GzipFile(filename="", mode="wb", fileobj=raw, compresslevel=compressLevel) as compressed:
+			shutil.copyfileobj(stream, compressed)
+
+def openCompressed(src):
+	return gzip.open(src, "rb")
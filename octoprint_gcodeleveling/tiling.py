@@ -0,0 +1,59 @@
+# Piecewise model for large beds: the probed rectangle is cut into a grid of tiles, each fit with its own low degree polynomial
+# Between the centers of neighbouring tiles their polynomials are blended with a smoothstep, so height and slope stay continuous
+# A point is covered by at most 2 tiles along each axis, which are found from its coordinates without a search
+
+def tileCenters(lo, hi, count):
+	pitch = (hi - lo) / float(count)
+	return [lo + (tile + 0.5) * pitch for tile in range(count)]
+
+# the span where a tile's blend weight is not zero, the outer tiles reach past the probed rectangle
+def tileSpan(centers, tile, reach=1.0):
+	pitch = centers[1] - centers[0] if len(centers) > 1 else 0.0
+	lo = float("-inf") if tile == 0 else centers[tile] - reach*pitch
+	hi = float("inf") if tile == len(centers) - 1 else centers[tile] + reach*pitch
+	return lo, hi
+
+# the points a tile is fit to, the span is widened until they pin down a polynomial of the degree
+def tilePoints(points, xCenters, xTile, yCenters, yTile, xDeg, yDeg):
+	reach = 1.0
+	while True:
+		xLo, xHi = tileSpan(xCenters, xTile, reach)
+		yLo, yHi = tileSpan(yCenters, yTile, reach)
+		chosen = [point for point in points if xLo <= point[0] <= xHi and yLo <= point[1] <= yHi]
+		if len(set(point[0] for point in chosen)) > xDeg and len(set(point[1] for point in chosen)) > yDeg:
+			return chosen
+		if len(chosen) == len(points):
+			return chosen
+		reach *= 1.5
+
+def fitTiles(points, xDeg, yDeg, xTiles, yTiles):
+	from octoprint_gcodeleveling import twoDimFit
+
+	# points from the settings can hold strings, min() and the span comparisons would order them as text
+	points = [[float(coor) for coor in point] for point in points]
+	xCenters = tileCenters(min(point[0] for point in points), max(point[0] for point in points), xTiles)
+	yCenters = tileCenters(min(point[1] for point in points), max(point[1] for point in points), yTiles)
+
+	coeffs = [[twoDimFit.twoDpolyFit(tilePoints(points, xCenters, xTile, yCenters, yTile, xDeg, yDeg), xDeg, yDeg).tolist() for yTile in range(yTiles)] for xTile in range(xTiles)]
+	return dict(x=xCenters, y=yCenters, coeffs=coeffs)
+
+# the tiles that cover v along one axis with their weight and its first and second derivative
+def blend(centers, v):
+	last = len(centers) - 1
+	if last == 0 or v <= centers[0]:
+		return ((0, 1.0, 0.0, 0.0),)
+	if v >= centers[last]:
+		return ((last, 1.0, 0.0, 0.0),)
+
+	pitch = centers[1] - centers[0]
+	t = (v - centers[0]) / pitch
+	tile = min(int(t), last - 1)
+	f = t - tile
+	s = f*f*(3.0 - 2.0*f)
+	ds = 6.0*f*(1.0 - f) / pitch
+	dds = (6.0 - 12.0*f) / (pitch*pitch)
+	return ((tile, 1.0 - s, -ds, -dds), (tile + 1, s, ds, dds))
+
+# the lines where the blend switches to another pair of tiles, the centers of the tiles along each axis
+def seams(tiles):
+	return (tiles['x'] if len(tiles['x']) > 1 else [], tiles['y'] if len(tiles['y']) > 1 else [])
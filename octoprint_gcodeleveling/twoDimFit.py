@@ -86,9 +86,124 @@ def twoDpolyFit(ps, xDeg, yDeg):
 	coeffs = cS.reshape((xDeg+1),(yDeg+1))
 	return coeffs
 
+# Keeps the sums that make up twoDpolyFit's normal equations, so each new point is one O(degree^2) update
+# and solving them gives the same coefficients as fitting every point again
+class IncrementalFit():
+	def __init__(self, xDeg, yDeg):
+		self.xDeg = xDeg
+		self.yDeg = yDeg
+		self.moments = np.zeros((2*xDeg+1, 2*yDeg+1))
+		self.zMoments = np.zeros((xDeg+1, yDeg+1))
+		self.points = []
+
+	def add(self, point):
+		x, y, z = np.array(point, dtype="float")
+		for xPow in range(2*self.xDeg+1):
+			for yPow in range(2*self.yDeg+1):
+				self.moments[xPow, yPow] += (x**xPow)*(y**yPow)*(z**0)
+				if xPow <= self.xDeg and yPow <= self.yDeg:
+					self.zMoments[xPow, yPow] += (x**xPow)*(y**yPow)*(z**1)
+		self.points.append((float(x), float(y), float(z)))
+
+	def coeffs(self):
+		size = (self.xDeg+1)*(self.yDeg+1)
+		A = np.zeros((size, size))
+		for r in range(size):
+			for c in range(size):
+				A[r, c] = self.moments[r // (self.yDeg+1) + c // (self.yDeg+1), r % (self.yDeg+1) + c % (self.yDeg+1)]
+
+		cS = solve(A, self.zMoments.reshape(size))
+		return cS.reshape((self.xDeg+1), (self.yDeg+1))
+
+	# distance from each point to the current surface, a point far off the rest is likely a bad probe
+	def residuals(self, coeffs=None):
+		if coeffs is None:
+			coeffs = self.coeffs()
+		return [z - twoDpolyEval(coeffs, x, y) for x, y, z in self.points]
+
 # maximum deviation solving between linear move and poly model
 def maximumDeviation(cs, start, end):
 	start = np.asarray(start)
 	end = np.asarray(end)
 
 	return((0,0), 0)
+
+# Least squares design matrix, one column per coefficient in the same order as the flattened coeffs of twoDpolyFit
+def designMatrix(ps, xDeg, yDeg):
+	ps = np.asarray(ps, dtype="float")
+	xPowers = ps[:, 0:1] ** np.arange(xDeg+1)
+	yPowers = ps[:, 1:2] ** np.arange(yDeg+1)
+	return (xPowers[:, :, None] * yPowers[:, None, :]).reshape(len(ps), (xDeg+1)*(yDeg+1))
+
+# scaling each axis to [-1, 1] leaves the fit unchanged, but keeps high powers of bed coordinates well conditioned
+def scaleAxes(ps, reference):
+	scaled = np.array(ps, dtype="float")
+	for axis in (0, 1):
+		lo, hi = reference[:, axis].min(), reference[:, axis].max()
+		scaled[:, axis] = (scaled[:, axis] - (hi + lo)/2) / ((hi - lo)/2 if hi > lo else 1.0)
+	return scaled
+
+# Standard error of the fitted height at each query (x, y), from the spread of the residuals and how tightly the points
+# pin the surface down there, None while there are not more points than coefficients
+def heightError(ps, xDeg, yDeg, queries):
+	ps = np.asarray(ps, dtype="float")
+	count = len(ps)
+
+	X = designMatrix(scaleAxes(ps, ps), xDeg, yDeg)
+	if X.shape[1] >= count or np.linalg.matrix_rank(X) < X.shape[1]:
+		return None
+
+	Q, R = np.linalg.qr(X)
+	residuals = ps[:, 2] - Q.dot(Q.T.dot(ps[:, 2]))
+	variance = residuals.dot(residuals) / (count - X.shape[1])
+
+	spread = np.linalg.solve(R.T, designMatrix(scaleAxes(queries, ps), xDeg, yDeg).T)
+	return np.sqrt(variance * (spread**2).sum(axis=0))
+
+# Cross validated rms error of a degree pair, None if the points can't support it
+# Held out residuals come from one fit on all points: removing a point is a rank one downdate, so e_cv = e / (1 - h_ii),
+# and removing a fold of points is a block downdate, e_cv = (I - H_ff)^-1 e_f
+def crossValidate(ps, xDeg, yDeg, folds=0):
+	ps = np.asarray(ps, dtype="float")
+	count = len(ps)
+
+	scaled = scaleAxes(ps, ps)
+
+	X = designMatrix(scaled, xDeg, yDeg)
+	if X.shape[1] >= count or np.linalg.matrix_rank(X) < X.shape[1]:
+		return None
+
+	Q, R = np.linalg.qr(X)
+	residuals = scaled[:, 2] - Q.dot(Q.T.dot(scaled[:, 2]))
+
+	if folds <= 1 or folds >= count:
+		leverage = (Q**2).sum(axis=1)
+		if leverage.max() > 1 - 1e-9:
+			return None
+		held = residuals / (1 - leverage)
+	else:
+		held = np.empty(count)
+		for fold in range(folds):
+			rows = np.arange(fold, count, folds)
+			Qf = Q[rows]
+			downdate = np.eye(len(rows)) - Qf.dot(Qf.T)
+			if np.linalg.matrix_rank(downdate) < len(rows):
+				return None
+			held[rows] = np.linalg.solve(downdate, residuals[rows])
+
+	return float(np.sqrt(np.mean(held**2)))
+
+# Sweeps every degree pair up to maxDegree, the best one has the lowest cross validated error (ties go to the simpler model)
+def selectDegree(ps, maxDegree, folds=0):
+	scores = []
+	for xDeg in range(maxDegree+1):
+		for yDeg in range(maxDegree+1):
+			rmse = crossValidate(ps, xDeg, yDeg, folds)
+			if rmse is not None:
+				scores.append(dict(x=xDeg, y=yDeg, rmse=rmse))
+
+	if not len(scores):
+		return None
+
+	best = min(scores, key=lambda score: (round(score['rmse'], 9), score['x'] + score['y']))
+	return dict(x=best['x'], y=best['y'], rmse=best['rmse'], folds=folds if 1 < folds < len(ps) else len(ps), scores=scores)
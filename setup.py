@@ -59,7 +59,14 @@ plugin_ignored_packages = []
 # Example:
 #     plugin_requires = ["someDependency==dev"]
 #     additional_setup_parameters = {"dependency_links": ["https://github.com/someUser/someRepo/archive/master.zip#egg=someDependency-dev"]}
-additional_setup_parameters = {}
+additional_setup_parameters = {
+	"entry_points": {
+		"console_scripts": [
+			"gcodeleveling = octoprint_gcodeleveling.cli:main",
+			"gcodeleveling-bench = octoprint_gcodeleveling.bench:main"
+		]
+	}
+}
 
 ########################################################################################################################
 
@@ -0,0 +1,423 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import io, logging, math, os, random, re, shutil, tempfile, threading, time, unittest
+
+from octoprint_gcodeleveling import arcfit, bounds, evaluators, index, jobs, maxima, model, probing, storage, tiling, twoDimFit
+from octoprint_gcodeleveling.analysis import GcodeAnalyzer
+from octoprint_gcodeleveling.preprocessor import GcodeLevelingError, GcodePreProcessor
+
+# Regression tests for the plugin, run with `make test` (or python3 test.py)
+
+def bedPoints(surface, count=5, size=200.0):
+	return [(x*size/(count-1), y*size/(count-1), surface(x*size/(count-1), y*size/(count-1))) for x in range(count) for y in range(count)]
+
+def tilted(x, y):
+	return 0.3*((x-100)/100)**2 - 0.2*((y-100)/100)**2 + 0.001*x
+
+# layers of long infill lines (split by leveling) and circles cut into short segments (welded back into arcs)
+def sampleGcode(layers=12):
+	lines = ["G90", "M82", "G28", "G1 Z0.2 F3000"]
+	e = 0.0
+	for layer in range(layers):
+		lines.append(";LAYER:{}".format(layer))
+		lines.append("G0 Z{:.2f}".format(0.2 + 0.2*layer))
+		for row in range(40):
+			y = 5.0 + row*4.75
+			e += 9.0
+			lines.append("G1 X{:.3f} Y{:.3f} E{:.5f} F1800 ; infill".format(195.0 if row % 2 == 0 else 5.0, y, e))
+		for step in range(72):
+			angle = step*math.pi/36
+			e += 0.1
+			lines.append("G1 X{:.4f} Y{:.4f} E{:.5f}".format(100 + 40*math.cos(angle), 100 + 40*math.sin(angle), e))
+	return ("\n".join(lines) + "\n").encode("utf-8")
+
+class StorageTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp(prefix="gcodeleveling-test-")
+
+	def tearDown(self):
+		shutil.rmtree(self.folder, ignore_errors=True)
+
+	def test_paths_stay_inside_the_data_folder(self):
+		self.assertEqual(storage.originalPath(self.folder, "/prints/./part.gcode"), os.path.join(self.folder, "originals", "prints/part.gcode.gz"))
+		for path in ("", "/", "../part.gcode", "prints/../../part.gcode"):
+			self.assertRaises(ValueError, storage.originalPath, self.folder, path)
+
+	def test_original_round_trips_compressed(self):
+		data = b"G1 X10 Y10 Z0.2\n" * 1000
+		dest = storage.originalPath(self.folder, "prints/part.gcode")
+		storage.saveCompressed(io.BytesIO(data), dest)
+		self.assertLess(os.path.getsize(dest), len(data))
+		with storage.openCompressed(dest) as original:
+			self.assertEqual(original.read(), data)
+
+	def test_stored_files_follow_moves(self):
+		storage.saveCompressed(io.BytesIO(b"G28\n"), storage.originalPath(self.folder, "a/part.gcode"))
+		storage.moveStored(storage.storedFiles(self.folder, "a/part.gcode"), storage.storedFiles(self.folder, "b/part.gcode"))
+		self.assertFalse(os.path.exists(storage.originalPath(self.folder, "a/part.gcode")))
+		self.assertTrue(os.path.exists(storage.originalPath(self.folder, "b/part.gcode")))
+
+		# a moved folder is removed first, its files are held until it shows up again
+		storage.moveStored(storage.storedFolders(self.folder, "b"), storage.storedFolders(self.folder, "b", held=True))
+		storage.moveStored(storage.storedFolders(self.folder, "b", held=True), storage.storedFolders(self.folder, "c"))
+		with storage.openCompressed(storage.originalPath(self.folder, "c/part.gcode")) as original:
+			self.assertEqual(original.read(), b"G28\n")
+
+		storage.removeStored(storage.storedFiles(self.folder, "c/part.gcode"))
+		self.assertFalse(os.path.exists(storage.originalPath(self.folder, "c/part.gcode")))
+
+class LevelingTestCase(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp(prefix="gcodeleveling-test-")
+		self.coeffs = twoDimFit.twoDpolyFit(bedPoints(tilted), 2, 2)
+
+	def tearDown(self):
+		shutil.rmtree(self.folder, ignore_errors=True)
+
+	def path(self, name):
+		return os.path.join(self.folder, name)
+
+	def write(self, name, data):
+		with open(self.path(name), "wb") as gcodeFile:
+			gcodeFile.write(data)
+		return self.path(name)
+
+	def read(self, name):
+		with open(self.path(name), "rb") as gcodeFile:
+			return gcodeFile.read()
+
+class AnalysisTest(LevelingTestCase):
+	def analyze(self, data, sampleEvery):
+		analyzer = GcodeAnalyzer(io.BytesIO(data), 3, logging.getLogger("test"), self.coeffs, -5.0, 100.0, 10.0, 15.0, False, sampleEvery=sampleEvery)
+		return analyzer.run(chunkSize=1 << 12)
+
+	def test_estimates_match_the_leveled_output(self):
+		data = sampleGcode(layers=40)
+		leveled = GcodePreProcessor(io.BytesIO(data), 3, logging.getLogger("test"), self.coeffs, -5.0, 100.0, 10.0, 15.0, False).read()
+
+		full = self.analyze(data, 1)
+		self.assertEqual(full['outputBytesEstimate'], len(leveled))
+		self.assertEqual(full['outputLinesEstimate'], leveled.count(b"\n"))
+
+		# skipped chunks are still counted, only a tenth of the input is leveled
+		sampled = self.analyze(data, 10)
+		self.assertEqual(sampled['lines'], full['lines'])
+		self.assertEqual(sampled['movesSeen'], full['movesSeen'])
+		self.assertLess(sampled['movesSampled'], full['movesSampled'] / 5)
+		self.assertAlmostEqual(sampled['outputBytesEstimate'], len(leveled), delta=len(leveled) * 0.05)
+
+class CertifyTest(LevelingTestCase):
+	def test_g92_is_not_certified(self):
+		gcode = b"G90\nG1 X10 Y10 Z0.2\nG92 Z0\nG1 X20 Y20 Z0.2\n"
+		self.assertIsNone(bounds.scanExtents(io.BytesIO(gcode)))
+
+	def test_out_of_bounds_file_fails(self):
+		extents = bounds.scanExtents(io.BytesIO(b"G90\nG1 X10 Y10 Z0.2\nG1 X190 Y190 Z30.0\n"))
+		result = bounds.certify(self.coeffs, extents, -5.0, 20.0, False)
+		self.assertEqual(result['status'], bounds.OUTSIDE)
+		self.assertGreater(result['point'][2], 20.0)
+
+	def test_in_bounds_file_is_certified(self):
+		extents = bounds.scanExtents(io.BytesIO(b"G90\nG1 X10 Y10 Z0.2\nG1 X190 Y190 Z3.0\n"))
+		self.assertEqual(bounds.certify(self.coeffs, extents, -5.0, 20.0, False)['status'], bounds.CERTIFIED)
+
+	def test_range_encloses_the_surface(self):
+		rng = random.Random(5)
+		for trial in range(20):
+			coeffs = twoDimFit.twoDpolyFit([(x, y, rng.gauss(0, 0.3)) for x, y, z in bedPoints(tilted)], 3, 3)
+			low, high = bounds.polyRange(coeffs, 20.0, 180.0, 10.0, 150.0)
+			samples = [twoDimFit.twoDpolyEval(coeffs, 20.0 + 160.0*u/40, 10.0 + 140.0*v/40) for u in range(41) for v in range(41)]
+			self.assertLessEqual(low, min(samples))
+			self.assertGreaterEqual(high, max(samples))
+
+	# certification replaces the check on every point, so a (wrongly) certified file is not stopped
+	def test_certified_file_skips_the_bounds_check(self):
+		gcode = b"G90\nG1 X10 Y10 Z0.2\nG1 X190 Y190 Z30.0\n"
+		level = lambda certified: GcodePreProcessor(io.BytesIO(gcode), 3, logging.getLogger("test"), self.coeffs, -5.0, 20.0, 10.0, 15.0, False, certified=certified).read()
+		self.assertRaises(GcodeLevelingError, level, False)
+		self.assertIn(b"Z30.", level(True))
+
+class ModelCacheTest(LevelingTestCase):
+	def test_cached_model_is_loaded_instead_of_fit(self):
+		points = bedPoints(tilted)
+		fitted = model.ModelCache(self.folder).get(points, 2, 2)
+
+		# a fresh cache stands in for a restart, it has to find the model on disk
+		original = twoDimFit.twoDpolyFit
+		def twoDpolyFit(*args):
+			raise AssertionError("refit a cached model")
+		twoDimFit.twoDpolyFit = twoDpolyFit
+		try:
+			loaded = model.ModelCache(self.folder).get(points, 2, 2)
+		finally:
+			twoDimFit.twoDpolyFit = original
+
+		self.assertEqual(loaded.key, fitted.key)
+		self.assertEqual(loaded.derivatives, fitted.derivatives)
+		for x, y in ((0.0, 0.0), (37.5, 120.0), (200.0, 180.0)):
+			self.assertAlmostEqual(loaded.compiled.value(x, y), fitted.compiled.value(x, y), places=12)
+
+	# profiles only keep the model key, pruning keeps the models of every profile and drops the rest
+	def test_profiles_keep_their_models(self):
+		cache = model.ModelCache(self.folder)
+		flat = cache.get(bedPoints(lambda x, y: 0.0), 1, 1)
+		tiled = cache.get(bedPoints(tilted, count=9), 2, 2, (2, 2))
+		self.assertNotEqual(model.modelKey(bedPoints(tilted, count=9), 2, 2), tiled.key)
+
+		cache.prune(set([tiled.key]))
+		self.assertFalse(os.path.exists(cache.path(flat.key)))
+
+		switched = model.ModelCache(self.folder).load(tiled.key)
+		self.assertEqual(switched.tiles, tiled.tiles)
+		self.assertAlmostEqual(switched.compiled.value(140.0, 60.0), tiled.compiled.value(140.0, 60.0), places=12)
+		self.assertIsNone(model.ModelCache(self.folder).load(flat.key))
+
+class SubdivisionTest(unittest.TestCase):
+	def test_split_moves_stay_within_threshold(self):
+		rng = random.Random(3)
+		coeffs = twoDimFit.twoDpolyFit([(x, y, rng.gauss(0, 0.25)) for x, y, z in bedPoints(tilted, count=6)], 3, 3)
+		model = evaluators.forCoeffs(coeffs)
+		for trial in range(50):
+			start = (rng.uniform(0, 200), rng.uniform(0, 200))
+			end = (rng.uniform(0, 200), rng.uniform(0, 200))
+			for pieceStart, pieceEnd in maxima.lineWiseMaxima(model, start, end, maxima.SingleGradientAscent()):
+				startZ = model.value(*pieceStart)
+				endZ = model.value(*pieceEnd)
+				for step in range(1, 20):
+					q = step / 20.0
+					x = pieceStart[0] + q*(pieceEnd[0] - pieceStart[0])
+					y = pieceStart[1] + q*(pieceEnd[1] - pieceStart[1])
+					# the search only samples the worst point of a piece, so a little past the threshold is let through
+					self.assertLess(abs(model.value(x, y) - startZ - q*(endZ - startZ)), 1.1*math.sqrt(maxima.threshold))
+
+class SegmentLimitTest(unittest.TestCase):
+	def level(self, feedrate, minSegmentTime):
+		coeffs = twoDimFit.twoDpolyFit(bedPoints(lambda x, y: 0.2*math.sin(x/15.0), count=9), 6, 1)
+		gcode = "G90\nM82\nG1 X0 Y100 Z0.2 F{}\nG1 X200 Y100 E10\n".format(feedrate).encode("utf-8")
+		preprocessor = GcodePreProcessor(io.BytesIO(gcode), 3, logging.getLogger("test"), coeffs, -5.0, 5.0, 10.0, 15.0, False, minSegmentTime=minSegmentTime)
+		return preprocessor, preprocessor.read().decode("utf-8").splitlines()[3:]
+
+	def test_fast_moves_keep_the_minimum_segment_time(self):
+		preprocessor, unlimited = self.level(6000, 0.0)
+		self.assertEqual(len(unlimited), 7)
+
+		# 200 mm at 100 mm/s leaves room for 4 segments of half a second
+		preprocessor, limited = self.level(6000, 0.5)
+		self.assertEqual(len(limited), 4)
+		self.assertEqual(limited[-1], unlimited[-1])
+		self.assertEqual((preprocessor.limitedMoves, preprocessor.droppedSegments), (1, 3))
+		self.assertGreater(preprocessor.limitDeviation, 0.0)
+
+		preprocessor, slow = self.level(600, 0.5)
+		self.assertEqual(slow, unlimited)
+		self.assertEqual(preprocessor.limitedMoves, 0)
+
+class ArcWeldTest(unittest.TestCase):
+	def test_welded_lines_keep_their_comments(self):
+		welder = arcfit.ArcWelder(0.1)
+		lines = ["G90", "G1 X10 Y0 Z0.2"]
+		for step in range(1, 9):
+			angle = step*math.pi/16
+			lines.append("G1 X{:.4f} Y{:.4f} Z0.2 E{:.4f}{}".format(10*math.cos(angle), 10*math.sin(angle), step*0.1, " ; part {}".format(step) if step in (3, 5) else ""))
+		lines.append("G0 X0")
+		out = (welder.feedLines("\n".join(lines) + "\n") + welder.flush()).split("\n")
+
+		self.assertEqual(welder.arcs, 1)
+		self.assertEqual(out[2:5], ["; part 3", "; part 5", "G3 X0.0 Y10.0 Z0.2 I-10.0 J0.0 E0.8"])
+
+class FitTest(unittest.TestCase):
+	def test_cross_validation_picks_the_degree_of_the_surface(self):
+		points = bedPoints(lambda x, y: 0.002*x + 0.00001*(y-100)**2, count=6)
+		selection = twoDimFit.selectDegree(points, 3)
+		self.assertEqual((selection['x'], selection['y']), (1, 2))
+
+	def test_incremental_fit_matches_batch_fit(self):
+		rng = random.Random(7)
+		points = [(x, y, z + rng.gauss(0, 0.02)) for x, y, z in bedPoints(tilted, count=6)]
+		for xDeg, yDeg in ((1, 1), (2, 2), (3, 2)):
+			fit = twoDimFit.IncrementalFit(xDeg, yDeg)
+			for point in points:
+				fit.add(point)
+			incremental = fit.coeffs()
+			batch = twoDimFit.twoDpolyFit(points, xDeg, yDeg)
+			for x, y, z in points:
+				self.assertAlmostEqual(twoDimFit.twoDpolyEval(incremental, x, y), twoDimFit.twoDpolyEval(batch, x, y), places=6)
+
+	def test_compiled_evaluator_matches_eval(self):
+		rng = random.Random(11)
+		coeffs = twoDimFit.twoDpolyFit([(x, y, rng.gauss(0, 0.3)) for x, y, z in bedPoints(tilted)], 3, 3)
+		model = evaluators.forCoeffs(coeffs)
+		for trial in range(200):
+			x, y = rng.uniform(-20, 220), rng.uniform(-20, 220)
+			self.assertAlmostEqual(model.value(x, y), twoDimFit.twoDpolyEval(coeffs, x, y), places=9)
+
+	# the settings dialog can save coordinates as strings
+	def test_tiles_fit_from_string_points(self):
+		points = bedPoints(tilted, count=9)
+		tiles = tiling.fitTiles(points, 2, 2, 3, 2)
+		self.assertEqual(tiling.fitTiles([[str(coor) for coor in point] for point in points], 2, 2, 3, 2), tiles)
+
+class BudgetTest(LevelingTestCase):
+	def job(self, maxJobTime=0.0, maxGrowth=0.0):
+		return jobs.snapshot(self.coeffs, -5.0, 100.0, 10.0, 15.0, False, False, 0.0, 0.0, maxJobTime, maxGrowth)
+
+	def test_budgets(self):
+		now = time.time()
+		jobs.checkBudget(self.job(), now - 3600, 100 << 20, 0, None)
+		self.assertRaises(jobs.JobAborted, jobs.checkBudget, self.job(maxJobTime=10.0), now - 11, 0, 0, None)
+
+		# growth is measured against at least 1 MB of input
+		jobs.checkBudget(self.job(maxGrowth=4.0), now, 3 << 20, 1000, None)
+		self.assertRaises(jobs.JobAborted, jobs.checkBudget, self.job(maxGrowth=4.0), now, 5 << 20, 1000, None)
+		self.assertRaises(jobs.JobAborted, jobs.checkBudget, self.job(maxGrowth=4.0), now, 9 << 20, 2 << 20, None)
+
+	def test_cancelled_job_writes_nothing(self):
+		inPath = self.write("input.gcode", sampleGcode())
+		cancelPath = self.write("cancel", b"")
+		result = jobs.levelPath(inPath, self.path("output.gcode"), self.job(), cancelPath=cancelPath)
+		self.assertTrue(result['aborted'])
+		self.assertEqual(result['message'], "Cancelled")
+		self.assertFalse(os.path.exists(self.path("output.gcode")))
+
+class AdaptivePlanTest(unittest.TestCase):
+	# probes the surface the way auto_probe does, round by round until the plan has nothing left to add
+	def probe(self, surface):
+		plan = probing.AdaptivePlan(0.0, 200.0, 0.0, 200.0, 9, 9, 0.02, 81, maxRounds=6)
+		fit = twoDimFit.IncrementalFit(2, 2)
+		rounds = []
+		points = list(plan.coarse)
+		while len(points):
+			for x, y in points:
+				fit.add((x, y, surface(x, y)))
+			rounds.append(len(points))
+			points = plan.refine(fit, fit.coeffs(), points[-1])
+		return plan, fit, rounds
+
+	def test_surface_of_the_degree_needs_only_the_coarse_grid(self):
+		plan, fit, rounds = self.probe(tilted)
+		self.assertEqual((plan.xCount, plan.yCount), (4, 4))
+		self.assertEqual(rounds, [16])
+
+	def test_stalled_residuals_stop_the_refinement(self):
+		bump = lambda x, y: 0.3*math.exp(-((x-140)**2 + (y-60)**2)/900.0)
+		plan, fit, rounds = self.probe(bump)
+		self.assertFalse(plan.improving)
+		self.assertLess(len(rounds), plan.maxRounds)
+		self.assertLess(sum(rounds), plan.maxPoints)
+
+		coeffs = fit.coeffs()
+		self.assertGreater(len(plan.outliers), 0)
+		for x, y, z in plan.outliers:
+			self.assertGreater(abs(z - twoDimFit.twoDpolyEval(coeffs, x, y)), plan.tolerance)
+
+class ProbeSessionTest(unittest.TestCase):
+	def test_literal_prefix(self):
+		self.assertEqual(probing.literalPrefix(r"^ok X:(?P<x>-?[0-9.]+)"), "ok X:")
+		self.assertEqual(probing.literalPrefix(r"Bed X: \d"), "Bed X: ")
+		self.assertEqual(probing.literalPrefix(r"\.\+x?"), ".+")
+		# a character that may repeat or be left out ends the prefix
+		self.assertEqual(probing.literalPrefix("ab*c"), "a")
+		self.assertEqual(probing.literalPrefix("ab+c"), "ab")
+		for pattern, flags in (("a|b", 0), ("[X]", 0), ("ok X", re.IGNORECASE)):
+			self.assertEqual(probing.literalPrefix(pattern, flags), "")
+
+	def session(self, timeout):
+		session = probing.ProbeSession()
+		session.start(re.compile(r"ok X:(?P<x>[0-9.]+) Y:(?P<y>[0-9.]+) Z:(?P<z>-?[0-9.]+)"), timeout)
+		return session
+
+	def test_results_are_taken_only_while_a_point_waits(self):
+		session = self.session(5.0)
+		session.feed("ok X:1.0 Y:2.0 Z:0.3")
+		session.expect(0.5)
+		self.assertEqual(session.pointTimeout, 5.5)
+		for line in ("ok", "echo:busy processing", "ok X:10.0 Y:20.0 Z:-0.25", "ok X:1.0 Y:2.0 Z:0.3"):
+			session.feed(line)
+		self.assertEqual(session.wait(), (10.0, 20.0, -0.25))
+		session.finish()
+		self.assertEqual(session.state, probing.DONE)
+
+	def test_missing_result_or_abort_ends_the_session(self):
+		session = self.session(0.05)
+		session.expect()
+		self.assertIsNone(session.wait())
+		self.assertEqual((session.state, session.error), (probing.DONE, "No probe result within 0.1 s"))
+
+		session = self.session(0.0)
+		session.expect()
+		threading.Timer(0.05, session.abort, ("Cancelled",)).start()
+		self.assertIsNone(session.wait())
+		self.assertEqual(session.error, "Cancelled")
+		self.assertFalse(session.abort("Again"))
+
+class TilingTest(unittest.TestCase):
+	def test_tiles_are_continuous_across_seams(self):
+		bump = lambda x, y: 0.3*math.exp(-((x-140)**2 + (y-60)**2)/900.0)
+		tiles = tiling.fitTiles(bedPoints(bump, count=9), 2, 2, 3, 3)
+		model = evaluators.forTiles(tiles)
+		xSeams, ySeams = model.seams
+		self.assertEqual(len(xSeams), 3)
+
+		for seam in xSeams:
+			for y in (15.0, 60.0, 133.0):
+				self.assertAlmostEqual(model.value(seam - 1e-7, y), model.value(seam + 1e-7, y), places=6)
+				self.assertAlmostEqual(model.gradient(seam - 1e-7, y)[0], model.gradient(seam + 1e-7, y)[0], places=5)
+		for seam in ySeams:
+			for x in (15.0, 60.0, 133.0):
+				self.assertAlmostEqual(model.value(x, seam - 1e-7), model.value(x, seam + 1e-7), places=6)
+				self.assertAlmostEqual(model.gradient(x, seam - 1e-7)[1], model.gradient(x, seam + 1e-7)[1], places=5)
+
+class ResumeTest(LevelingTestCase):
+	def job(self):
+		return jobs.snapshot(self.coeffs, -5.0, 100.0, 10.0, 15.0, False, False, 0.0, 0.05, indexEvery=50)
+
+	# stands in for a restart: the job stops at a budget check after some checkpoints were saved
+	def interrupt(self, inPath, checkpointDir, checks):
+		original = jobs.checkBudget
+		calls = [0]
+		def checkBudget(*args):
+			calls[0] += 1
+			if calls[0] > checks:
+				raise jobs.JobAborted("Interrupted")
+			original(*args)
+
+		jobs.checkBudget = checkBudget
+		try:
+			return jobs.levelPath(inPath, self.path("resumed.gcode"), self.job(), checkpointDir=checkpointDir, checkpointInterval=0.0, indexPath=self.path("resumed.index.json"))
+		finally:
+			jobs.checkBudget = original
+
+	def test_resumed_output_is_identical(self):
+		inPath = self.write("input.gcode", sampleGcode(layers=100))
+		result = jobs.levelPath(inPath, self.path("direct.gcode"), self.job(), indexPath=self.path("direct.index.json"))
+		self.assertNotIn("error", result)
+		self.assertGreater(result['outBytes'], 4 << 16)
+
+		checkpointDir = self.path("job")
+		os.makedirs(checkpointDir)
+		interrupted = self.interrupt(inPath, checkpointDir, 3)
+		self.assertTrue(interrupted['aborted'])
+		self.assertIsNotNone(jobs.loadCheckpoint(checkpointDir))
+
+		resumed = jobs.levelPath(inPath, self.path("resumed.gcode"), self.job(), checkpointDir=checkpointDir, checkpointInterval=0.0, indexPath=self.path("resumed.index.json"))
+		self.assertNotIn("error", resumed)
+		self.assertEqual(self.read("direct.gcode"), self.read("resumed.gcode"))
+		self.assertEqual(index.load(self.path("direct.index.json")), index.load(self.path("resumed.index.json")))
+
+	def test_index_records_leveled_z(self):
+		inPath = self.write("input.gcode", sampleGcode(layers=3))
+		jobs.levelPath(inPath, self.path("direct.gcode"), self.job(), indexPath=self.path("direct.index.json"))
+		output = self.read("direct.gcode")
+		seekIndex = index.load(self.path("direct.index.json"))
+
+		for position in range(len(seekIndex['columns']['line'])):
+			entry = index.entry(seekIndex, position)
+			moves = [line for line in output[:entry['offset']].decode("utf-8").split("\n") if line[:2] in ("G0", "G1", "G2", "G3") and " Z" in line]
+			if entry['z'] is None:
+				self.assertEqual(moves, [])
+			else:
+				self.assertAlmostEqual(float(moves[-1].split(" Z")[1].split()[0]), entry['z'], places=3)
+
+if __name__ == "__main__":
+	unittest.main()